@@ -0,0 +1,64 @@
+"""Microbenchmark for making requests with app credentials.
+
+Run from the top of the repo:
+
+  python -m benchmarks.bench_app_jwt
+
+Compares the cost of an app-authenticated request when we have to sign a
+fresh JWT against the cost when we can reuse a cached one. No network access
+is needed: requests go to a fake transport.
+"""
+import timeit
+
+import trio
+
+from snekomatic.gh import GithubApp, CachedAppToken
+from tests.credentials import TEST_APP_ID, TEST_PRIVATE_KEY, TEST_USER_AGENT
+
+
+class NullTransport:
+    async def request(self, method, url, headers, body):
+        return 200, {"content-type": "application/json"}, b"{}"
+
+
+def bench(name, fn):
+    count, elapsed = timeit.Timer(fn).autorange()
+    print(f"{name:>28}: {elapsed / count * 1e6:8.1f} µs")
+
+
+def main():
+    app = GithubApp(
+        session=NullTransport(),
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+    )
+
+    def sign_fresh():
+        app._app_token = CachedAppToken()
+        app._app_jwt()
+
+    def sign_cached():
+        app._app_jwt()
+
+    async def requests(count, fresh):
+        client = app.app_client
+        for _ in range(count):
+            if fresh:
+                app._app_token = CachedAppToken()
+            await client.getitem("/app")
+
+    def request_fresh():
+        trio.run(requests, 100, True)
+
+    def request_cached():
+        trio.run(requests, 100, False)
+
+    bench("sign JWT (uncached)", sign_fresh)
+    bench("sign JWT (cached)", sign_cached)
+    bench("100 requests (uncached JWT)", request_fresh)
+    bench("100 requests (cached JWT)", request_cached)
+
+
+if __name__ == "__main__":
+    main()
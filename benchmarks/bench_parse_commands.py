@@ -0,0 +1,93 @@
+"""Microbenchmark for finding commands in comment bodies.
+
+Run from the top of the repo:
+
+  python -m benchmarks.bench_parse_commands
+
+The corpus is every comment body in the example webhook payloads in
+notes.org, plus variants of each with a long pasted log added, and with
+commands added. We compare a full markdown parse of every body against
+parse_commands with an empty cache (like new comments) and a full one (like
+redeliveries).
+"""
+import json
+from pathlib import Path
+import re
+import timeit
+
+import snekomatic.gh
+from snekomatic.gh import parse_commands, _parse_commands
+
+NOTES = Path(__file__).absolute().parent.parent / "notes.org"
+
+LOG = "".join(
+    f'  File "/usr/lib/python3.7/site-packages/thing.py", line {i}\n'
+    f"    return frobnicate(x)\n"
+    for i in range(500)
+)
+
+
+def bench(name, fn):
+    count, elapsed = timeit.Timer(fn).autorange()
+    print(f"{name:>28}: {elapsed / count * 1e3:8.2f} ms")
+
+
+def bodies_in(value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "body" and isinstance(item, str):
+                yield item
+            else:
+                yield from bodies_in(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from bodies_in(item)
+
+
+def load_corpus():
+    text = NOTES.read_text()
+    start = text.index("* Github webhook payload examples")
+    end = text.index("* Github action notes")
+    section = text[start:end]
+    bodies = []
+    for match in re.finditer(
+        r"#\+BEGIN_SRC json\n(.*?)#\+END_SRC", section, re.DOTALL
+    ):
+        bodies.extend(bodies_in(json.loads(match.group(1))))
+    corpus = []
+    for body in bodies:
+        corpus.append(body)
+        corpus.append(body + "\n\n```\n" + LOG + "```\n")
+        corpus.append(body + "\n/label bug\n/assign me")
+    return corpus
+
+
+def main():
+    corpus = load_corpus()
+    print(
+        f"{len(corpus)} bodies, {sum(map(len, corpus))} characters in total"
+    )
+
+    def full_parse():
+        for body in corpus:
+            list(_parse_commands(body))
+
+    def uncached():
+        snekomatic.gh._parsed_commands.clear()
+        for body in corpus:
+            parse_commands(body)
+
+    def cached():
+        for body in corpus:
+            parse_commands(body)
+
+    for body in corpus:
+        assert parse_commands(body) == list(_parse_commands(body))
+
+    bench("full markdown parse", full_parse)
+    bench("parse_commands (uncached)", uncached)
+    bench("parse_commands (cached)", cached)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Microbenchmark for finding the routes that match a webhook.
+
+Run from the top of the repo:
+
+  python -m benchmarks.bench_routing
+
+Registers a few hundred routes, restricted on action/repository/sender like
+a busy app would be, and compares RouteIndex against checking every route's
+restrictions in turn.
+"""
+import random
+import timeit
+
+from snekomatic.gh import Route, RouteIndex, _restriction_matches
+
+ACTIONS = ["opened", "closed", "edited", "labeled", "synchronize", "created"]
+REPOS = [f"python-trio/repo-{i}" for i in range(40)]
+SENDER_TYPES = ["User", "Bot"]
+ROUTE_COUNT = 400
+
+
+def bench(name, fn):
+    count, elapsed = timeit.Timer(fn).autorange()
+    print(f"{name:>28}: {elapsed / count * 1e6:8.1f} µs")
+
+
+async def handler(event_type, payload, client):  # pragma: no cover
+    pass
+
+
+def random_restrictions(rng):
+    restrictions = {}
+    if rng.random() < 0.9:
+        restrictions["action"] = rng.choice(ACTIONS)
+    if rng.random() < 0.7:
+        restrictions["repository.full_name"] = rng.choice(REPOS)
+    if rng.random() < 0.3:
+        restrictions["sender.type"] = rng.choice(SENDER_TYPES)
+    if rng.random() < 0.1:
+        restrictions["pull_request.draft"] = False
+    return restrictions
+
+
+def random_payload(rng):
+    return {
+        "action": rng.choice(ACTIONS),
+        "repository": {"full_name": rng.choice(REPOS)},
+        "sender": {"type": rng.choice(SENDER_TYPES)},
+        "pull_request": {"draft": rng.random() < 0.5},
+    }
+
+
+def main():
+    rng = random.Random(0)
+    routes = [
+        Route(handler, random_restrictions(rng)) for _ in range(ROUTE_COUNT)
+    ]
+    index = RouteIndex()
+    for route in routes:
+        index.add(route)
+    payloads = [random_payload(rng) for _ in range(100)]
+
+    def linear():
+        for payload in payloads:
+            [
+                route
+                for route in routes
+                if all(
+                    _restriction_matches(payload, path, expected)
+                    for path, expected in route.restrictions.items()
+                )
+            ]
+
+    def indexed():
+        for payload in payloads:
+            index.match(payload)
+
+    for payload in payloads:
+        assert index.match(payload) == [
+            route
+            for route in routes
+            if all(
+                _restriction_matches(payload, path, expected)
+                for path, expected in route.restrictions.items()
+            )
+        ]
+
+    print(f"{ROUTE_COUNT} routes, 100 events per run")
+    bench("linear scan", linear)
+    bench("RouteIndex", indexed)
+
+
+if __name__ == "__main__":
+    main()
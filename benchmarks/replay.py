@@ -0,0 +1,231 @@
+"""Replay webhooks through the whole app, against a fake Github.
+
+Run from the top of the repo. Like the tests, this needs a postgres; the
+database at $DATABASE_URL gets migrated and written to, so don't point it at
+anything you care about:
+
+  DATABASE_URL=postgresql://postgres@localhost/bench \
+      python -m benchmarks.replay --events 1000 --concurrency 20
+
+Signed payloads, built from the sample payloads in tests/sample-data plus
+some variations that trigger commands and invitations, are posted to
+quart_app's webhook endpoint, with up to --concurrency requests in flight.
+Github API calls go to tests.fake_github.FakeGithub, which can add latency
+(--github-latency) and errors (--github-error-rate) to make things more
+realistic. Webhooks are handled before the response is sent
+(WEBHOOK_WORKERS=0), so the latency measured is end-to-end.
+
+If any delivery fails (a non-2xx response, or a handler raising), the
+failures are listed and the exit status is 1, since the numbers from a
+broken run don't mean much.
+"""
+import argparse
+from collections import Counter
+from functools import partial
+import json
+import math
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import trio
+
+from tests.credentials import (
+    TEST_APP_ID,
+    TEST_INSTALLATION_ID,
+    TEST_PRIVATE_KEY,
+    TEST_USER_AGENT,
+    TEST_WEBHOOK_SECRET,
+)
+from tests.fake_github import FakeGithub
+from tests.util import fake_webhook
+
+REPO_DIR = Path(__file__).absolute().parent.parent
+SAMPLE_DATA_DIR = REPO_DIR / "tests" / "sample-data"
+
+# sample data -> event type
+SAMPLES = {
+    "issue-created-webhook": "issues",
+    "comment-existing-issue": "issue_comment",
+    "comment-edited": "issue_comment",
+    "new-pr-created": "pull_request",
+    "comment-existing-pr": "issue_comment",
+    "add-single-comment": "pull_request_review",
+    "pr-review-comment": "pull_request_review_comment",
+    "full-pr-review": "pull_request_review",
+    "pr-review-comment-01": "pull_request_review_comment",
+    "pr-review": "pull_request_review",
+}
+
+ORG = "njsmith-test-org"
+
+
+def load_sample(name):
+    data = json.loads((SAMPLE_DATA_DIR / (name + ".json")).read_text())
+    data["installation"]["id"] = TEST_INSTALLATION_ID
+    return data
+
+
+def build_corpus(rng, count):
+    samples = [
+        (event_type, load_sample(name))
+        for name, event_type in SAMPLES.items()
+    ]
+
+    ping = load_sample("comment-existing-issue")
+    ping["comment"]["body"] = "Is this thing on?\n/ping"
+
+    def merged_pr():
+        payload = load_sample("new-pr-created")
+        payload["action"] = "closed"
+        payload["pull_request"]["merged"] = True
+        # Mostly people we've seen before, sometimes someone new
+        login = f"contributor-{rng.randrange(count // 4 + 1)}"
+        payload["pull_request"]["user"]["login"] = login
+        return payload
+
+    corpus = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.1:
+            corpus.append(("issue_comment", ping))
+        elif roll < 0.3:
+            corpus.append(("pull_request", merged_pr()))
+        else:
+            corpus.append(rng.choice(samples))
+    return corpus
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[round(fraction * (len(sorted_values) - 1))]
+
+
+async def replay(quart_app, corpus, concurrency):
+    from snekomatic.db import prepare_database
+
+    # Migrate the database before we start timing
+    await prepare_database()
+    client = quart_app.test_client()
+    latencies = []
+    statuses = []
+    send_channel, receive_channel = trio.open_memory_channel(len(corpus))
+    async with send_channel:
+        for event_type, payload in corpus:
+            send_channel.send_nowait(
+                fake_webhook(event_type, payload, TEST_WEBHOOK_SECRET)
+            )
+
+    async def worker():
+        async for headers, body in receive_channel:
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    "/webhook/github", data=body, headers=headers
+                )
+            except Exception as exc:
+                statuses.append(repr(exc))
+            else:
+                statuses.append(response.status_code)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    async with trio.open_nursery() as nursery:
+        for _ in range(concurrency):
+            nursery.start_soon(worker)
+    return time.perf_counter() - start, sorted(latencies), statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--consistency-delay",
+        type=float,
+        default=0,
+        help="seconds process_event waits before routing (production: 1)",
+    )
+    parser.add_argument(
+        "--github-latency",
+        type=float,
+        default=0,
+        help="median Github API latency in seconds (log-normal)",
+    )
+    parser.add_argument(
+        "--github-error-rate",
+        type=float,
+        default=0,
+        help="fraction of Github API requests that fail with a 502",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if "DATABASE_URL" not in os.environ:
+        parser.error("DATABASE_URL must point to a scratch postgres database")
+    os.environ["GITHUB_USER_AGENT"] = TEST_USER_AGENT
+    os.environ["GITHUB_APP_ID"] = TEST_APP_ID
+    os.environ["GITHUB_PRIVATE_KEY"] = TEST_PRIVATE_KEY
+    os.environ["GITHUB_WEBHOOK_SECRET"] = TEST_WEBHOOK_SECRET
+    os.environ.pop("WEBHOOK_WORKERS", None)
+
+    # Imported late, since it reads the environment at import time
+    from snekomatic.app import quart_app, github_app
+
+    rng = random.Random(args.seed)
+    fake_github = FakeGithub(rng=rng)
+    if args.github_latency:
+        fake_github.latency["*"] = partial(
+            rng.lognormvariate, math.log(args.github_latency), 0.5
+        )
+    fake_github.error_rate["*"] = args.github_error_rate
+    # Half of the returning contributors are already members
+    for i in range(0, args.events // 4 + 1, 2):
+        fake_github.orgs[ORG][f"contributor-{i}"] = "active"
+    github_app._transport = fake_github
+    github_app.consistency_delay = args.consistency_delay
+
+    corpus = build_corpus(rng, args.events)
+    elapsed, latencies, statuses = trio.run(
+        replay, quart_app, corpus, args.concurrency
+    )
+
+    failed = Counter(
+        status
+        for status in statuses
+        if not isinstance(status, int) or not 200 <= status < 300
+    )
+    handler_failures = {
+        name: stats.failures
+        for name, stats in github_app.route_stats.items()
+        if stats.failures
+    }
+    print(
+        f"{len(corpus)} events, concurrency {args.concurrency}, "
+        f"{sum(failed.values())} failed"
+    )
+    print(f"  throughput: {len(corpus) / elapsed:8.1f} events/s")
+    print(f"  p50:        {percentile(latencies, 0.5) * 1e3:8.1f} ms")
+    print(f"  p99:        {percentile(latencies, 0.99) * 1e3:8.1f} ms")
+    print(
+        f"  Github calls per event: "
+        f"{fake_github.total_calls / len(corpus):.2f}"
+    )
+    for endpoint, calls in sorted(fake_github.calls.items()):
+        print(
+            f"    {endpoint:>14}: {calls / len(corpus):.2f} "
+            f"({fake_github.not_modified[endpoint]} not modified, "
+            f"{fake_github.errors[endpoint]} errors)"
+        )
+    if failed or handler_failures:
+        print("FAILED; these numbers are not trustworthy")
+        for status, count in failed.most_common():
+            print(f"  {count} deliveries got {status}")
+        for name, count in sorted(handler_failures.items()):
+            print(f"  {name} raised {count} times")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
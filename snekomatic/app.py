@@ -1,6 +1,9 @@
 import sys
 import os
+import datetime
+from functools import partial
 import trio
+import attr
 from glom import glom
 import hypercorn
 import hypercorn.trio
@@ -8,13 +11,32 @@ import quart
 from quart import request
 from quart_trio import QuartTrio
 import gidgethub
-from gidgethub.sansio import accept_format
-
-from .db import SentInvitation
-from .gh import GithubApp, reply_url, reaction_url
+from gidgethub.sansio import Event, accept_format
+
+from .db import (
+    SentInvitation,
+    WebhookJob,
+    JOB_MAX_ATTEMPTS,
+    DB_STATS,
+    DB_QUERY_SECONDS,
+    DB_WAIT_SECONDS,
+    InstallationTokenStore,
+    WebhookDeliveryStore,
+    OrgMembers,
+    prepare_database,
+)
+from .gh import (
+    GithubApp,
+    WebhookQueueFull,
+    WebhookHandlerError,
+    reply_url,
+    reaction_url,
+)
+from .metrics import CONTENT_TYPE, Gauge, Histogram, Registry
+from .log import LOGGER, Logger, log
+from .stall import StallDetector
+from .tracing import RECORDER, span_tree, start_trace
 
-# we should stash the delivery id in a contextvar and include it in logging
-# also maybe structlog? eh print is so handy for now
 
 # Maybe:
 # send message on first PR, with basic background info – volunteer project,
@@ -40,20 +62,140 @@ from .gh import GithubApp, reply_url, reaction_url
 # the milestone coming and then when you get there it *is* a milestone.
 
 quart_app = QuartTrio(__name__)
-github_app = GithubApp()
+
+if "TOKEN_STORE_KEY" in os.environ:
+    # Share installation tokens with any other processes using the same
+    # database
+    token_store = InstallationTokenStore(os.environ["TOKEN_STORE_KEY"])
+else:
+    token_store = None
+
+# The delivery store makes sure redelivered webhooks are only handled once,
+# even if the copies go to different processes.
+github_app = GithubApp(
+    token_store=token_store, delivery_store=WebhookDeliveryStore()
+)
+
+# Served at /metrics, for Prometheus to scrape
+metrics_registry = Registry()
+metrics_registry.register(github_app.metrics)
+metrics_registry.register(DB_WAIT_SECONDS)
+metrics_registry.register(DB_QUERY_SECONDS)
+metrics_registry.register(LOGGER)
+stall_detector = StallDetector()
+metrics_registry.register(stall_detector.metrics)
+WEBHOOK_ACK_SECONDS = metrics_registry.register(
+    Histogram(
+        "snekomatic_webhook_ack_seconds",
+        "Time from receiving a webhook to responding to it",
+    )
+)
+# Only updated when scraped, since it needs a database query
+WEBHOOK_JOBS = metrics_registry.register(
+    Gauge(
+        "snekomatic_webhook_jobs",
+        "Webhooks in the postgres queue",
+        ["state"],
+    )
+)
 
 if "SENTRY_DSN" in os.environ:
     import sentry_sdk
 
     sentry_sdk.init(os.environ["SENTRY_DSN"])
 
+    # Errors in handlers running on background workers don't go through
+    # quart, so they need to be reported separately.
+    github_app.error_handler = sentry_sdk.capture_exception
+
     @quart.got_request_exception.connect
     async def error_handler(_, *, exception):
-        if isinstance(exception, Exception):
-            print(f"Logging error to sentry: {exception!r}")
+        if isinstance(exception, WebhookHandlerError):
+            log("Handler errors were already logged to sentry")
+        elif isinstance(exception, Exception):
+            log(f"Logging error to sentry: {exception!r}")
             sentry_sdk.capture_exception(exception)
         else:
-            print(f"NOT logging error to sentry: {exception!r}")
+            log(f"NOT logging error to sentry: {exception!r}")
+
+
+@attr.s
+class DurableWebhookQueue:
+    """Webhook queue that lives in postgres, so it survives restarts.
+
+    Any number of workers, in any number of processes, can pull from it.
+    """
+
+    batch_size = attr.ib()
+    # Workers in this process get woken up immediately when we push a job,
+    # but jobs pushed by other processes are only noticed by polling.
+    poll_interval = attr.ib(default=5)
+    _new_job = attr.ib(factory=trio.Event)
+
+    async def push(self, event):
+        await github_app.decode_event(event)
+        await WebhookJob.push(event.delivery_id, event.event, event.data)
+        self._new_job.set()
+
+    async def run_worker(self):
+        while True:
+            if self._new_job.is_set():
+                self._new_job = trio.Event()
+            jobs = await WebhookJob.claim(self.batch_size)
+            if not jobs:
+                with trio.move_on_after(self.poll_interval):
+                    await self._new_job.wait()
+                continue
+            for job in jobs:
+                await self._run_job(job)
+
+    async def _run_job(self, job):
+        with start_trace(job.delivery_id, "webhook_job", job_id=job.id):
+            await self._run_job_traced(job)
+
+    async def _run_job_traced(self, job):
+        if job.attempts > JOB_MAX_ATTEMPTS:
+            # Probably this job keeps killing whatever process runs it
+            await WebhookJob.fail(job, "worker died while processing")
+            log("Job dead-lettered", job_id=job.id)
+            return
+        # The rest of the batch might have been waiting a while
+        if not await WebhookJob.renew(job):
+            log("Lost our lease on this job; skipping it", job_id=job.id)
+            return
+        log(
+            f"Job attempt {job.attempts} of {JOB_MAX_ATTEMPTS}",
+            job_id=job.id,
+        )
+        event = Event(
+            job.payload, event=job.event_type, delivery_id=job.delivery_id
+        )
+        try:
+            # Failed attempts release the delivery, so retries get through.
+            # But if another worker is still running this job (e.g. we took
+            # over after its lease ran out), the delivery store stops us from
+            # running the handlers twice.
+            await github_app.process_event(event)
+        except Exception as exc:
+            # Handler errors were already logged with their tracebacks
+            handler_error = isinstance(exc, WebhookHandlerError)
+            log("Job failed", job_id=job.id, exc_info=not handler_error)
+            if not handler_error and github_app.error_handler is not None:
+                github_app.error_handler(exc)
+            if await WebhookJob.fail(job, repr(exc)):
+                log("Job dead-lettered", job_id=job.id)
+        else:
+            await WebhookJob.complete(job)
+
+
+# Set by main() if we're using the postgres-backed queue
+durable_webhook_queue = None
+
+# Set by main() once startup has finished (e.g. the database is migrated)
+ready = False
+
+# Set by main(); traces include payload details, so they aren't public
+debug_traces_enabled = False
 
 
 @quart_app.route("/")
@@ -61,9 +203,103 @@ async def index():
     return "Hi! 🐍🐍🐍"
 
 
+@quart_app.route("/ready")
+async def ready_check():
+    if not ready:
+        return "starting up", 503
+    return "ready"
+
+
+@quart_app.route("/status")
+async def status():
+    if durable_webhook_queue is not None:
+        queue_status = {"webhook_jobs": await WebhookJob.counts()}
+    else:
+        queue_status = {
+            "webhook_queue": attr.asdict(github_app.webhook_queue_stats)
+        }
+    return quart.jsonify(
+        webhook_workers_running=(
+            durable_webhook_queue is not None
+            or github_app.webhook_workers_running
+        ),
+        db=attr.asdict(DB_STATS),
+        loop_stalls={
+            offender: attr.asdict(stats)
+            for offender, stats in stall_detector.offenders.items()
+        },
+        rate_limits={
+            str(key): attr.asdict(budget)
+            for key, budget in github_app.rate_limits.budgets.items()
+        },
+        **queue_status,
+    )
+
+
+@quart_app.route("/metrics")
+async def prometheus_metrics():
+    if durable_webhook_queue is not None:
+        for state, count in (await WebhookJob.counts()).items():
+            WEBHOOK_JOBS.set(count, state=state)
+    return metrics_registry.render(), 200, {"content-type": CONTENT_TYPE}
+
+
+@quart_app.route("/debug/traces")
+async def debug_traces():
+    if not debug_traces_enabled:
+        return "not found", 404
+    return quart.jsonify(
+        traces=[
+            {
+                "delivery_id": delivery_id,
+                "spans": len(spans),
+                # The longest one is usually the whole thing
+                "duration": max(s["duration"] for s in spans),
+                "errors": sum(1 for s in spans if s["error"] is not None),
+            }
+            for delivery_id, spans in RECORDER.recent()
+        ]
+    )
+
+
+@quart_app.route("/debug/traces/<delivery_id>")
+async def debug_trace(delivery_id):
+    if not debug_traces_enabled:
+        return "not found", 404
+    spans = RECORDER.get(delivery_id)
+    if spans is None:
+        return "no such trace (maybe it's too old?)", 404
+    return quart.jsonify(delivery_id=delivery_id, spans=span_tree(spans))
+
+
 @quart_app.route("/webhook/github", methods=["POST"])
 async def webhook_github():
+    received = trio.current_time()
+    delivery_id = request.headers.get("x-github-delivery")
+    try:
+        with start_trace(delivery_id, "webhook_github"):
+            return await _handle_webhook()
+    finally:
+        WEBHOOK_ACK_SECONDS.observe(trio.current_time() - received)
+
+
+async def _handle_webhook():
     body = await request.get_data()
+    if durable_webhook_queue is not None:
+        event = github_app.parse_webhook(request.headers, body)
+        # Don't bother storing events that nothing would be routed to
+        if github_app.might_route(event):
+            await durable_webhook_queue.push(event)
+        return "", 202
+    if github_app.webhook_workers_running:
+        # Acknowledge as soon as the event is validated and queued; the
+        # workers started in main() will take it from here.
+        try:
+            await github_app.enqueue_webhook(request.headers, body)
+        except WebhookQueueFull as exc:
+            log(str(exc))
+            return "webhook queue is full", 503
+        return "", 202
     await github_app.dispatch_webhook(request.headers, body)
     return ""
 
@@ -142,33 +378,113 @@ async def _member_state(gh_client, org, member):
         return glom(response, "state")
 
 
+# How often main() refreshes our copy of the org memberships, in seconds (see
+# ORG_MEMBER_SYNC_INTERVAL). None means we don't keep a copy, and always ask
+# Github.
+org_member_sync_interval = None
+
+
+async def _sync_org_members(gh_client, org):
+    states = {}
+    async for member in gh_client.getiter(
+        "/orgs/{org}/members?per_page=100", url_vars={"org": org}
+    ):
+        states[member["login"]] = "active"
+    async for invitation in gh_client.getiter(
+        "/orgs/{org}/invitations?per_page=100", url_vars={"org": org}
+    ):
+        # Invitations sent by email don't have a login
+        if invitation.get("login") is not None:
+            states.setdefault(invitation["login"], "pending")
+    await OrgMembers.replace(org, states)
+    log(f"Synced {len(states)} members and invitations for {org}")
+
+
+async def _sync_all_org_members():
+    async for installation in github_app.app_client.getiter(
+        "/app/installations"
+    ):
+        if glom(installation, "account.type") != "Organization":
+            continue
+        org = glom(installation, "account.login")
+        # It's fine if this waits for more urgent requests
+        gh_client = github_app.client_for(installation["id"], priority="low")
+        try:
+            await _sync_org_members(gh_client, org)
+        except Exception:
+            log(f"Syncing members of {org} failed", exc_info=True)
+
+
+async def run_org_member_sync(interval):
+    while True:
+        try:
+            await _sync_all_org_members()
+        except Exception:
+            # We'll fall back on asking Github until the next try
+            log("Syncing org members failed", exc_info=True)
+        await trio.sleep(interval)
+
+
+async def _cached_member_state(gh_client, org, member):
+    # Same as _member_state, but tries our copy first
+    if org_member_sync_interval is not None:
+        # Webhooks keep our copy up to date between syncs, but in case we
+        # missed some, we only trust it until the next sync is due. If that
+        # one is late or failed, we ask Github.
+        max_age = datetime.timedelta(seconds=org_member_sync_interval)
+        fresh, state = await OrgMembers.state(org, member, max_age=max_age)
+        if fresh:
+            log(f"Our copy of {org}'s members says {member} is {state}")
+            return state
+    return await _member_state(gh_client, org, member)
+
+
+@github_app.route("organization", action="member_added")
+@github_app.route("organization", action="member_removed")
+@github_app.route("organization", action="member_invited")
+async def organization_membership_changed(event_type, payload, gh_client):
+    org = glom(payload, "organization.login")
+    action = payload["action"]
+    if action == "member_invited":
+        login = glom(payload, "invitation.login", default=None)
+        if login is None:
+            # Invited by email; we'll find out who it was when they accept
+            return
+        state = "pending"
+    else:
+        login = glom(payload, "membership.user.login")
+        state = "active" if action == "member_added" else None
+    log(f"{org} membership change: {login} is now {state}")
+    await OrgMembers.set_state(org, login, state)
+
+
 # There's no "merged" event; instead you get action=closed + merged=True
 @github_app.route("pull_request", action="closed")
 async def pull_request_merged(event_type, payload, gh_client):
-    print("PR closed")
+    log("PR closed")
     if not glom(payload, "pull_request.merged"):
-        print("but not merged, so never mind")
+        log("but not merged, so never mind")
         return
     if glom(payload, "pull_request.user.type", default="").lower() == "bot":
-        print("This user is a bot -> not inviting")
+        log("This user is a bot -> not inviting")
         return
     creator = glom(payload, "pull_request.user.login")
     org = glom(payload, "organization.login")
-    print(f"PR by {creator} was merged!")
+    log(f"PR by {creator} was merged!")
 
-    if SentInvitation.contains(creator):
-        print("The database says we already sent an invitation")
+    if await SentInvitation.contains(creator):
+        log("The database says we already sent an invitation")
         return
 
-    state = await _member_state(gh_client, org, creator)
+    state = await _cached_member_state(gh_client, org, creator)
     if state is not None:
         # Remember for later so we don't keep checking the Github API over and
         # over.
-        SentInvitation.add(creator)
-        print(f"They already have member state {state}; not inviting")
+        await SentInvitation.add(creator)
+        log(f"They already have member state {state}; not inviting")
         return
 
-    print("Inviting! Woohoo!")
+    log("Inviting! Woohoo!")
     # Send an invitation
     await gh_client.put(
         "/orgs/{org}/memberships/{username}",
@@ -176,7 +492,7 @@ async def pull_request_merged(event_type, payload, gh_client):
         data={"role": "member"},
     )
     # Record that we did
-    SentInvitation.add(creator)
+    await SentInvitation.add(creator)
     # Welcome them
     await gh_client.post(
         glom(payload, "pull_request.comments_url"),
@@ -186,7 +502,7 @@ async def pull_request_merged(event_type, payload, gh_client):
 
 @github_app.route_command("ping")
 async def handle_ping(command, event_type, payload, gh_client):
-    assert command == ["ping"]
+    assert command == ["/ping"]
     await gh_client.post(
         reply_url(event_type, payload), data={"body": "pong!"}
     )
@@ -197,20 +513,117 @@ async def handle_ping(command, event_type, payload, gh_client):
     )
 
 
+async def _startup():
+    global ready
+    start = trio.current_time()
+    # Do this up front rather than making the first webhook wait for it
+    await prepare_database()
+    ready = True
+    log(f"~~~ Ready after {trio.current_time() - start:.3f}s ~~~")
+
+
 async def main(*, task_status=trio.TASK_STATUS_IGNORED):
-    print("~~~ Starting up! ~~~")
+    global durable_webhook_queue, ready, org_member_sync_interval
+    global debug_traces_enabled
+    log("~~~ Starting up! ~~~")
     # On Heroku, have to bind to whatever $PORT says:
     # https://devcenter.heroku.com/articles/dynos#local-environment-variables
     port = os.environ.get("PORT", 8000)
-    async with trio.open_nursery() as nursery:
-        config = hypercorn.Config.from_mapping(
-            bind=[f"0.0.0.0:{port}"],
-            # Log to stdout
-            accesslog="-",
-            errorlog="-",
-            # Setting this just silences a warning:
-            worker_class="trio",
-        )
-        urls = await nursery.start(hypercorn.trio.serve, quart_app, config)
-        print("Accepting HTTP requests at:", urls)
-        task_status.started(urls)
+    # If WEBHOOK_WORKERS is set, then webhooks are acknowledged immediately
+    # and processed by this many background tasks. Otherwise, each webhook
+    # is fully processed before we respond to it.
+    webhook_workers = int(os.environ.get("WEBHOOK_WORKERS", 0))
+    # "memory" is fastest, but anything that's queued is lost if we restart.
+    # "postgres" is durable, and can be shared between several processes.
+    webhook_queue = os.environ.get("WEBHOOK_QUEUE", "memory")
+    webhook_queue_size = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+    webhook_job_batch_size = int(os.environ.get("WEBHOOK_JOB_BATCH_SIZE", 10))
+    # If set, we keep a copy of who's in our orgs, refreshed this often (in
+    # seconds), so we don't have to ask Github on every merged PR.
+    if "ORG_MEMBER_SYNC_INTERVAL" in os.environ:
+        org_member_sync_interval = int(os.environ["ORG_MEMBER_SYNC_INTERVAL"])
+    # Recent traces are always kept in memory; if this is set, they can be
+    # seen at /debug/traces. Only turn it on if the app isn't reachable by
+    # strangers.
+    debug_traces_enabled = os.environ.get("DEBUG_TRACES") == "1"
+    # If this is set, traces are also appended to this file.
+    trace_file = None
+    if "TRACE_FILE" in os.environ:
+        trace_file = open(os.environ["TRACE_FILE"], "a", encoding="utf-8")
+        trace_logger = Logger(stream=trace_file)
+        RECORDER.export_to(trace_logger.write_line)
+    # Keep only some of the chattiest log lines, e.g.
+    # "routing=0.1,queue=0.01" keeps 10% of routing lines and 1% of queue
+    # lines. Lines in other categories are always kept.
+    if "LOG_SAMPLE_RATES" in os.environ:
+        for entry in os.environ["LOG_SAMPLE_RATES"].split(","):
+            category, rate = entry.split("=")
+            LOGGER.sample_rates[category.strip()] = float(rate)
+    # If the event loop is blocked for longer than this many seconds, log
+    # what was blocking it. 0 turns the stall detector off.
+    stall_threshold = float(os.environ.get("LOOP_STALL_THRESHOLD", 0.1))
+    # How many threads can be busy with CPU-heavy work (big payloads, etc.)
+    # at once
+    if "CPU_THREADS" in os.environ:
+        github_app.cpu_offload.max_threads = int(os.environ["CPU_THREADS"])
+    try:
+        async with trio.open_nursery() as nursery:
+            # From here on, logging doesn't block on stdout
+            await nursery.start(LOGGER.run_writer)
+            if trace_file is not None:
+                await nursery.start(trace_logger.run_writer)
+            if stall_threshold > 0:
+                stall_detector.threshold = stall_threshold
+                nursery.start_soon(stall_detector.run)
+            # This runs concurrently with starting the HTTP server
+            nursery.start_soon(_startup)
+            nursery.start_soon(github_app.run_token_refresher)
+            if org_member_sync_interval is not None:
+                nursery.start_soon(
+                    run_org_member_sync, org_member_sync_interval
+                )
+            if webhook_workers > 0:
+                log(
+                    f"Starting {webhook_workers} webhook workers "
+                    f"({webhook_queue} queue)"
+                )
+                if webhook_queue == "postgres":
+                    durable_webhook_queue = DurableWebhookQueue(
+                        batch_size=webhook_job_batch_size
+                    )
+                    for _ in range(webhook_workers):
+                        nursery.start_soon(durable_webhook_queue.run_worker)
+                elif webhook_queue == "memory":
+                    nursery.start_soon(
+                        partial(
+                            github_app.run_webhook_workers,
+                            webhook_workers,
+                            queue_size=webhook_queue_size,
+                        )
+                    )
+                else:
+                    raise RuntimeError(
+                        f"unknown WEBHOOK_QUEUE: {webhook_queue!r}"
+                    )
+            config = hypercorn.Config.from_mapping(
+                bind=[f"0.0.0.0:{port}"],
+                # Log to stdout
+                accesslog="-",
+                errorlog="-",
+                # Setting this just silences a warning:
+                worker_class="trio",
+            )
+            urls = await nursery.start(
+                hypercorn.trio.serve, quart_app, config
+            )
+            log("Accepting HTTP requests", urls=" ".join(urls))
+            task_status.started(urls)
+    finally:
+        durable_webhook_queue = None
+        ready = False
+        org_member_sync_interval = None
+        debug_traces_enabled = False
+        LOGGER.sample_rates.clear()
+        RECORDER.close()
+        if trace_file is not None:
+            trace_file.close()
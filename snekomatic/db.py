@@ -1,14 +1,45 @@
 import os
+import json
+import time
+import datetime
+import functools
+from contextlib import asynccontextmanager
 from pathlib import Path
-from sqlalchemy import create_engine, MetaData, Table, Column, String
-from sqlalchemy.sql.expression import select, exists
+import trio
+import pendulum
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import (
+    create_engine,
+    MetaData,
+    Table,
+    Column,
+    Index,
+    String,
+    Integer,
+    Text,
+    Boolean,
+    DateTime,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql.expression import select, func
 import alembic.config
 import alembic.command
 import alembic.migration
 import alembic.autogenerate
+import alembic.script
 import pprint
+
+from .log import log
+from .metrics import Histogram
+from .tracing import span
+import threading
 import attr
 
+# How many connections we keep open to the database. Since all our database
+# work happens in threads that hold a connection for their whole lifetime,
+# this is also the maximum number of threads talking to the database at once.
+DB_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+
 metadata = MetaData()
 
 sent_invitation = Table(
@@ -17,6 +48,69 @@ sent_invitation = Table(
     Column("entry", String, primary_key=True),
 )
 
+webhook_job = Table(
+    "webhook_job",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("delivery_id", String, nullable=False),
+    Column("event_type", String, nullable=False),
+    # The decoded webhook payload, re-encoded as JSON
+    Column("payload", Text, nullable=False),
+    # Incremented every time a worker claims the job
+    Column("attempts", Integer, nullable=False),
+    # The job can't be claimed before this time. It's pushed into the future
+    # both when a worker claims the job (so if the worker dies, someone else
+    # will pick it up after the lease runs out) and when we're backing off
+    # after a failure.
+    Column("run_at", DateTime(timezone=True), nullable=False),
+    # Jobs that keep failing get parked here for a human to look at
+    Column("dead", Boolean, nullable=False),
+    Column("last_error", Text),
+    Index("ix_webhook_job_run_at", "run_at"),
+)
+
+installation_token = Table(
+    "installation_token",
+    metadata,
+    Column("installation_id", String, primary_key=True),
+    # Encrypted with TOKEN_STORE_KEY, so a database leak doesn't hand out
+    # access to our installations
+    Column("encrypted_token", Text, nullable=False),
+    Column("expires_at", DateTime(timezone=True), nullable=False),
+)
+
+# Our copy of who's in the Github orgs we're installed in
+org_member = Table(
+    "org_member",
+    metadata,
+    Column("org", String, primary_key=True),
+    # Lowercased, since Github logins are case-insensitive
+    Column("login", String, primary_key=True),
+    # "active" for members, "pending" for people with an invitation
+    Column("state", String, nullable=False),
+)
+
+org_member_sync = Table(
+    "org_member_sync",
+    metadata,
+    Column("org", String, primary_key=True),
+    # When we last fetched the full list of members; until then, we don't
+    # know who *isn't* a member
+    Column("synced_at", DateTime(timezone=True), nullable=False),
+)
+
+webhook_delivery = Table(
+    "webhook_delivery",
+    metadata,
+    Column("delivery_id", String, primary_key=True),
+    # When a process started handling the delivery. If it's still not done
+    # after DELIVERY_LEASE, that process probably died, and someone else can
+    # take over.
+    Column("claimed_at", DateTime(timezone=True), nullable=False),
+    Column("done", Boolean, nullable=False),
+    Index("ix_webhook_delivery_claimed_at", "claimed_at"),
+)
+
 
 @attr.s
 class CachedEngine:
@@ -26,52 +120,642 @@ class CachedEngine:
 
 CACHED_ENGINE = CachedEngine(None, None)
 
+# Held while setting up the engine, so that if several threads need it at
+# once, only one of them runs the migrations.
+_engine_lock = threading.Lock()
 
-def get_conn():
-    global CACHED_ENGINE
-    if CACHED_ENGINE.database_url != os.environ["DATABASE_URL"]:
-        engine = create_engine(os.environ["DATABASE_URL"])
 
-        # Run any necessary migrations
-        with engine.connect() as conn:
-            alembic_cfg = alembic.config.Config(
-                Path(__file__).parent / "alembic.ini"
-            )
-            alembic_cfg.attributes["connection"] = conn
-            alembic.command.upgrade(alembic_cfg, "head")
+def _migrate_and_check(conn):
+    alembic_cfg = alembic.config.Config(Path(__file__).parent / "alembic.ini")
+    head = alembic.script.ScriptDirectory.from_config(
+        alembic_cfg
+    ).get_current_head()
+    current = alembic.migration.MigrationContext.configure(
+        conn
+    ).get_current_revision()
+    if current == head:
+        # We've already migrated and checked this database, so save ourselves
+        # the (slow) comparison.
+        log(f"Database schema is at {head}; skipping checks")
+        return
+
+    # Run any necessary migrations
+    log(f"Migrating database from {current} to {head}")
+    alembic_cfg.attributes["connection"] = conn
+    alembic.command.upgrade(alembic_cfg, "head")
+
+    # Verify that the actual final schema matches what we expect
+    mc = alembic.migration.MigrationContext.configure(conn)
+    diff = alembic.autogenerate.compare_metadata(mc, metadata)
+    if diff:
+        log(
+            "!!! mismatch between db schema and code\n" + pprint.pformat(diff)
+        )
+        raise RuntimeError("consistency check failed")
+
 
-        # Verify that the actual final schema matches what we expect
+def _prepare_engine(database_url):
+    start = time.monotonic()
+    engine = create_engine(database_url, pool_size=DB_POOL_SIZE)
+    try:
         with engine.connect() as conn:
-            mc = alembic.migration.MigrationContext.configure(conn)
-            diff = alembic.autogenerate.compare_metadata(mc, metadata)
-            if diff:
-                print("!!! mismatch between db schema and code")
-                pprint.pprint(diff)
-                raise RuntimeError("consistency check failed")
+            # Postgres has transactional DDL, so if the consistency check
+            # fails, the migrations get rolled back too.
+            with conn.begin():
+                _migrate_and_check(conn)
+    except:
+        engine.dispose()
+        raise
+    log(f"Database ready in {time.monotonic() - start:.3f}s")
+    return CachedEngine(engine, database_url)
 
-        # Iff that all worked out, then save the engine so we can skip those
-        # checks next time
-        CACHED_ENGINE = CachedEngine(engine, os.environ["DATABASE_URL"])
-    return CACHED_ENGINE.engine.connect()
+
+def _get_engine():
+    global CACHED_ENGINE
+    with _engine_lock:
+        if CACHED_ENGINE.engine is None:
+            CACHED_ENGINE = _prepare_engine(os.environ["DATABASE_URL"])
+        return CACHED_ENGINE.engine
+
+
+def get_conn():
+    engine = CACHED_ENGINE.engine
+    if engine is None:
+        engine = _get_engine()
+    return engine.connect()
+
+
+def dispose_engine():
+    """Forget about the current database (mostly useful for tests)."""
+    global CACHED_ENGINE, _sent_invitation_cache
+    with _engine_lock:
+        if CACHED_ENGINE.engine is not None:
+            CACHED_ENGINE.engine.dispose()
+        CACHED_ENGINE = CachedEngine(None, None)
+        _sent_invitation_cache = CachedSet(None, set(), 0)
+
+
+@attr.s
+class DBStats:
+    calls = attr.ib(default=0)
+    # Time spent waiting for a free thread, and then actually talking to the
+    # database, in seconds
+    total_wait = attr.ib(default=0.0)
+    max_wait = attr.ib(default=0.0)
+    total_run = attr.ib(default=0.0)
+    max_run = attr.ib(default=0.0)
+
+
+DB_STATS = DBStats()
+
+# The same, broken down by function, for /metrics
+DB_WAIT_SECONDS = Histogram(
+    "snekomatic_db_wait_seconds",
+    "Time spent waiting for a database thread",
+    ["function"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "snekomatic_db_query_seconds",
+    "Time spent talking to the database",
+    ["function"],
+)
+
+_db_limiter = trio.CapacityLimiter(DB_POOL_SIZE)
+
+
+# psycopg2 is blocking, so we do all our database work in threads, to keep
+# the event loop responsive.
+def _in_db_thread(fn):
+    name = fn.__qualname__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        submitted = time.monotonic()
+        started = None
+
+        def run():
+            nonlocal started
+            started = time.monotonic()
+            return fn(*args, **kwargs)
+
+        with span("db", function=name) as db_span:
+            try:
+                return await trio.to_thread.run_sync(run, limiter=_db_limiter)
+            finally:
+                if started is not None:
+                    waited = started - submitted
+                    ran = time.monotonic() - started
+                    DB_STATS.calls += 1
+                    DB_STATS.total_wait += waited
+                    DB_STATS.max_wait = max(DB_STATS.max_wait, waited)
+                    DB_STATS.total_run += ran
+                    DB_STATS.max_run = max(DB_STATS.max_run, ran)
+                    DB_WAIT_SECONDS.observe(waited, function=name)
+                    DB_QUERY_SECONDS.observe(ran, function=name)
+                    db_span.set(wait=waited)
+
+    return wrapper
+
+
+@_in_db_thread
+def prepare_database():
+    """Connect to $DATABASE_URL, and migrate and check it if necessary.
+
+    If you don't call this, it happens automatically the first time the
+    database is used.
+    """
+    _get_engine()
+
+
+# The sent_invitation set only ever grows, and it's small, so we keep a copy
+# in memory and write through to it. A cached "yes" is always right. A
+# cached "no" might be stale if some other process added the entry, so once
+# the copy is older than this many seconds, a miss triggers a reload. (Even
+# a stale "no" is harmless: before inviting anyone, we double-check their
+# membership state with Github.)
+SENT_INVITATION_MAX_AGE = 300
+
+
+@attr.s
+class CachedSet:
+    engine = attr.ib()
+    entries = attr.ib()
+    loaded_at = attr.ib()
+
+
+_sent_invitation_cache = CachedSet(None, set(), 0)
+
+
+@_in_db_thread
+def _load_sent_invitations():
+    with get_conn() as conn:
+        rows = conn.execute(select([sent_invitation.c.entry]))
+        return CACHED_ENGINE.engine, {entry for (entry,) in rows}
 
 
 class SentInvitation:
     @staticmethod
-    def contains(name):
+    async def contains(name):
+        global _sent_invitation_cache
+        cache = _sent_invitation_cache
+        if cache.engine is not None and cache.engine is CACHED_ENGINE.engine:
+            if name in cache.entries:
+                return True
+            if time.monotonic() - cache.loaded_at < SENT_INVITATION_MAX_AGE:
+                return False
+        loaded_at = time.monotonic()
+        engine, entries = await _load_sent_invitations()
+        # Don't lose anything that add() put in while we were loading
+        if _sent_invitation_cache.engine is engine:
+            entries |= _sent_invitation_cache.entries
+        _sent_invitation_cache = CachedSet(engine, entries, loaded_at)
+        return name in entries
+
+    @staticmethod
+    async def add(name):
+        await SentInvitation._insert(name)
+        cache = _sent_invitation_cache
+        if cache.engine is not None and cache.engine is CACHED_ENGINE.engine:
+            cache.entries.add(name)
+
+    @staticmethod
+    @_in_db_thread
+    def _insert(name):
+        with get_conn() as conn:
+            # Another process might have beaten us to it, and that's fine.
+            conn.execute(
+                pg_insert(sent_invitation)
+                .values(entry=name)
+                .on_conflict_do_nothing()
+            )
+
+
+# How long a worker gets to finish a job before other workers assume it died
+# and take over. Workers renew it when they start each job, so it only has to
+# cover one job, but it has to be longer than DELIVERY_LEASE: a retry that
+# finds the dead worker's claim on the delivery still active would think the
+# delivery was already handled, and drop it.
+JOB_LEASE = datetime.timedelta(minutes=15)
+# After this many attempts, a job is dead-lettered instead of retried.
+JOB_MAX_ATTEMPTS = 5
+
+
+def _job_backoff(attempts):
+    # 30s, 1m, 2m, 4m, ..., capped at an hour
+    return datetime.timedelta(seconds=min(30 * 2 ** (attempts - 1), 3600))
+
+
+@attr.s(frozen=True)
+class Job:
+    id = attr.ib()
+    delivery_id = attr.ib()
+    event_type = attr.ib()
+    payload = attr.ib()
+    attempts = attr.ib()
+
+
+class WebhookJob:
+    @staticmethod
+    @_in_db_thread
+    def push(delivery_id, event_type, payload):
         with get_conn() as conn:
-            # This is:
-            #   SELECT EXISTS (SELECT 1 FROM sent_invitation WHERE entry = ?)
             return conn.execute(
-                select(
-                    [
-                        exists(
-                            select([1]).where(sent_invitation.c.entry == name)
-                        )
-                    ]
+                webhook_job.insert()
+                .values(
+                    delivery_id=delivery_id,
+                    event_type=event_type,
+                    payload=json.dumps(payload),
+                    attempts=0,
+                    run_at=func.now(),
+                    dead=False,
+                )
+                .returning(webhook_job.c.id)
+            ).scalar()
+
+    @staticmethod
+    @_in_db_thread
+    def claim(batch_size, lease=JOB_LEASE):
+        # This is:
+        #   UPDATE webhook_job SET attempts = attempts + 1,
+        #                          run_at = now() + lease
+        #   WHERE id IN (SELECT id FROM webhook_job
+        #                WHERE NOT dead AND run_at <= now()
+        #                ORDER BY id LIMIT batch_size
+        #                FOR UPDATE SKIP LOCKED)
+        #   RETURNING ...
+        #
+        # SKIP LOCKED means that concurrent claimers each get a disjoint set
+        # of rows, instead of blocking on each other or double-claiming.
+        claimable = (
+            select([webhook_job.c.id])
+            .where(~webhook_job.c.dead & (webhook_job.c.run_at <= func.now()))
+            .order_by(webhook_job.c.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        with get_conn() as conn:
+            with conn.begin():
+                rows = conn.execute(
+                    webhook_job.update()
+                    .where(webhook_job.c.id.in_(claimable))
+                    .values(
+                        attempts=webhook_job.c.attempts + 1,
+                        run_at=func.now() + lease,
+                    )
+                    .returning(
+                        webhook_job.c.id,
+                        webhook_job.c.delivery_id,
+                        webhook_job.c.event_type,
+                        webhook_job.c.payload,
+                        webhook_job.c.attempts,
+                    )
+                ).fetchall()
+        jobs = [
+            Job(
+                id=row.id,
+                delivery_id=row.delivery_id,
+                event_type=row.event_type,
+                payload=json.loads(row.payload),
+                attempts=row.attempts,
+            )
+            for row in rows
+        ]
+        jobs.sort(key=lambda job: job.id)
+        return jobs
+
+    @staticmethod
+    @_in_db_thread
+    def renew(job, lease=JOB_LEASE):
+        """Extend our lease on 'job'; returns False if we've lost it."""
+        with get_conn() as conn:
+            result = conn.execute(
+                webhook_job.update()
+                .where(
+                    (webhook_job.c.id == job.id)
+                    # If someone else claimed it, they bumped this
+                    & (webhook_job.c.attempts == job.attempts)
+                    & ~webhook_job.c.dead
+                )
+                .values(run_at=func.now() + lease)
+            )
+        return result.rowcount == 1
+
+    @staticmethod
+    @_in_db_thread
+    def complete(job):
+        with get_conn() as conn:
+            conn.execute(
+                webhook_job.delete().where(webhook_job.c.id == job.id)
+            )
+
+    @staticmethod
+    @_in_db_thread
+    def fail(job, error, *, max_attempts=JOB_MAX_ATTEMPTS):
+        """Record a failed attempt; returns True if the job is now dead."""
+        dead = job.attempts >= max_attempts
+        with get_conn() as conn:
+            conn.execute(
+                webhook_job.update()
+                .where(webhook_job.c.id == job.id)
+                .values(
+                    dead=dead,
+                    last_error=error,
+                    run_at=func.now() + _job_backoff(job.attempts),
+                )
+            )
+        return dead
+
+    @staticmethod
+    @_in_db_thread
+    def counts():
+        with get_conn() as conn:
+            rows = conn.execute(
+                select([webhook_job.c.dead, func.count()]).group_by(
+                    webhook_job.c.dead
+                )
+            ).fetchall()
+        counts = {"pending": 0, "dead": 0}
+        for dead, count in rows:
+            counts["dead" if dead else "pending"] = count
+        return counts
+
+
+@_in_db_thread
+def _get_installation_token(installation_id):
+    with get_conn() as conn:
+        return conn.execute(
+            select(
+                [
+                    installation_token.c.encrypted_token,
+                    installation_token.c.expires_at,
+                ]
+            ).where(installation_token.c.installation_id == installation_id)
+        ).first()
+
+
+@_in_db_thread
+def _put_installation_token(installation_id, encrypted_token, expires_at):
+    insert = pg_insert(installation_token).values(
+        installation_id=installation_id,
+        encrypted_token=encrypted_token,
+        expires_at=expires_at,
+    )
+    with get_conn() as conn:
+        conn.execute(
+            insert.on_conflict_do_update(
+                index_elements=[installation_token.c.installation_id],
+                set_={
+                    "encrypted_token": insert.excluded.encrypted_token,
+                    "expires_at": insert.excluded.expires_at,
+                },
+            )
+        )
+
+
+# Advisory locks belong to a database session, so the lock functions all
+# operate on a connection that's kept open for as long as the lock is held.
+@_in_db_thread
+def _open_conn():
+    return get_conn()
+
+
+@_in_db_thread
+def _release_conn(conn):
+    # Returning a connection to the pool doesn't end its session, so make
+    # sure we don't leave any locks behind.
+    try:
+        conn.execute(select([func.pg_advisory_unlock_all()]))
+    finally:
+        conn.close()
+
+
+@_in_db_thread
+def _try_advisory_lock(conn, name):
+    return conn.execute(
+        select([func.pg_try_advisory_lock(func.hashtext(name))])
+    ).scalar()
+
+
+class InstallationTokenStore:
+    """Lets several processes share installation tokens (see gh.py).
+
+    'key' is a Fernet key, as generated by
+    cryptography.fernet.Fernet.generate_key().
+    """
+
+    def __init__(self, key, *, lock_timeout=10):
+        self._fernet = Fernet(key)
+        self._lock_timeout = lock_timeout
+
+    async def get(self, installation_id):
+        row = await _get_installation_token(str(installation_id))
+        if row is None:
+            return None
+        encrypted_token, expires_at = row
+        try:
+            token = self._fernet.decrypt(encrypted_token.encode("ascii"))
+        except InvalidToken:
+            # Probably the key was rotated; pretend it's not there
+            return None
+        return token.decode("ascii"), pendulum.instance(expires_at)
+
+    async def put(self, installation_id, token, expires_at):
+        encrypted_token = self._fernet.encrypt(token.encode("ascii"))
+        await _put_installation_token(
+            str(installation_id),
+            encrypted_token.decode("ascii"),
+            datetime.datetime.fromtimestamp(
+                expires_at.timestamp(), tz=datetime.timezone.utc
+            ),
+        )
+
+    @asynccontextmanager
+    async def renewal_lock(self, installation_id):
+        name = f"snekomatic installation token {installation_id}"
+        conn = await _open_conn()
+        try:
+            locked = False
+            # Poll rather than blocking in pg_advisory_lock, so that we
+            # don't tie up a database thread while we wait.
+            with trio.move_on_after(self._lock_timeout):
+                while not await _try_advisory_lock(conn, name):
+                    await trio.sleep(0.1)
+                locked = True
+            yield locked
+        finally:
+            await _release_conn(conn)
+
+
+# Github only lets you redeliver webhooks from the last few days, so there's
+# no point remembering deliveries for longer than this.
+DELIVERY_TTL = datetime.timedelta(days=7)
+# Longer than GithubApp's default route timeout
+DELIVERY_LEASE = datetime.timedelta(minutes=10)
+
+
+@_in_db_thread
+def _claim_delivery(delivery_id, lease):
+    # This is:
+    #   INSERT INTO webhook_delivery VALUES (delivery_id, now(), false)
+    #   ON CONFLICT (delivery_id) DO UPDATE SET claimed_at = now()
+    #     WHERE NOT webhook_delivery.done
+    #       AND webhook_delivery.claimed_at < now() - lease
+    #   RETURNING delivery_id
+    #
+    # Postgres makes concurrent inserts of the same delivery wait for each
+    # other, so exactly one of them gets a row back.
+    insert = pg_insert(webhook_delivery).values(
+        delivery_id=delivery_id, claimed_at=func.now(), done=False
+    )
+    with get_conn() as conn:
+        row = conn.execute(
+            insert.on_conflict_do_update(
+                index_elements=[webhook_delivery.c.delivery_id],
+                set_={"claimed_at": func.now()},
+                where=~webhook_delivery.c.done
+                & (webhook_delivery.c.claimed_at < func.now() - lease),
+            ).returning(webhook_delivery.c.delivery_id)
+        ).first()
+    return row is not None
+
+
+@_in_db_thread
+def _complete_delivery(delivery_id):
+    with get_conn() as conn:
+        conn.execute(
+            webhook_delivery.update()
+            .where(webhook_delivery.c.delivery_id == delivery_id)
+            .values(done=True)
+        )
+
+
+@_in_db_thread
+def _release_delivery(delivery_id):
+    with get_conn() as conn:
+        conn.execute(
+            webhook_delivery.delete().where(
+                (webhook_delivery.c.delivery_id == delivery_id)
+                & ~webhook_delivery.c.done
+            )
+        )
+
+
+@_in_db_thread
+def _prune_deliveries(ttl):
+    with get_conn() as conn:
+        conn.execute(
+            webhook_delivery.delete().where(
+                webhook_delivery.c.claimed_at < func.now() - ttl
+            )
+        )
+
+
+class WebhookDeliveryStore:
+    """Remembers which webhook deliveries have been handled (see gh.py), so
+    redeliveries don't run the handlers again, even in another process.
+    """
+
+    def __init__(
+        self, *, lease=DELIVERY_LEASE, ttl=DELIVERY_TTL, prune_interval=3600
+    ):
+        self._lease = lease
+        self._ttl = ttl
+        self._prune_interval = prune_interval
+        self._next_prune = 0.0
+
+    async def claim(self, delivery_id):
+        # Old deliveries get cleaned up as a side-effect of new ones arriving
+        if time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + self._prune_interval
+            await _prune_deliveries(self._ttl)
+        return await _claim_delivery(delivery_id, self._lease)
+
+    async def complete(self, delivery_id):
+        await _complete_delivery(delivery_id)
+
+    async def release(self, delivery_id):
+        await _release_delivery(delivery_id)
+
+
+class OrgMembers:
+    """A local mirror of org memberships and pending invitations.
+
+    It's refreshed from the Github API every so often by replace(), and kept
+    up to date in between by set_state() calls from webhook handlers.
+    """
+
+    @staticmethod
+    @_in_db_thread
+    def state(org, login, *, max_age):
+        """Returns (fresh, state).
+
+        'state' is "active", "pending", or None for neither. 'fresh' is False
+        if we haven't synced the org in the last 'max_age', in which case you
+        shouldn't trust 'state'.
+        """
+        with get_conn() as conn:
+            fresh = conn.execute(
+                select([func.count()]).where(
+                    (org_member_sync.c.org == org)
+                    & (org_member_sync.c.synced_at > func.now() - max_age)
                 )
             ).scalar()
+            state = conn.execute(
+                select([org_member.c.state]).where(
+                    (org_member.c.org == org)
+                    & (org_member.c.login == login.lower())
+                )
+            ).scalar()
+        return bool(fresh), state
 
     @staticmethod
-    def add(name):
+    @_in_db_thread
+    def replace(org, states):
+        """Replace everything we know about 'org' with 'states'.
+
+        'states' maps logins to "active" or "pending".
+        """
+        rows = [
+            {"org": org, "login": login.lower(), "state": state}
+            for login, state in states.items()
+        ]
+        insert = pg_insert(org_member_sync).values(
+            org=org, synced_at=func.now()
+        )
         with get_conn() as conn:
-            conn.execute(sent_invitation.insert(), entry=name)
+            with conn.begin():
+                conn.execute(
+                    org_member.delete().where(org_member.c.org == org)
+                )
+                if rows:
+                    conn.execute(org_member.insert(), rows)
+                conn.execute(
+                    insert.on_conflict_do_update(
+                        index_elements=[org_member_sync.c.org],
+                        set_={"synced_at": insert.excluded.synced_at},
+                    )
+                )
+
+    @staticmethod
+    @_in_db_thread
+    def set_state(org, login, state):
+        """Record a single change; 'state' can be None to remove someone."""
+        login = login.lower()
+        with get_conn() as conn:
+            if state is None:
+                conn.execute(
+                    org_member.delete().where(
+                        (org_member.c.org == org)
+                        & (org_member.c.login == login)
+                    )
+                )
+                return
+            insert = pg_insert(org_member).values(
+                org=org, login=login, state=state
+            )
+            conn.execute(
+                insert.on_conflict_do_update(
+                    index_elements=[org_member.c.org, org_member.c.login],
+                    set_={"state": insert.excluded.state},
+                )
+            )
@@ -12,6 +12,18 @@ Basic setup:
       # 'gh_client' is a gidgethub-style github API client that automatically
       # uses the right credentials for this webhook event.
 
+Routes can be restricted on several fields at once, including nested ones,
+and a callable is treated as a predicate on the field's value:
+
+  @gh_app.route(
+      "pull_request",
+      action="opened",
+      where={
+          "repository.full_name": "python-trio/trio",
+          "pull_request.user.login": lambda login: login != "dependabot",
+      },
+  )
+
 Integrate into webapp:
 
   @quart_app.route("/webhook/github", methods=["POST"])
@@ -21,16 +33,69 @@ Integrate into webapp:
       await gh_app.dispatch_webhook(headers, body)
       return ""
 
+dispatch_webhook doesn't return until all the handlers have finished. If you
+would rather acknowledge the webhook immediately, start some background
+workers and use enqueue_webhook instead:
+
+  nursery.start_soon(gh_app.run_webhook_workers, 4)
+
+  ...
+      await gh_app.enqueue_webhook(headers, body)
+      return "", 202
+
+Or, if you want to put events somewhere more durable, validate them with
+'gh_app.parse_webhook(headers, body)' and later hand the resulting
+gidgethub Event to 'await gh_app.process_event(event)'. The payload isn't
+decoded until something needs it, and 'gh_app.might_route(event)' can
+usually tell you without decoding it whether process_event would do anything
+with the event, so you can skip storing it. 'await gh_app.decode_event(event)'
+decodes it in a worker thread if it's big.
+
+CPU-heavy work -- decoding big payloads, parsing big comments for commands,
+signing app tokens -- happens in worker threads, so it doesn't hold up other
+webhooks. Pass 'cpu_threads=...' to limit how many threads it can use at
+once (see CpuOffloader).
+
 If you want to make API requests spontaneously, not in response to a
 webhook, then use one of these:
 
   client = gh_app.app_client
   client = gh_app.client_for(installation_id)
 
+Besides gidgethub's usual methods, clients can run GraphQL queries with
+'await client.graphql(query, variables)'. For small lookups that lots of
+handlers do at once, see GraphQLLookup: they get batched into a single query.
+
 You can also get an installation token with 'await gh_app.token_for(...)',
 which is useful in case you want to run git commands directly using those
 credentials.
 
+If you're running several processes, they can share installation tokens
+instead of each getting their own, by passing 'token_store=...' to GithubApp.
+A token store needs these methods:
+
+  async def get(installation_id) -> (token, expires_at) or None
+  async def put(installation_id, token, expires_at)
+  # Async context manager; waits a while to take a lock shared across
+  # processes, and then yields True if it got it or False if it gave up
+  def renewal_lock(installation_id)
+
+If the store fails, we fall back to keeping tokens in memory.
+
+Github sometimes delivers the same webhook twice, and people can hit
+"Redeliver" in the UI. process_event ignores deliveries that this process has
+already handled (or is handling). To catch duplicates that go to different
+processes, pass 'delivery_store=...', which needs these methods:
+
+  # Returns True if nobody else has handled or is handling this delivery
+  async def claim(delivery_id) -> bool
+  # The handlers finished successfully
+  async def complete(delivery_id)
+  # The handlers failed, so a redelivery should run them again
+  async def release(delivery_id)
+
+If the store fails, we go ahead and process the delivery.
+
 This should probably be split off into its own library eventually...
 
 Some notes on how this compares to octomachinery, which has overlapping goals:
@@ -56,13 +121,25 @@ here.
 """
 
 from collections import defaultdict
+import hashlib
+import hmac
+import http
+import itertools
+import json
 import os
+import random
+import re
+import threading
+import urllib.parse
+import time
 from typing import Mapping, Tuple
 
 import anyio
 import asks
 import attr
 import cachetools
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 from gidgethub.sansio import Event, accept_format
 import gidgethub.abc
 from glom import glom
@@ -71,11 +148,23 @@ import pendulum
 import marko
 from marko.ext.gfm import gfm
 
-__all__ = ["GithubApp"]
+from .metrics import CallbackCollector, Counter, Gauge, Histogram, Registry
+from .log import bind, log
+from .tracing import span, start_trace
+
+# Much faster at decoding big webhook payloads, if it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# XX TODO: should we catch exceptions in webhook handlers, the same way flask
-# etc. catch exceptions in request handlers? right now the first exception
-# leaks out of dispatch_webhook and cancels the running of other handlers
+__all__ = [
+    "GithubApp",
+    "GraphQLLookup",
+    "GraphQLError",
+    "WebhookQueueFull",
+    "WebhookHandlerError",
+]
 
 # XX octomachinery's preview_version= argument is pretty handy, should we
 # adopt it? maybe push upstream to gidgethub?
@@ -89,6 +178,10 @@ __all__ = ["GithubApp"]
 MAX_CLOCK_SKEW = pendulum.Duration(minutes=1)
 
 
+# Github refuses app tokens that expire more than this far in the future
+MAX_APP_TOKEN_LIFETIME = pendulum.Duration(minutes=10)
+
+
 def _too_close_for_comfort(expires_at):
     return pendulum.now() + MAX_CLOCK_SKEW > expires_at
 
@@ -110,17 +203,359 @@ def _lazy_env_fallback(name):
     return property(getter)
 
 
-def _all_match(data, restrictions):
-    for key, value in restrictions.items():
-        if key not in data or data[key] != value:
-            return False
-    return True
+class AsksTransport:
+    """The default HTTP transport, using asks.
+
+    Connections are kept alive and reused. Each host gets its own pool of at
+    most 'connections_per_host' connections, unless you pass in a specific
+    asks.Session to use for everything.
+
+    A transport is anything with an async method:
+
+      request(method, url, headers, body) -> (status_code, headers, body)
+
+    where the returned header names are lowercase. So if you want to use some
+    other HTTP client, or a fake Github for testing, then you can pass one of
+    those to GithubApp or BaseGithubClient instead.
+    """
+
+    def __init__(self, session=None, *, connections_per_host=100):
+        self._session = session
+        self._connections_per_host = connections_per_host
+        # (scheme, netloc) -> asks.Session
+        self._sessions = {}
+
+    def _session_for(self, url):
+        if self._session is not None:
+            return self._session
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        session = self._sessions.get(key)
+        if session is None:
+            session = asks.Session(connections=self._connections_per_host)
+            self._sessions[key] = session
+        return session
+
+    async def request(self, method, url, headers, body):
+        response = await self._session_for(url).request(
+            method, url, headers=headers, data=body
+        )
+        # asks gets its headers from h11, which always lowercases names, so
+        # we can pass them straight through.
+        if response.status_code == 304:
+            # Don't even try to read the body of a 304 (see
+            # https://github.com/theelous3/asks/issues/133).
+            return response.status_code, response.headers, b""
+        return response.status_code, response.headers, response.content
+
+
+def _as_transport(session):
+    if session is None:
+        return AsksTransport()
+    if isinstance(session, asks.Session):
+        return AsksTransport(session)
+    return session
+
+
+@attr.s
+class RateLimitBudget:
+    # These come from the x-ratelimit-* headers on the most recent response,
+    # minus any requests we've sent since then
+    limit = attr.ib(default=None)
+    remaining = attr.ib(default=None)
+    # Unix timestamp when 'remaining' goes back up to 'limit'
+    reset_at = attr.ib(default=0.0)
+    # Unix timestamp before which we shouldn't send anything at all, because
+    # Github told us to back off (e.g. a secondary rate limit)
+    blocked_until = attr.ib(default=0.0)
+
+
+class RateLimitScheduler:
+    """Tracks Github's rate limits, and delays requests to stay under them.
+
+    Each key (e.g. an installation id) gets its own budget. Low priority
+    requests start getting held back once the remaining budget drops below
+    'low_priority_reserve' (as a fraction of the limit), so that there's
+    something left for more important things. Normal requests are only held
+    back once the budget is completely gone. Either way they wait until the
+    budget resets, instead of failing.
+
+    If Github tells us to back off with Retry-After, we wait and then retry,
+    up to 'max_retries' times, as long as it's not asking us to wait more
+    than 'max_retry_after' seconds.
+    """
+
+    def __init__(
+        self, *, low_priority_reserve=0.2, max_retries=2, max_retry_after=120
+    ):
+        self.budgets = defaultdict(RateLimitBudget)
+        self._low_priority_reserve = low_priority_reserve
+        self._max_retries = max_retries
+        self._max_retry_after = max_retry_after
+
+    def _delay(self, budget, priority):
+        now = time.time()
+        delay = budget.blocked_until - now
+        if budget.remaining is not None and now < budget.reset_at:
+            if budget.remaining <= 0:
+                exhausted = True
+            elif priority == "low":
+                reserve = self._low_priority_reserve * budget.limit
+                exhausted = budget.remaining < reserve
+            else:
+                exhausted = False
+            if exhausted:
+                delay = max(delay, budget.reset_at - now)
+        return delay
+
+    def _update(self, budget, status_code, headers):
+        if "x-ratelimit-remaining" in headers:
+            budget.limit = int(headers["x-ratelimit-limit"])
+            budget.remaining = int(headers["x-ratelimit-remaining"])
+            budget.reset_at = float(headers["x-ratelimit-reset"])
+        if status_code in (403, 429) and "retry-after" in headers:
+            retry_after = float(headers["retry-after"])
+            budget.blocked_until = max(
+                budget.blocked_until, time.time() + retry_after
+            )
+            return retry_after
+        if status_code == 403 and budget.remaining == 0:
+            return max(budget.reset_at - time.time(), 0)
+        return None
+
+    async def request(self, key, priority, send):
+        """Call 'await send()' when the budget for 'key' allows it."""
+        budget = self.budgets[key]
+        for attempt in range(self._max_retries + 1):
+            delay = self._delay(budget, priority)
+            if delay > 0:
+                log(
+                    "Rate limit: holding request",
+                    key=key,
+                    priority=priority,
+                    delay=f"{delay:.1f}s",
+                )
+                with span("rate_limit_wait", key=str(key), delay=delay):
+                    await anyio.sleep(delay)
+            if budget.remaining is not None:
+                budget.remaining -= 1
+            response = await send()
+            retry_after = self._update(budget, response[0], response[1])
+            if retry_after is None or retry_after > self._max_retry_after:
+                break
+        return response
+
+
+class GraphQLError(Exception):
+    """Github reported errors for a GraphQL query.
+
+    'errors' is the list of errors from the response, and 'data' is whatever
+    partial data came back with them.
+    """
+
+    def __init__(self, errors, data=None):
+        super().__init__(
+            "; ".join(error.get("message", repr(error)) for error in errors)
+        )
+        self.errors = errors
+        self.data = data
+
+
+_GRAPHQL_VARIABLE_RE = re.compile(r"\$(\w+)")
+
+
+class GraphQLLookup:
+    """A single top-level GraphQL field, which can be batched with others.
+
+    'selection' is the field with its arguments and sub-selections, using
+    $variables for anything that changes between lookups; the keyword
+    arguments give the variables' GraphQL types. For example:
+
+      USER_INFO = GraphQLLookup(
+          "user(login: $login) { name company }", login="String!"
+      )
+      info = await gh_client.graphql_lookup(USER_INFO, {"login": "njsmith"})
+    """
+
+    def __init__(self, selection, **variable_types):
+        undeclared = set(_GRAPHQL_VARIABLE_RE.findall(selection))
+        undeclared -= set(variable_types)
+        if undeclared:
+            raise ValueError(f"no types given for {sorted(undeclared)}")
+        self.selection = selection
+        self.variable_types = variable_types
+
+    def aliased(self, alias, variables):
+        """Returns (selection, declarations, variables) for use in a query
+        alongside other lookups, with everything renamed for 'alias'."""
+        selection = _GRAPHQL_VARIABLE_RE.sub(
+            lambda match: f"${match.group(1)}__{alias}", self.selection
+        )
+        declarations = [
+            f"${name}__{alias}: {type_}"
+            for name, type_ in self.variable_types.items()
+        ]
+        variables = {
+            f"{name}__{alias}": value for name, value in variables.items()
+        }
+        return f"{alias}: {selection}", declarations, variables
+
+
+@attr.s
+class GraphQLBatchStats:
+    # Lookups requested, and the queries it took to answer them
+    lookups = attr.ib(default=0)
+    queries = attr.ib(default=0)
+
+
+class _GraphQLBatch:
+    def __init__(self):
+        # [(GraphQLLookup, variables), ...]
+        self.lookups = []
+        self.full = anyio.create_event()
+        self.done = anyio.create_event()
+        self.response = None
+        self.exception = None
+        self.abandoned = False
+
+    def result(self, alias):
+        if self.exception is not None:
+            raise self.exception
+        data = self.response.get("data") or {}
+        errors = [
+            error
+            for error in self.response.get("errors") or []
+            # Errors without a path are about the whole query
+            if not error.get("path") or error["path"][0] == alias
+        ]
+        if errors:
+            raise GraphQLError(errors, data.get(alias))
+        return data[alias]
+
+
+class GraphQLBatcher:
+    """Combines GraphQL lookups made at about the same time into one query.
+
+    This saves both round trips and rate limit points when lots of handlers
+    are running at once. There's no background task: the first lookup in
+    each batch waits up to 'window' seconds for others to join, and then
+    sends the query on everyone's behalf.
+    """
+
+    def __init__(self, *, window=0.01, max_size=50):
+        self._window = window
+        self._max_size = max_size
+        # The batch that new lookups should join, if any
+        self._batch = None
+        self.stats = GraphQLBatchStats()
+
+    async def lookup(self, client, lookup, variables):
+        self.stats.lookups += 1
+        while True:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                # anyio needs to know which async library we're using before
+                # it can make events, so this can't happen any earlier
+                batch = self._batch = _GraphQLBatch()
+            alias = f"q{len(batch.lookups)}"
+            batch.lookups.append((lookup, variables))
+            if len(batch.lookups) >= self._max_size:
+                self._batch = None
+                await batch.full.set()
+            if leader:
+                await self._send(client, batch)
+            else:
+                await batch.done.wait()
+            if batch.abandoned:
+                # The leader was cancelled before it got an answer; try again
+                # in a new batch
+                continue
+            return batch.result(alias)
+
+    async def _send(self, client, batch):
+        try:
+            async with anyio.move_on_after(self._window):
+                await batch.full.wait()
+            if self._batch is batch:
+                self._batch = None
+            selections = []
+            declarations = []
+            variables = {}
+            for i, (lookup, lookup_variables) in enumerate(batch.lookups):
+                selection, more_declarations, more_variables = lookup.aliased(
+                    f"q{i}", lookup_variables
+                )
+                selections.append(selection)
+                declarations += more_declarations
+                variables.update(more_variables)
+            query = "query"
+            if declarations:
+                query += "(" + ", ".join(declarations) + ")"
+            query += " { " + " ".join(selections) + " }"
+            self.stats.queries += 1
+            try:
+                batch.response = await client.post(
+                    "/graphql", data={"query": query, "variables": variables}
+                )
+            except Exception as exc:
+                batch.exception = exc
+        except BaseException:
+            batch.abandoned = True
+            if self._batch is batch:
+                self._batch = None
+            raise
+        finally:
+            async with anyio.open_cancel_scope(shield=True):
+                await batch.done.set()
+
+
+_ENDPOINT_PATTERNS = [
+    (re.compile(r"^/repos/[^/]+/[^/]+"), "/repos/{owner}/{repo}"),
+    (re.compile(r"^/(orgs|users)/[^/]+"), r"/\1/{name}"),
+    (re.compile(r"/memberships/[^/]+$"), "/memberships/{username}"),
+    (re.compile(r"/\d+(?=/|$)"), "/{id}"),
+]
+
+
+def _endpoint_name(url):
+    # "https://api.github.com/repos/python-trio/trio/issues/5/comments" ->
+    # "/repos/{owner}/{repo}/issues/{id}/comments", so metrics don't get a
+    # new label for every issue.
+    path = urllib.parse.urlsplit(url).path
+    for pattern, replacement in _ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path
 
 
 # This should maybe move into gidgethub
 class BaseGithubClient(gidgethub.abc.GitHubAPI):
-    def __init__(self, session, *args, **kwargs):
-        self._session = session
+    def __init__(
+        self,
+        session,
+        *args,
+        scheduler=None,
+        rate_limit_key=None,
+        priority="normal",
+        graphql_batcher=None,
+        request_seconds=None,
+        **kwargs,
+    ):
+        # 'session' can be an asks.Session, or any transport (see
+        # AsksTransport)
+        self._transport = _as_transport(session)
+        # If given, a Histogram with "endpoint" and "status" labels
+        self._request_seconds = request_seconds
+        # Clients that share a batcher can have their lookups combined
+        if graphql_batcher is None:
+            graphql_batcher = GraphQLBatcher()
+        self._graphql_batcher = graphql_batcher
+        if scheduler is None:
+            scheduler = RateLimitScheduler()
+        self._scheduler = scheduler
+        self._rate_limit_key = rate_limit_key
+        # "normal" or "low"
+        self._priority = priority
         super().__init__(*args, **kwargs)
 
     async def _request(
@@ -130,68 +565,156 @@ class BaseGithubClient(gidgethub.abc.GitHubAPI):
         headers: Mapping[str, str],
         body: bytes = b"",
     ) -> Tuple[int, Mapping[str, str], bytes]:
-        response = await self._session.request(
-            method, url, headers=headers, data=body
-        )
-        # asks stores headers in a regular dict. They're probably lowercase
-        # already, but let's be 100% certain.
-        lower_headers = {
-            key.lower(): value for (key, value) in response.headers.items()
-        }
-        return response.status_code, lower_headers, response.content
+        async def send():
+            endpoint = _endpoint_name(url)
+            start = time.monotonic()
+            # If we never get a response
+            status = "error"
+            with span(
+                "github_request", method=method, endpoint=endpoint
+            ) as request_span:
+                try:
+                    response = await self._transport.request(
+                        method, url, headers, body
+                    )
+                    status = str(response[0])
+                    return response
+                finally:
+                    request_span.set(status=status)
+                    if self._request_seconds is not None:
+                        self._request_seconds.observe(
+                            time.monotonic() - start,
+                            endpoint=endpoint,
+                            status=status,
+                        )
+
+        key = self._rate_limit_key
+        if urllib.parse.urlsplit(url).path == "/graphql":
+            # GraphQL has a separate rate limit, counted in points
+            key = (key, "graphql")
+        response = await self._scheduler.request(key, self._priority, send)
+        if hasattr(self._cache, "next_entry_size"):
+            # gidgethub might cache the decoded body as soon as we return
+            self._cache.next_entry_size = len(response[2])
+        if response[0] == 304:
+            # Not modified, so gidgethub will use its cached copy
+            stats = getattr(self._cache, "stats", None)
+            if stats is not None:
+                stats.not_modified += 1
+        return response
 
     # Why does gidgethub make this mandatory? it's not used for anything
     async def sleep(self, seconds):
         await anyio.sleep(seconds)
 
+    async def graphql(self, query, variables=None):
+        """Run a GraphQL query, and return the "data" part of the response.
+
+        'variables' is a dict, so that a variable can be called e.g. "query"
+        without clashing with our arguments. Raises GraphQLError if Github
+        reports any errors.
+        """
+        if variables is None:
+            variables = {}
+        response = await self.post(
+            "/graphql", data={"query": query, "variables": variables}
+        )
+        if response.get("errors"):
+            raise GraphQLError(response["errors"], response.get("data"))
+        return response["data"]
+
+    async def graphql_lookup(self, lookup, variables):
+        """Look up a GraphQLLookup's field, batched with any other lookups
+        that happen around the same time. 'variables' is a dict, like for
+        graphql().
+        """
+        return await self._graphql_batcher.lookup(self, lookup, variables)
+
 
+@attr.s
+class CacheStats:
+    # Requests where we had a cached copy to revalidate
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    # Revalidations where Github said our copy was still good. These don't
+    # count against the rate limit.
+    not_modified = attr.ib(default=0)
+
+
+def _cache_entry_size(item):
+    # Items are (size, entry) pairs; see SegmentedCacheOverlay
+    return item[0]
+
+
+# gidgethub's cache is keyed by URL, but different installations can see
+# different things at the same URL, so each installation gets its own
+# segment of our shared cache.
+#
+# Entries are gidgethub's (etag, last_modified, data, more) tuples. Measuring
+# those is slow, so we go by the size of the raw response body instead:
+# BaseGithubClient._request sets next_entry_size just before gidgethub
+# stores the decoded response.
 @attr.s
 class SegmentedCacheOverlay:
     _underlying = attr.ib()
     _segment = attr.ib()
+    stats = attr.ib()
+    next_entry_size = attr.ib(default=0)
 
     def __getitem__(self, key):
-        return self._underlying[self._segment, key]
+        try:
+            _, value = self._underlying[self._segment, key]
+        except KeyError:
+            self.stats.misses += 1
+            raise
+        self.stats.hits += 1
+        return value
 
     def __setitem__(self, key, value):
-        self._underlying[self._segment, key] = value
+        size, self.next_entry_size = self.next_entry_size, 0
+        try:
+            self._underlying[self._segment, key] = (size, value)
+        except ValueError:
+            # Too big to cache at all
+            pass
 
 
 class AppGithubClient(BaseGithubClient):
     def __init__(self, app):
         self.app = app
-        # Temporarily disabled because of:
-        #   https://github.com/theelous3/asks/issues/133
-        # cache = SegmentedCacheOverlay(app._cache, None)
-        cache = None
-        super().__init__(app._session, requester=app.user_agent, cache=cache)
+        cache = SegmentedCacheOverlay(app._cache, None, app.cache_stats)
+        super().__init__(
+            app._transport,
+            requester=app.user_agent,
+            cache=cache,
+            scheduler=app.rate_limits,
+            rate_limit_key="app",
+            request_seconds=app.github_request_seconds,
+        )
 
     async def _make_request(self, *args, **kwargs):
-        now = pendulum.now()
-        jwt_app_token = jwt.encode(
-            {
-                "iat": (now - MAX_CLOCK_SKEW).int_timestamp,
-                "exp": (now + MAX_CLOCK_SKEW).int_timestamp,
-                "iss": self.app.app_id,
-            },
-            key=self.app.private_key,
-            algorithm="RS256",
-        )
-        jwt_app_token = jwt_app_token.decode("ascii")
         kwargs["oauth_token"] = None
-        kwargs["jwt"] = jwt_app_token
+        kwargs["jwt"] = await self.app._app_jwt_offloaded()
         return await super()._make_request(*args, **kwargs)
 
 
 class InstallationGithubClient(BaseGithubClient):
-    def __init__(self, app, installation_id):
+    def __init__(self, app, installation_id, priority="normal"):
         self.app = app
         self.installation_id = installation_id
-        # Temporarily disabled because of:
-        #   https://github.com/theelous3/asks/issues/133
-        # cache = SegmentedCacheOverlay(app._cache, installation_id)
-        cache = None
-        super().__init__(app._session, requester=app.user_agent, cache=cache)
+        cache = SegmentedCacheOverlay(
+            app._cache, installation_id, app.cache_stats
+        )
+        super().__init__(
+            app._transport,
+            requester=app.user_agent,
+            cache=cache,
+            scheduler=app.rate_limits,
+            rate_limit_key=installation_id,
+            priority=priority,
+            graphql_batcher=app._graphql_batchers[installation_id],
+            request_seconds=app.github_request_seconds,
+        )
 
     async def _make_request(self, *args, **kwargs):
         token = await self.app.token_for(self.installation_id)
@@ -200,6 +723,13 @@ class InstallationGithubClient(BaseGithubClient):
         return await super()._make_request(*args, **kwargs)
 
 
+@attr.s
+class CachedAppToken:
+    token = attr.ib(default="")
+    # pendulum.DateTime
+    expires_at = attr.ib(default=pendulum.datetime(1900, 1, 1))
+
+
 @attr.s
 class CachedInstallationToken:
     token = attr.ib(default="")
@@ -208,12 +738,323 @@ class CachedInstallationToken:
     # if a refresh is already in progress, an anyio.Event
     # otherwise, None
     refresh_event = attr.ib(default=None)
+    # time.monotonic() when token_for was last called
+    last_used = attr.ib(default=0.0)
+
+
+class WebhookQueueFull(Exception):
+    """Raised by enqueue_webhook when the workers are too far behind."""
+
+
+@attr.s
+class WebhookQueueStats:
+    # Events that have been accepted, but not yet picked up by a worker
+    depth = attr.ib(default=0)
+    enqueued = attr.ib(default=0)
+    processed = attr.ib(default=0)
+    failed = attr.ib(default=0)
+    # How long events sat in the queue before a worker got to them, in
+    # seconds
+    total_wait = attr.ib(default=0.0)
+    max_wait = attr.ib(default=0.0)
+
+
+class WebhookHandlerError(Exception):
+    """Raised by process_event if any handlers failed.
+
+    Each handler's exception has already been printed and passed to
+    GithubApp.error_handler by the time this is raised; they're also
+    available as the 'errors' attribute.
+    """
+
+    def __init__(self, errors):
+        super().__init__(
+            f"{len(errors)} webhook handler(s) failed: "
+            + ", ".join(repr(error) for error in errors)
+        )
+        self.errors = errors
 
 
 @attr.s(frozen=True)
 class Route:
     async_fn = attr.ib()
     restrictions = attr.ib()
+    # Seconds; None means use the GithubApp's default
+    timeout = attr.ib(default=None)
+    # How many copies of this handler can run at once; None means no limit
+    max_concurrency = attr.ib(default=None)
+
+
+@attr.s
+class RouteStats:
+    calls = attr.ib(default=0)
+    failures = attr.ib(default=0)
+    # Seconds, including time spent waiting for max_concurrency
+    total_time = attr.ib(default=0.0)
+    max_time = attr.ib(default=0.0)
+
+
+# Marks a field that's missing from the payload, or an index slot that the
+# route doesn't care about.
+_MISSING = object()
+_ANY = object()
+
+# Payload fields that RouteIndex can look up directly, because lots of routes
+# restrict on them. Any other restrictions are checked one at a time.
+_INDEXED_PATHS = ("action", "repository.full_name", "sender.type")
+
+
+def _restriction_matches(data, path, expected):
+    value = glom(data, path, default=_MISSING)
+    if value is _MISSING:
+        return False
+    if callable(expected):
+        return bool(expected(value))
+    return value == expected
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class RouteIndex:
+    """All the routes for one event type.
+
+    Routes are bucketed by the values they require for _INDEXED_PATHS, so
+    finding the matching routes costs a few dict lookups plus checking the
+    leftover restrictions on the candidates, instead of checking every
+    restriction on every route.
+    """
+
+    def __init__(self):
+        self._count = 0
+        # (action, repo, sender type), with _ANY for wildcards
+        #   -> [(registration order, route, leftover restrictions)]
+        self._buckets = defaultdict(list)
+        # action (or _ANY) -> how many routes require it
+        self._actions = defaultdict(int)
+
+    def __len__(self):
+        return self._count
+
+    def might_match(self, action=_ANY):
+        """Whether any route could match a payload with this action.
+
+        Pass _MISSING if the payload has no action, or leave it out if you
+        don't know.
+        """
+        if action is _ANY or not _hashable(action):
+            return self._count > 0
+        return bool(self._actions[_ANY] or self._actions.get(action))
+
+    def add(self, route):
+        restrictions = dict(route.restrictions)
+        key = []
+        for path in _INDEXED_PATHS:
+            expected = restrictions.get(path, _ANY)
+            if callable(expected) or not _hashable(expected):
+                key.append(_ANY)
+            else:
+                key.append(restrictions.pop(path, _ANY))
+        self._buckets[tuple(key)].append(
+            (self._count, route, list(restrictions.items()))
+        )
+        self._actions[key[0]] += 1
+        self._count += 1
+
+    def match(self, data):
+        """Returns the routes matching 'data', in registration order."""
+        choices = []
+        for path in _INDEXED_PATHS:
+            value = glom(data, path, default=_MISSING)
+            if value is _MISSING or not _hashable(value):
+                choices.append((_ANY,))
+            else:
+                choices.append((value, _ANY))
+        candidates = []
+        for key in itertools.product(*choices):
+            candidates.extend(self._buckets.get(key, ()))
+        candidates.sort(key=lambda candidate: candidate[0])
+        return [
+            route
+            for _, route, leftover in candidates
+            if all(
+                _restriction_matches(data, path, expected)
+                for path, expected in leftover
+            )
+        ]
+
+
+def _route_name(route):
+    return getattr(route.async_fn, "__qualname__", repr(route.async_fn))
+
+
+def _loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _verify_webhook_signature(headers, body, secret):
+    # Github sends both of these, but the sha256 one is the one to trust
+    for header, digestmod in [
+        ("x-hub-signature-256", "sha256"),
+        ("x-hub-signature", "sha1"),
+    ]:
+        signature = headers.get(header)
+        if signature is not None:
+            break
+    else:
+        raise gidgethub.ValidationFailure("signature is missing")
+    expected = (
+        f"{digestmod}="
+        + hmac.new(secret.encode("utf-8"), body, digestmod).hexdigest()
+    )
+    if not hmac.compare_digest(
+        signature.encode("utf-8"), expected.encode("ascii")
+    ):
+        raise gidgethub.ValidationFailure(
+            "payload's signature does not align with the secret"
+        )
+
+
+# Github puts "action" first in its payloads, so we can usually find it
+# without decoding anything.
+_LEADING_ACTION_RE = re.compile(
+    rb'\A\s*\{\s*"action"\s*:\s*"([\x20\x21\x23-\x5b\x5d-\x7e]*)"'
+)
+
+
+class LazyEvent(Event):
+    """A webhook event that doesn't decode its JSON payload until needed.
+
+    Payloads are big, and most of them are for events that nothing is
+    routed to, so this saves a lot of work.
+    """
+
+    def __init__(self, body, *, event, delivery_id):
+        self.event = event
+        self.delivery_id = delivery_id
+        self._body = body
+        self._data = _MISSING
+
+    @property
+    def decoded(self):
+        return self._data is not _MISSING
+
+    @property
+    def data(self):
+        if self._data is _MISSING:
+            self._data = _loads(self._body)
+            self._body = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._body = None
+
+    def peek(self):
+        """Returns (action, has installation) without decoding the payload.
+
+        The action is _ANY if we can't tell, or _MISSING if there isn't one.
+        'has installation' might be a false positive, but never a false
+        negative.
+        """
+        if self.decoded:
+            action = glom(self._data, "action", default=_MISSING)
+            installation_id = glom(
+                self._data, "installation.id", default=None
+            )
+            return action, installation_id is not None
+        match = _LEADING_ACTION_RE.match(self._body)
+        action = _ANY if match is None else match.group(1).decode("ascii")
+        return action, b'"installation"' in self._body
+
+
+class CpuOffloader:
+    """Runs CPU-heavy work in worker threads, so it doesn't hold up the loop.
+
+    Small jobs aren't worth the trip to a thread, so each kind of work has a
+    size threshold (in bytes or characters), and only jobs at least that big
+    are offloaded. Threads don't make Python code run in parallel, but the
+    GIL changes hands every few milliseconds, so other webhooks keep moving
+    while a big job runs.
+    """
+
+    # XX Rough guesses at where each kind of work starts taking a few
+    # milliseconds; see benchmarks/bench_parse_commands.py
+    DEFAULT_THRESHOLDS = {"parse_commands": 16 * 1024, "json_decode": 2 ** 20}
+
+    def __init__(self, *, max_threads=4, thresholds=None):
+        # Read when the first job is offloaded
+        self.max_threads = max_threads
+        self.thresholds = dict(self.DEFAULT_THRESHOLDS)
+        if thresholds is not None:
+            self.thresholds.update(thresholds)
+        self._limiter = None
+
+        self.metrics = Registry()
+        self.cpu_seconds = self.metrics.register(
+            Histogram(
+                "snekomatic_cpu_seconds",
+                "Time spent on CPU-heavy work, on the event loop or in a "
+                "worker thread",
+                ["kind", "where"],
+            )
+        )
+        self.wait_seconds = self.metrics.register(
+            Histogram(
+                "snekomatic_cpu_wait_seconds",
+                "Time offloaded work spent waiting for a worker thread",
+                ["kind"],
+            )
+        )
+
+    def offloads(self, kind, size):
+        """Whether run() would use a worker thread for this job."""
+        return size is None or size >= self.thresholds.get(kind, 0)
+
+    async def run(self, kind, fn, *args, size=None):
+        """Returns fn(*args), computed in a worker thread if 'size' is at
+        least the threshold for 'kind'.
+
+        size=None means it always goes to a thread.
+        """
+        submitted = time.monotonic()
+        if not self.offloads(kind, size):
+            try:
+                return fn(*args)
+            finally:
+                self.cpu_seconds.observe(
+                    time.monotonic() - submitted, kind=kind, where="loop"
+                )
+        if self._limiter is None:
+            # Created lazily, because anyio needs to know which async library
+            # we're using
+            self._limiter = anyio.create_capacity_limiter(self.max_threads)
+        started = None
+
+        def run():
+            nonlocal started
+            started = time.monotonic()
+            return fn(*args)
+
+        with span("cpu_offload", kind=kind, size=size) as offload_span:
+            try:
+                return await anyio.run_in_thread(run, limiter=self._limiter)
+            finally:
+                if started is not None:
+                    waited = started - submitted
+                    self.wait_seconds.observe(waited, kind=kind)
+                    self.cpu_seconds.observe(
+                        time.monotonic() - started, kind=kind, where="thread"
+                    )
+                    offload_span.set(wait=waited)
 
 
 class GithubApp:
@@ -225,24 +1066,99 @@ class GithubApp:
         app_id=None,
         private_key=None,
         webhook_secret=None,
+        token_store=None,
+        delivery_store=None,
+        # Default for how long a webhook handler can run before we give up on
+        # it, in seconds; None for no limit. Can be overridden per route.
+        route_timeout=300,
+        # How long process_event waits before running handlers, in seconds,
+        # to give Github's eventual consistency time to catch up.
+        consistency_delay=1,
+        # Approximate memory budget for cached API responses, in bytes.
         # XX Completely untuned; maybe this is too big, or too small.
-        cache_size=500,
+        cache_size=16 * 2 ** 20,
+        # How many worker threads can be busy with big markdown/JSON/JWT
+        # jobs at once (see CpuOffloader).
+        cpu_threads=4,
     ):
-        if session is None:
-            # We don't really need to limit simultaneous connections... we're
-            # not going to overwhelm github's frontend servers.
-            session = asks.Session(connections=100)
-        self._session = session
+        # We don't really need to limit simultaneous connections... we're not
+        # going to overwhelm github's frontend servers. (AsksTransport's
+        # default is 100 per host.)
+        self._transport = _as_transport(session)
         self._user_agent = user_agent
         self._app_id = app_id
         self._private_key = private_key
         self._webhook_secret = webhook_secret
         self._installation_tokens = defaultdict(CachedInstallationToken)
-        # event_type -> [Route(...), Route(...), ...]
-        self._routes = defaultdict(list)
+        # Lets several processes share installation tokens; see
+        # _renew_token_shared for the interface.
+        self._token_store = token_store
+        self._delivery_store = delivery_store
+        # delivery id -> True, for deliveries this process has claimed
+        self._deliveries = cachetools.LRUCache(10000)
+        # Parsing the key and RS256-signing tokens is slow, so we do it as
+        # rarely as we can get away with.
+        self._signing_key = None
+        self._app_token = CachedAppToken()
+        # event_type -> RouteIndex
+        self._routes = defaultdict(RouteIndex)
+        self._route_timeout = route_timeout
+        self.consistency_delay = consistency_delay
+        # id(route) -> semaphore, for routes with max_concurrency
+        self._route_limiters = {}
+        # handler name -> RouteStats
+        self.route_stats = defaultdict(RouteStats)
         # command name -> handler
         self._command_routes = {}
-        self._cache = cachetools.LRUCache(cache_size)
+        self._cache = cachetools.LRUCache(
+            cache_size, getsizeof=_cache_entry_size
+        )
+        self.cache_stats = CacheStats()
+        # installation id -> GraphQLBatcher, so lookups from different
+        # webhook handlers get batched together
+        self._graphql_batchers = defaultdict(GraphQLBatcher)
+        # Shared by all our clients, so they all see the same budgets
+        self.rate_limits = RateLimitScheduler()
+        self.cpu_offload = CpuOffloader(max_threads=cpu_threads)
+        # Only set while run_webhook_workers is running
+        self._webhook_queue = None
+        self.webhook_queue_stats = WebhookQueueStats()
+        # Called with any exception that escapes a webhook handler running on
+        # a background worker, since there's no request to propagate it to.
+        self.error_handler = None
+
+        # Everything above, for a /metrics endpoint. Latencies need
+        # histograms; the rest is read from the stats objects when scraped.
+        self.metrics = Registry()
+        self.webhook_done_seconds = self.metrics.register(
+            Histogram(
+                "snekomatic_webhook_done_seconds",
+                "Time from receiving a webhook to finishing its handlers",
+            )
+        )
+        self.handler_seconds = self.metrics.register(
+            Histogram(
+                "snekomatic_handler_seconds",
+                "Time spent running each webhook handler",
+                ["handler"],
+            )
+        )
+        self.github_request_seconds = self.metrics.register(
+            Histogram(
+                "snekomatic_github_request_seconds",
+                "Github API request latency",
+                ["endpoint", "status"],
+            )
+        )
+        self.token_refreshes = self.metrics.register(
+            Counter(
+                "snekomatic_token_refreshes_total",
+                "Installation token renewals",
+                ["result"],
+            )
+        )
+        self.metrics.register(self.cpu_offload.metrics)
+        self.metrics.register(CallbackCollector(self._collect_metrics))
 
         # Not included currently:
         # - edits/deletions
@@ -269,51 +1185,286 @@ class GithubApp:
     def app_client(self):
         return AppGithubClient(self)
 
-    def client_for(self, installation_id):
-        return InstallationGithubClient(self, installation_id)
+    def client_for(self, installation_id, *, priority="normal"):
+        # priority="low" is for things that can wait, if we're running low on
+        # API calls (see RateLimitScheduler)
+        return InstallationGithubClient(self, installation_id, priority)
+
+    def _collect_metrics(self):
+        queue_depth = Gauge(
+            "snekomatic_webhook_queue_depth", "Webhooks waiting for a worker"
+        )
+        queue_depth.set(self.webhook_queue_stats.depth)
+        queue_events = Counter(
+            "snekomatic_webhook_queue_events_total",
+            "Webhooks that went through the in-memory queue",
+            ["state"],
+        )
+        for state in ["enqueued", "processed", "failed"]:
+            queue_events.inc(
+                getattr(self.webhook_queue_stats, state), state=state
+            )
+        handler_failures = Counter(
+            "snekomatic_handler_failures_total",
+            "Webhook handlers that raised an exception",
+            ["handler"],
+        )
+        for name, stats in self.route_stats.items():
+            handler_failures.inc(stats.failures, handler=name)
+        cache = Counter(
+            "snekomatic_github_cache_total",
+            "Lookups in the Github response cache; not_modified counts the "
+            "hits that Github confirmed were still fresh",
+            ["result"],
+        )
+        for result in ["hits", "misses", "not_modified"]:
+            cache.inc(getattr(self.cache_stats, result), result=result)
+        rate_limit_remaining = Gauge(
+            "snekomatic_github_rate_limit_remaining",
+            "Requests left in the current Github rate limit window",
+            ["key"],
+        )
+        for key, budget in self.rate_limits.budgets.items():
+            if budget.remaining is not None:
+                rate_limit_remaining.set(budget.remaining, key=key)
+        graphql = Counter(
+            "snekomatic_graphql_batching_total",
+            "GraphQL lookups, and the queries it took to answer them",
+            ["kind"],
+        )
+        for batcher in self._graphql_batchers.values():
+            graphql.inc(batcher.stats.lookups, kind="lookups")
+            graphql.inc(batcher.stats.queries, kind="queries")
+        return [
+            queue_depth,
+            queue_events,
+            handler_failures,
+            cache,
+            rate_limit_remaining,
+            graphql,
+        ]
+
+    def _app_jwt(self):
+        if _too_close_for_comfort(self._app_token.expires_at):
+            if self._signing_key is None:
+                self._signing_key = serialization.load_pem_private_key(
+                    self.private_key.encode("ascii"),
+                    password=None,
+                    backend=default_backend(),
+                )
+            now = pendulum.now()
+            # Backdate in case Github's clock is behind ours, and stay under
+            # the lifetime limit in case it's ahead.
+            issued_at = now - MAX_CLOCK_SKEW
+            expires_at = now + MAX_APP_TOKEN_LIFETIME - MAX_CLOCK_SKEW
+            token = jwt.encode(
+                {
+                    "iat": issued_at.int_timestamp,
+                    "exp": expires_at.int_timestamp,
+                    "iss": self.app_id,
+                },
+                key=self._signing_key,
+                algorithm="RS256",
+            )
+            self._app_token = CachedAppToken(
+                token.decode("ascii"),
+                pendulum.from_timestamp(expires_at.int_timestamp),
+            )
+        return self._app_token.token
+
+    async def _app_jwt_offloaded(self):
+        if _too_close_for_comfort(self._app_token.expires_at):
+            # RS256 signing takes a while. If several requests get here at
+            # once they might all sign, but that's harmless.
+            return await self.cpu_offload.run("jwt_sign", self._app_jwt)
+        return self._app_token.token
 
     async def token_for(self, installation_id):
         cit = self._installation_tokens[installation_id]
+        cit.last_used = time.monotonic()
 
         while _too_close_for_comfort(cit.expires_at):
-            print(
-                f"{installation_id}: Token is uncached or expired or will expire soon"
-            )
             if cit.refresh_event is not None:
-                print(
-                    f"{installation_id}: Renewal already in progress; waiting"
+                log(
+                    "Token is uncached or expiring; renewal already in "
+                    "progress, waiting",
+                    installation_id=installation_id,
                 )
                 await cit.refresh_event.wait()
             else:
-                print(f"{installation_id}: Renewing now")
-                cit.refresh_event = anyio.create_event()
-                try:
-                    response = await self.app_client.post(
-                        "/app/installations/{installation_id}/access_tokens",
-                        url_vars={"installation_id": installation_id},
-                        accept=accept_format(version="machine-man-preview"),
-                        data={},
-                    )
-                    cit.token = response["token"]
-                    cit.expires_at = pendulum.parse(response["expires_at"])
-                    assert not _too_close_for_comfort(cit.expires_at)
-                    print(f"{installation_id}: Renewed successfully")
-                finally:
-                    # Make sure that even if we get cancelled, any other tasks
-                    # will still wake up (and can retry the operation)
-                    await cit.refresh_event.set()
-                    cit.refresh_event = None
+                log(
+                    "Token is uncached or expiring; renewing now",
+                    installation_id=installation_id,
+                )
+                await self._renew_token(installation_id, cit)
 
         return cit.token
 
-    def add(self, async_fn, event_type, **restrictions):
-        if len(restrictions) > 1:
-            raise TypeError("At most one restriction is allowed (for now)")
-        self._routes[event_type].append(Route(async_fn, restrictions))
+    async def _renew_token(self, installation_id, cit):
+        with span("token_refresh", installation_id=installation_id):
+            await self._renew_token_traced(installation_id, cit)
+
+    async def _renew_token_traced(self, installation_id, cit):
+        cit.refresh_event = anyio.create_event()
+        try:
+            if self._token_store is None:
+                await self._fetch_token(installation_id, cit)
+            else:
+                await self._renew_token_shared(installation_id, cit)
+        except Exception:
+            self.token_refreshes.inc(result="failed")
+            raise
+        finally:
+            # Make sure that even if we get cancelled, any other tasks will
+            # still wake up (and can retry the operation)
+            await cit.refresh_event.set()
+            cit.refresh_event = None
+
+    async def _fetch_token(self, installation_id, cit):
+        response = await self.app_client.post(
+            "/app/installations/{installation_id}/access_tokens",
+            url_vars={"installation_id": installation_id},
+            accept=accept_format(version="machine-man-preview"),
+            data={},
+        )
+        cit.token = response["token"]
+        cit.expires_at = pendulum.parse(response["expires_at"])
+        assert not _too_close_for_comfort(cit.expires_at)
+        self.token_refreshes.inc(result="fetched")
+        log("Renewed token", installation_id=installation_id)
+
+    def _use_stored_token(self, installation_id, cit, stored):
+        if stored is None:
+            return False
+        token, expires_at = stored
+        if _too_close_for_comfort(expires_at):
+            return False
+        cit.token = token
+        cit.expires_at = expires_at
+        self.token_refreshes.inc(result="from_store")
+        log("Using token from shared store", installation_id=installation_id)
+        return True
+
+    async def _renew_token_shared(self, installation_id, cit):
+        store = self._token_store
+        fetching = False
+        try:
+            # Maybe another process already renewed it
+            stored = await store.get(installation_id)
+            if self._use_stored_token(installation_id, cit, stored):
+                return
+            async with store.renewal_lock(installation_id) as locked:
+                if not locked:
+                    log(
+                        "Shared token lock timed out",
+                        installation_id=installation_id,
+                    )
+                # Maybe another process renewed it while we were waiting for
+                # the lock
+                stored = await store.get(installation_id)
+                if self._use_stored_token(installation_id, cit, stored):
+                    return
+                fetching = True
+                await self._fetch_token(installation_id, cit)
+                fetching = False
+                await store.put(installation_id, cit.token, cit.expires_at)
+        except Exception:
+            if fetching:
+                raise
+            # The shared store is just an optimization; we can manage without
+            log(
+                "Shared token store failed",
+                installation_id=installation_id,
+                exc_info=True,
+            )
+            if _too_close_for_comfort(cit.expires_at):
+                await self._fetch_token(installation_id, cit)
+
+    async def run_token_refresher(
+        self,
+        *,
+        interval=60,
+        active_window=3600,
+        refresh_ahead=pendulum.Duration(minutes=5),
+    ):
+        """Renew installation tokens in the background, before they expire.
+
+        Every 'interval' seconds, we look for installations that have used
+        their token in the last 'active_window' seconds, and whose token will
+        be too close to expiry within 'refresh_ahead', and renew those
+        tokens, so that webhook handlers don't have to wait for it.
+        token_for still renews on demand if this falls behind.
+        """
+        while True:
+            await anyio.sleep(interval)
+            now = time.monotonic()
+            due = [
+                (installation_id, cit)
+                for installation_id, cit in self._installation_tokens.items()
+                if cit.token
+                and now - cit.last_used < active_window
+                and _too_close_for_comfort(cit.expires_at - refresh_ahead)
+            ]
+            if not due:
+                continue
+            log("Renewing installation tokens in background", count=len(due))
+            async with anyio.create_task_group() as tg:
+                for installation_id, cit in due:
+                    # Spread the renewals out over the interval, so we don't
+                    # send a burst of them all at once.
+                    delay = random.uniform(0, interval / 2)
+                    await tg.spawn(
+                        self._renew_token_soon,
+                        installation_id,
+                        cit,
+                        delay,
+                        refresh_ahead,
+                    )
+
+    async def _renew_token_soon(
+        self, installation_id, cit, delay, refresh_ahead
+    ):
+        await anyio.sleep(delay)
+        # token_for might have gotten to it first
+        if cit.refresh_event is not None:
+            return
+        if not _too_close_for_comfort(cit.expires_at - refresh_ahead):
+            return
+        try:
+            await self._renew_token(installation_id, cit)
+        except Exception:
+            # No big deal; token_for will try again when it's needed
+            log(
+                "Background token renewal failed",
+                installation_id=installation_id,
+                exc_info=True,
+            )
+
+    def add(
+        self,
+        async_fn,
+        event_type,
+        *,
+        timeout=None,
+        max_concurrency=None,
+        where=None,
+        **restrictions,
+    ):
+        # Keyword restrictions are top-level payload fields. 'where' maps
+        # glom paths like "pull_request.user.login" to values. Either way, a
+        # callable value is a predicate to call on the field instead.
+        if where is not None:
+            for path, expected in where.items():
+                if path in restrictions:
+                    raise TypeError(f"{path!r} is restricted twice")
+                restrictions[path] = expected
+        self._routes[event_type].add(
+            Route(async_fn, restrictions, timeout, max_concurrency)
+        )
 
-    def route(self, event_type, **restrictions):
+    def route(self, event_type, **kwargs):
         def decorator(async_fn):
-            self.add(async_fn, event_type, **restrictions)
+            self.add(async_fn, event_type, **kwargs)
             return async_fn
 
         return decorator
@@ -331,32 +1482,340 @@ class GithubApp:
 
         return decorator
 
-    async def dispatch_webhook(self, headers, body):
-        event = Event.from_http(headers, body, secret=self.webhook_secret)
-        print(
-            f"GH webhook received: type={event.event}, delivery id={event.delivery_id}"
+    def parse_webhook(self, headers, body):
+        # Like gidgethub's Event.from_http, except that JSON payloads are
+        # decoded lazily, and we understand sha256 signatures.
+        with span("verify_signature"):
+            _verify_webhook_signature(headers, body, self.webhook_secret)
+        content_type = headers.get("content-type", "")
+        content_type = content_type.split(";")[0].strip().lower()
+        if content_type == "application/json":
+            event = LazyEvent(
+                body,
+                event=headers["x-github-event"],
+                delivery_id=headers["x-github-delivery"],
+            )
+        elif content_type == "application/x-www-form-urlencoded":
+            form = urllib.parse.parse_qs(body.decode("utf-8"))
+            event = Event(
+                _loads(form["payload"][0]),
+                event=headers["x-github-event"],
+                delivery_id=headers["x-github-delivery"],
+            )
+        else:
+            raise gidgethub.BadRequest(
+                http.HTTPStatus(415),
+                "expected a content-type of 'application/json' or "
+                "'application/x-www-form-urlencoded'",
+            )
+        log(
+            "GH webhook received",
+            event_type=event.event,
+            delivery_id=event.delivery_id,
         )
+        return event
+
+    async def dispatch_webhook(self, headers, body):
+        received = time.monotonic()
+        delivery_id = headers.get("x-github-delivery")
+        with start_trace(delivery_id, "dispatch_webhook"):
+            event = self.parse_webhook(headers, body)
+            try:
+                await self.process_event(event)
+            finally:
+                self.webhook_done_seconds.observe(time.monotonic() - received)
+
+    @property
+    def webhook_workers_running(self):
+        return self._webhook_queue is not None
+
+    async def enqueue_webhook(self, headers, body):
+        delivery_id = headers.get("x-github-delivery")
+        with start_trace(delivery_id, "enqueue_webhook"):
+            await self._enqueue_webhook(headers, body)
+
+    async def _enqueue_webhook(self, headers, body):
+        received = time.monotonic()
+        # Validate up front, so that bad signatures are still reported back
+        # to the sender.
+        event = self.parse_webhook(headers, body)
+        queue = self._webhook_queue
+        if queue is None:
+            raise RuntimeError("run_webhook_workers isn't running")
+        if not self.might_route(event):
+            log("Nothing routes this delivery; dropping it")
+            return
+        if queue.full():
+            raise WebhookQueueFull(
+                f"dropping delivery {event.delivery_id}: queue is full"
+            )
+        await queue.put((received, event))
+        self.webhook_queue_stats.enqueued += 1
+        self.webhook_queue_stats.depth = queue.qsize()
+
+    async def run_webhook_workers(self, worker_count, *, queue_size=1000):
+        if self._webhook_queue is not None:
+            raise RuntimeError("run_webhook_workers is already running")
+        queue = anyio.create_queue(queue_size)
+        self._webhook_queue = queue
+        try:
+            async with anyio.create_task_group() as tg:
+                for _ in range(worker_count):
+                    await tg.spawn(self._webhook_worker, queue)
+        finally:
+            self._webhook_queue = None
+
+    async def _webhook_worker(self, queue):
+        stats = self.webhook_queue_stats
+        while True:
+            received, event = await queue.get()
+            waited = time.monotonic() - received
+            stats.depth = queue.qsize()
+            stats.total_wait += waited
+            stats.max_wait = max(stats.max_wait, waited)
+            log(
+                "Delivery dequeued",
+                category="queue",
+                delivery_id=event.delivery_id,
+                waited=f"{waited:.3f}s",
+                still_queued=stats.depth,
+            )
+            try:
+                await self.process_event(event)
+            except WebhookHandlerError:
+                # Already reported
+                stats.failed += 1
+            except Exception as exc:
+                stats.failed += 1
+                log(
+                    "Error processing delivery",
+                    delivery_id=event.delivery_id,
+                    exc_info=True,
+                )
+                if self.error_handler is not None:
+                    self.error_handler(exc)
+            else:
+                stats.processed += 1
+            self.webhook_done_seconds.observe(time.monotonic() - received)
+
+    def might_route(self, event):
+        """Cheaply checks whether process_event might act on 'event'.
+
+        For events from parse_webhook, this usually doesn't need to decode the
+        payload at all.
+        """
+        routes = self._routes.get(event.event)
+        if routes is None or not len(routes):
+            return False
+        if isinstance(event, LazyEvent):
+            action, has_installation = event.peek()
+        else:
+            action = glom(event.data, "action", default=_MISSING)
+            has_installation = (
+                glom(event.data, "installation.id", default=None) is not None
+            )
+        return has_installation and routes.might_match(action)
+
+    async def process_event(self, event, *, deduplicate=True):
+        """Run the handlers for 'event'.
+
+        Pass deduplicate=False if you're retrying an event yourself, so it's
+        not mistaken for a redelivery.
+        """
+        with start_trace(
+            event.delivery_id, "process_event", event_type=event.event
+        ):
+            await self._deduplicate_and_process(event, deduplicate)
+
+    async def _deduplicate_and_process(self, event, deduplicate):
+        if not self.might_route(event):
+            log("No routes for this event; not dispatching")
+            return
+        delivery_id = event.delivery_id
+        if not deduplicate or delivery_id is None:
+            await self._process_event(event)
+            return
+        if not await self._claim_delivery(delivery_id):
+            log("Already handled this delivery; ignoring it")
+            return
+        try:
+            await self._process_event(event)
+        except BaseException:
+            await self._release_delivery(delivery_id)
+            raise
+        await self._complete_delivery(delivery_id)
+
+    async def _claim_delivery(self, delivery_id):
+        # Checked and set without yielding, so duplicates that arrive at the
+        # same time in this process can't both get through.
+        if delivery_id in self._deliveries:
+            return False
+        self._deliveries[delivery_id] = True
+        if self._delivery_store is None:
+            return True
+        try:
+            claimed = await self._delivery_store.claim(delivery_id)
+        except Exception:
+            log("Delivery store failed; processing anyway", exc_info=True)
+            return True
+        if not claimed:
+            # Another process has it. Don't remember it, in case that
+            # process fails and releases it.
+            self._deliveries.pop(delivery_id, None)
+        return claimed
+
+    async def _complete_delivery(self, delivery_id):
+        if self._delivery_store is None:
+            return
+        try:
+            await self._delivery_store.complete(delivery_id)
+        except Exception:
+            log("Delivery store failed to record it as done", exc_info=True)
+
+    async def _release_delivery(self, delivery_id):
+        self._deliveries.pop(delivery_id, None)
+        if self._delivery_store is None:
+            return
+        # We might be getting cancelled, but this still needs to happen
+        async with anyio.open_cancel_scope(shield=True):
+            try:
+                await self._delivery_store.release(delivery_id)
+            except Exception:
+                log("Delivery store failed to release it", exc_info=True)
+
+    async def _process_event(self, event):
         # Wait a bit to give Github's eventual consistency time to catch up
-        await anyio.sleep(1)
+        with span("consistency_delay"):
+            await anyio.sleep(self.consistency_delay)
+        await self.decode_event(event)
         installation_id = glom(event.data, "installation.id", default=None)
         if installation_id is None:
-            print("No associated installation; not dispatching")
+            log("No associated installation; not dispatching")
             return
+        with bind(installation_id=installation_id):
+            await self._run_routes(event, installation_id)
+
+    async def decode_event(self, event):
+        """Make sure event.data is decoded, without blocking on big
+        payloads."""
+        if isinstance(event, LazyEvent) and not event.decoded:
+            body = event._body
+            event.data = await self.cpu_offload.run(
+                "json_decode", _loads, body, size=len(body)
+            )
+
+    async def _run_routes(self, event, installation_id):
         client = self.client_for(installation_id)
-        for route in self._routes[event.event]:
-            if _all_match(event.data, route.restrictions):
-                print(f"Routing to {route.async_fn!r}")
-                await route.async_fn(event.event, event.data, client)
+        # Handlers are independent, so they run concurrently, and one failing
+        # doesn't affect the others.
+        errors = []
+        async with anyio.create_task_group() as tg:
+            for route in self._routes[event.event].match(event.data):
+                log("Routing", category="routing", handler=_route_name(route))
+                await tg.spawn(self._run_route, route, event, client, errors)
+        budget = self.rate_limits.budgets.get(installation_id)
+        if budget is not None and budget.remaining is not None:
+            log(
+                "Rate limit remaining",
+                category="routing",
+                remaining=budget.remaining,
+            )
+        if errors:
+            raise WebhookHandlerError(errors)
+
+    async def _run_route(self, route, event, client, errors):
+        name = _route_name(route)
+        stats = self.route_stats[name]
+        start = time.monotonic()
         try:
-            limit = client.rate_limit.remaining
-        except AttributeError:
-            pass
+            with span("route", handler=name):
+                limiter = self._route_limiter(route)
+                if limiter is None:
+                    await self._call_route(route, event, client)
+                else:
+                    async with limiter:
+                        await self._call_route(route, event, client)
+        except Exception as exc:
+            stats.failures += 1
+            errors.append(exc)
+            log("Error in handler", handler=name, exc_info=True)
+            if self.error_handler is not None:
+                self.error_handler(exc)
+        finally:
+            elapsed = time.monotonic() - start
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            self.handler_seconds.observe(elapsed, handler=name)
+            log(
+                "Handler finished",
+                category="routing",
+                handler=name,
+                elapsed=f"{elapsed:.3f}s",
+            )
+
+    def _route_limiter(self, route):
+        if route.max_concurrency is None:
+            return None
+        # Created lazily, because anyio needs to know which async library
+        # we're using
+        limiter = self._route_limiters.get(id(route))
+        if limiter is None:
+            limiter = anyio.create_semaphore(route.max_concurrency)
+            self._route_limiters[id(route)] = limiter
+        return limiter
+
+    async def _call_route(self, route, event, client):
+        timeout = route.timeout
+        if timeout is None:
+            timeout = self._route_timeout
+        if timeout is None:
+            await route.async_fn(event.event, event.data, client)
         else:
-            print(f"Rate limit for install {installation_id}: {limit}")
+            async with anyio.fail_after(timeout):
+                await route.async_fn(event.event, event.data, client)
+
+    async def parse_commands(self, body_text):
+        """Like the parse_commands function, except that big bodies are
+        parsed in a worker thread."""
+        found = _commands_cache_key(body_text)
+        if found is None:
+            return []
+        key, last_candidate = found
+        # The cache isn't thread-safe, so it's only touched from here
+        commands = _parsed_commands.get(key)
+        if commands is None:
+            trimmed = _trim_for_commands(body_text, last_candidate)
+            size = len(trimmed)
+            if self.cpu_offload.offloads("parse_commands", size):
+                commands = await self.cpu_offload.run(
+                    "parse_commands", _freeze_commands, trimmed, size=size
+                )
+            elif _marko_lock.acquire(blocking=False):
+                # Small, and no worker is parsing, so do it right here. (This
+                # runs it without reaching a checkpoint, so we can't be
+                # cancelled while holding the lock.)
+                try:
+                    commands = await self.cpu_offload.run(
+                        "parse_commands",
+                        _freeze_commands_locked,
+                        trimmed,
+                        size=size,
+                    )
+                finally:
+                    _marko_lock.release()
+            else:
+                # A worker is busy parsing; wait for it in a thread, instead
+                # of blocking the loop on the lock
+                commands = await self.cpu_offload.run(
+                    "parse_commands", _freeze_commands, trimmed
+                )
+            _parsed_commands[key] = commands
+        return [list(command) for command in commands]
 
     async def _dispatch_command(self, event_type, payload, gh_client):
         body = get_comment_body(event_type, payload)
-        for command in parse_commands(body):
+        for command in await self.parse_commands(body):
             if command[0] in self._command_routes:
                 # TODO: handle errors here
                 await self._command_routes[command[0]](
@@ -426,13 +1885,94 @@ def reaction_url(event_type, payload):
         raise ValueError(f"unknown event_type: {event_type!r}")
 
 
+# A command has to be on a line of its own, so any body containing one has a
+# line that matches this. Checking is much cheaper than parsing the markdown,
+# and most bodies don't have any commands.
+_COMMAND_CANDIDATE_RE = re.compile(r"^[^\S\n]*/", re.MULTILINE)
+
+# Ends a markdown paragraph.
+_BLANK_LINE_RE = re.compile(r"\n[^\S\n]*\n")
+
+# Github doesn't allow comments longer than this, so anything bigger is
+# suspicious and we don't look for commands past this point.
+MAX_COMMAND_BODY_LENGTH = 65536
+
+# sha256(body) -> commands, so redeliveries and edits that don't touch the
+# body don't have to be parsed again.
+_parsed_commands = cachetools.LRUCache(1024)
+
+
+def _trim_for_commands(body_text, last_candidate):
+    # Text after the last candidate line can't contain a command. But the
+    # rest of its paragraph can still change how it parses (e.g. a "---" or
+    # "===" underline turns the whole paragraph into a heading), so we cut
+    # at the first blank line after it instead.
+    end = _BLANK_LINE_RE.search(body_text, last_candidate)
+    if end is not None:
+        body_text = body_text[: end.start()]
+    if len(body_text) > MAX_COMMAND_BODY_LENGTH:
+        log(
+            "Body is too long; only looking for commands at the start",
+            length=len(body_text),
+            limit=MAX_COMMAND_BODY_LENGTH,
+        )
+        cut = body_text.rfind("\n", 0, MAX_COMMAND_BODY_LENGTH)
+        if cut == -1:
+            cut = MAX_COMMAND_BODY_LENGTH
+        body_text = body_text[:cut]
+    return body_text
+
+
+def _commands_cache_key(body_text):
+    # Returns (cache key, offset of the last line that might be a command),
+    # or None if there can't be any commands.
+    last_candidate = None
+    for last_candidate in _COMMAND_CANDIDATE_RE.finditer(body_text):
+        pass
+    if last_candidate is None:
+        return None
+    key = hashlib.sha256(body_text.encode("utf-8", "surrogatepass")).digest()
+    return key, last_candidate.start()
+
+
+# marko keeps its parse state in module and class attributes, so two
+# threads parsing at once corrupt each other's results. Everything that
+# parses holds this.
+_marko_lock = threading.Lock()
+
+
+def _freeze_commands(body_text):
+    with _marko_lock:
+        return _freeze_commands_locked(body_text)
+
+
+def _freeze_commands_locked(body_text):
+    # Immutable, for the cache. The caller holds _marko_lock.
+    return tuple(map(tuple, _parse_commands(body_text)))
+
+
+def parse_commands(body_text):
+    """Returns a list of commands in 'body_text', each split into words."""
+    found = _commands_cache_key(body_text)
+    if found is None:
+        return []
+    key, last_candidate = found
+    commands = _parsed_commands.get(key)
+    if commands is None:
+        trimmed = _trim_for_commands(body_text, last_candidate)
+        commands = _freeze_commands(trimmed)
+        _parsed_commands[key] = commands
+    # Fresh lists each time, in case a handler modifies its command
+    return [list(command) for command in commands]
+
+
 # We use marko to parse the body as markdown, and then when scanning for
 # commands we only look at top-level paragraphs, plain text, rendered as
 # standalone lines.
 #
 # For a quick overview of how marko's AST represents some markdown, run:
 #   marko.ast_renderer.ASTRenderer().render(gfm.parse("..."))
-def parse_commands(body_text):
+def _parse_commands(body_text):
     ast = gfm.parse(body_text)
     for para in ast.children:
         # This makes us ignore commands inside blockquotes, lists, code
@@ -0,0 +1,183 @@
+"""Structured logging that doesn't block the event loop.
+
+  log("Routing webhook", handler=name)
+
+writes a line like
+
+  Routing webhook handler=check_membership delivery_id=1234 installation_id=5
+
+Every record is tagged with the delivery id of the webhook we're handling
+(see tracing.py), plus anything bound with 'with bind(**fields):', like the
+installation id. Pass exc_info=True from an 'except' block to include the
+traceback, or stack=<a traceback.StackSummary> to include some other stack.
+
+While 'LOGGER.run_writer()' is running, records go into a bounded buffer,
+and the writer writes them out in batches from a thread, so a slow log drain
+can't stall the event loop. If the buffer fills up, new records are dropped,
+and counted in 'LOGGER.dropped'. Before the writer starts, and after it
+stops, records are written immediately, like print.
+
+Chatty lines can be sampled: give them a category, like
+log(..., category="routing"), and set LOGGER.sample_rates["routing"] to the
+fraction of them you want to keep.
+"""
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import json
+import random
+import sys
+import traceback
+
+import anyio
+import trio
+
+from .metrics import Counter, Gauge
+from .tracing import current_trace_id
+
+__all__ = ["log", "bind", "Logger", "LOGGER"]
+
+_bound = contextvars.ContextVar("log_fields", default={})
+
+
+@contextmanager
+def bind(**fields):
+    """Tag every record logged inside the 'with' block with 'fields'."""
+    token = _bound.set({**_bound.get(), **fields})
+    try:
+        yield
+    finally:
+        _bound.reset(token)
+
+
+def _format_value(value):
+    text = str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        text = json.dumps(text)
+    return text
+
+
+def _format_record(message, fields):
+    parts = [message]
+    for key, value in fields.items():
+        if value is not None:
+            parts.append(f"{key}={_format_value(value)}")
+    return " ".join(parts)
+
+
+class Logger:
+    def __init__(self, *, max_pending=10000, stream=None):
+        self.max_pending = max_pending
+        # None means whatever sys.stdout is when we write
+        self.stream = stream
+        # category -> fraction of records to keep
+        self.sample_rates = {}
+        # Records lost because the buffer was full
+        self.dropped = 0
+        # Records skipped by sampling
+        self.sampled_out = 0
+        self._pending = deque()
+        self._writer_running = False
+        self._random = random.Random()
+
+    def log(
+        self, message, *, category=None, exc_info=False, stack=None, **fields
+    ):
+        if category is not None:
+            rate = self.sample_rates.get(category, 1)
+            if rate < 1 and self._random.random() >= rate:
+                self.sampled_out += 1
+                return
+        all_fields = {"delivery_id": current_trace_id()}
+        all_fields.update(_bound.get())
+        all_fields.update(fields)
+        line = _format_record(message, all_fields)
+        if exc_info:
+            line += "\n" + traceback.format_exc().rstrip("\n")
+        if stack is not None:
+            line += "\nStack (most recent call last):\n"
+            line += "".join(stack.format()).rstrip("\n")
+        self.write_line(line)
+
+    def write_line(self, line):
+        """Write 'line' as is, with the same buffering as log()."""
+        if not self._writer_running:
+            self._write(line + "\n")
+        elif len(self._pending) >= self.max_pending:
+            self.dropped += 1
+        else:
+            self._pending.append(line)
+
+    def _write(self, text):
+        stream = sys.stdout if self.stream is None else self.stream
+        stream.write(text)
+        stream.flush()
+
+    def _take_batch(self, max_batch):
+        lines = []
+        while self._pending and len(lines) < max_batch:
+            lines.append(self._pending.popleft())
+        return lines
+
+    async def run_writer(
+        self,
+        *,
+        interval=0.1,
+        max_batch=1000,
+        task_status=trio.TASK_STATUS_IGNORED,
+    ):
+        """Write out buffered records every 'interval' seconds, until
+        cancelled. Use with 'nursery.start', so that records logged after it
+        returns are buffered."""
+        if self._writer_running:
+            raise RuntimeError("run_writer is already running")
+        self._writer_running = True
+        task_status.started()
+        reported_drops = self.dropped
+        try:
+            while True:
+                await anyio.sleep(interval)
+                while self._pending or self.dropped != reported_drops:
+                    lines = self._take_batch(max_batch)
+                    if self.dropped != reported_drops:
+                        lines.append(
+                            f"Log buffer full; dropped "
+                            f"{self.dropped - reported_drops} records"
+                        )
+                        reported_drops = self.dropped
+                    # These are out of the buffer now, so if we get
+                    # cancelled (e.g. at shutdown), we still have to finish
+                    # writing them
+                    async with anyio.open_cancel_scope(shield=True):
+                        await anyio.run_in_thread(
+                            self._write,
+                            "".join(line + "\n" for line in lines),
+                        )
+        finally:
+            self._writer_running = False
+            # Anything left over, e.g. because we're shutting down
+            lines = self._take_batch(len(self._pending))
+            if lines:
+                self._write("".join(line + "\n" for line in lines))
+
+    def collect(self):
+        # For metrics.Registry
+        dropped = Counter(
+            "snekomatic_log_dropped_total",
+            "Log records dropped because the buffer was full",
+        )
+        dropped.inc(self.dropped)
+        sampled_out = Counter(
+            "snekomatic_log_sampled_out_total",
+            "Log records skipped by sampling",
+        )
+        sampled_out.inc(self.sampled_out)
+        pending = Gauge(
+            "snekomatic_log_pending", "Log records waiting to be written"
+        )
+        pending.set(len(self._pending))
+        return [dropped, sampled_out, pending]
+
+
+LOGGER = Logger()
+log = LOGGER.log
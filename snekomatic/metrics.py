@@ -0,0 +1,214 @@
+"""Just enough of the Prometheus text format for a /metrics endpoint.
+
+Metrics are plain in-memory counters, gauges, and histograms, with labels
+passed as keyword arguments:
+
+  REQUEST_SECONDS = Histogram(
+      "myapp_request_seconds", "Time to handle a request", ["route"]
+  )
+  REQUEST_SECONDS.observe(0.012, route="/webhook")
+
+Updating one is a dict lookup and some arithmetic, so it's fine to do on
+every request. Nothing is locked, so only update them from the event loop
+thread.
+
+A Registry collects metrics and renders them all for scraping. Besides
+metrics, you can register anything with a collect() method that returns
+metrics, which is handy for turning existing stats objects into metrics at
+scrape time instead of keeping two copies up to date.
+"""
+from bisect import bisect_left
+import math
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+    "CallbackCollector",
+    "CONTENT_TYPE",
+]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The Prometheus client libraries' defaults; good for things that take
+# somewhere between a few milliseconds and a few seconds.
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+)
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+        + "}"
+    )
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # label values -> value (or histogram counts)
+        self._series = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, "
+                f"not {tuple(labels)}"
+            )
+        return tuple(labels[name] for name in self.labelnames)
+
+    def collect(self):
+        return [self]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {_escape(self.help)}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for key in sorted(self._series, key=lambda key: tuple(map(str, key))):
+            lines.extend(self._render_series(key, self._series[key]))
+        return lines
+
+    def _render_series(self, key, value):
+        labels = _format_labels(self.labelnames, key)
+        return [f"{self.name}{labels} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._series.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._series[self._key(labels)] = value
+
+    def value(self, **labels):
+        return self._series.get(self._key(labels))
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, bucket_count):
+        # Not cumulative; the last slot is for values above every bucket
+        self.counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = _HistogramSeries(len(self.buckets))
+            self._series[key] = series
+        # Buckets are upper bounds, inclusive
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+
+    def count(self, **labels):
+        series = self._series.get(self._key(labels))
+        return 0 if series is None else sum(series.counts)
+
+    def _render_series(self, key, series):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), series.counts):
+            total += count
+            labels = _format_labels(
+                self.labelnames, key, [("le", _format_value(bound))]
+            )
+            lines.append(f"{self.name}_bucket{labels} {total}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(series.sum)}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class CallbackCollector:
+    """Adapts a function returning metrics, for Registry.register."""
+
+    def __init__(self, fn):
+        self._fn = fn
+
+    def collect(self):
+        return self._fn()
+
+
+class Registry:
+    def __init__(self):
+        self._collectors = []
+
+    def register(self, collector):
+        """Add a metric (or anything with a collect() method, including
+        another Registry), and return it."""
+        self._collectors.append(collector)
+        return collector
+
+    def collect(self):
+        metrics = []
+        for collector in self._collectors:
+            metrics.extend(collector.collect())
+        return metrics
+
+    def render(self):
+        """Everything we know, in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.collect():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
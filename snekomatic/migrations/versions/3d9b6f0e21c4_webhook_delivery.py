@@ -0,0 +1,35 @@
+"""webhook delivery deduplication
+
+Revision ID: 3d9b6f0e21c4
+Revises: a8e2c47d0f13
+Create Date: 2026-10-18 15:02:41.107318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3d9b6f0e21c4"
+down_revision = "a8e2c47d0f13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "webhook_delivery",
+        sa.Column("delivery_id", sa.String, primary_key=True),
+        sa.Column("claimed_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("done", sa.Boolean, nullable=False),
+    )
+    op.create_index(
+        "ix_webhook_delivery_claimed_at", "webhook_delivery", ["claimed_at"]
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "ix_webhook_delivery_claimed_at", table_name="webhook_delivery"
+    )
+    op.drop_table("webhook_delivery")
@@ -0,0 +1,36 @@
+"""webhook job queue
+
+Revision ID: 5c3f1d2a9b7e
+Revises: 1479437ee1e2
+Create Date: 2026-10-18 10:12:41.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5c3f1d2a9b7e"
+down_revision = "1479437ee1e2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "webhook_job",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("delivery_id", sa.String, nullable=False),
+        sa.Column("event_type", sa.String, nullable=False),
+        sa.Column("payload", sa.Text, nullable=False),
+        sa.Column("attempts", sa.Integer, nullable=False),
+        sa.Column("run_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("dead", sa.Boolean, nullable=False),
+        sa.Column("last_error", sa.Text),
+    )
+    op.create_index("ix_webhook_job_run_at", "webhook_job", ["run_at"])
+
+
+def downgrade():
+    op.drop_index("ix_webhook_job_run_at", table_name="webhook_job")
+    op.drop_table("webhook_job")
@@ -0,0 +1,35 @@
+"""org member mirror
+
+Revision ID: 7b1e5c93d8a2
+Revises: 3d9b6f0e21c4
+Create Date: 2026-10-18 15:41:12.630954
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7b1e5c93d8a2"
+down_revision = "3d9b6f0e21c4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "org_member",
+        sa.Column("org", sa.String, primary_key=True),
+        sa.Column("login", sa.String, primary_key=True),
+        sa.Column("state", sa.String, nullable=False),
+    )
+    op.create_table(
+        "org_member_sync",
+        sa.Column("org", sa.String, primary_key=True),
+        sa.Column("synced_at", sa.DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("org_member_sync")
+    op.drop_table("org_member")
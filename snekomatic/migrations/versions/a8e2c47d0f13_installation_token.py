@@ -0,0 +1,29 @@
+"""shared installation tokens
+
+Revision ID: a8e2c47d0f13
+Revises: 5c3f1d2a9b7e
+Create Date: 2026-10-18 13:47:09.522874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a8e2c47d0f13"
+down_revision = "5c3f1d2a9b7e"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "installation_token",
+        sa.Column("installation_id", sa.String, primary_key=True),
+        sa.Column("encrypted_token", sa.Text, nullable=False),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("installation_token")
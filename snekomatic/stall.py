@@ -0,0 +1,164 @@
+"""Notice when something blocks the event loop, and find out what it was.
+
+Everything in snekomatic shares one trio thread, so a synchronous call that
+takes a while -- a database query that didn't go through _in_db_thread, JWT
+signing, parsing a huge comment -- holds up every webhook in flight.
+StallDetector.run() keeps a task that wakes up every 'interval' seconds; how
+late it wakes up is the scheduling lag, which goes into a histogram.
+
+A watchdog thread keeps an eye on that task. If it hasn't woken up for
+'threshold' seconds past when it should have, the loop is stuck, so the
+watchdog grabs the trio thread's stack right then, while the blocking call
+is still on it. Once the loop gets going again, the stall is logged with
+that stack, and counted under the innermost snekomatic function on it (the
+"offender"), so /metrics and /status show which code blocks the most.
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+
+import anyio
+import attr
+
+from .log import log
+from .metrics import Counter, Histogram, Registry
+
+__all__ = ["StallDetector", "StallStats"]
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@attr.s
+class StallStats:
+    count = attr.ib(default=0)
+    # In seconds
+    total = attr.ib(default=0.0)
+    max = attr.ib(default=0.0)
+
+
+def _offender(stack):
+    # The innermost frame that's our code, or failing that the innermost
+    # frame, period
+    for frame in reversed(stack):
+        if os.path.abspath(frame.filename).startswith(_PACKAGE_DIR):
+            break
+    else:
+        if not stack:
+            return "unknown"
+        frame = stack[-1]
+    return f"{os.path.basename(frame.filename)}:{frame.name}"
+
+
+class StallDetector:
+    def __init__(self, *, threshold=0.1, interval=0.05):
+        self.threshold = threshold
+        self.interval = interval
+        # offender -> StallStats
+        self.offenders = {}
+
+        self.metrics = Registry()
+        self.lag_seconds = self.metrics.register(
+            Histogram(
+                "snekomatic_loop_lag_seconds",
+                "How late the event loop got around to a task that was "
+                "ready to run",
+                buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5],
+            )
+        )
+        self.stalls = self.metrics.register(
+            Counter(
+                "snekomatic_loop_stalls_total",
+                "Times something blocked the event loop for longer than "
+                "the stall threshold",
+                ["offender"],
+            )
+        )
+        self.stall_seconds = self.metrics.register(
+            Counter(
+                "snekomatic_loop_stall_seconds_total",
+                "Time the event loop spent blocked in stalls",
+                ["offender"],
+            )
+        )
+
+        # Shared with the watchdog thread. Each of these is only ever
+        # assigned by one thread, and the other just reads it.
+        self._beats = 0
+        self._last_beat = None
+        self._loop_thread = None
+        # (beat number, StackSummary), set by the watchdog
+        self._captured = None
+
+    async def run(self):
+        """Watch for stalls until cancelled."""
+        if self._loop_thread is not None:
+            raise RuntimeError("StallDetector is already running")
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        stop = threading.Event()
+        watchdog = threading.Thread(
+            target=self._watchdog,
+            args=(stop,),
+            name="snekomatic stall watchdog",
+            daemon=True,
+        )
+        watchdog.start()
+        try:
+            while True:
+                before = time.monotonic()
+                await anyio.sleep(self.interval)
+                now = time.monotonic()
+                self._last_beat = now
+                self._beats += 1
+                lag = max(0.0, now - before - self.interval)
+                self.lag_seconds.observe(lag)
+                if lag >= self.threshold:
+                    self._report(lag)
+        finally:
+            stop.set()
+            self._loop_thread = None
+            self._captured = None
+
+    def _report(self, lag):
+        captured, self._captured = self._captured, None
+        # The watchdog might not have had a chance to look, e.g. if the
+        # blocking call was in C and held the GIL the whole time
+        if captured is not None and captured[0] == self._beats - 1:
+            stack = captured[1]
+        else:
+            stack = None
+        offender = _offender(stack or [])
+        stats = self.offenders.setdefault(offender, StallStats())
+        stats.count += 1
+        stats.total += lag
+        stats.max = max(stats.max, lag)
+        self.stalls.inc(offender=offender)
+        self.stall_seconds.inc(lag, offender=offender)
+        log(
+            "Event loop stalled",
+            offender=offender,
+            duration=f"{lag:.3f}s",
+            stack=stack,
+        )
+
+    def _watchdog(self, stop):
+        check_every = self.threshold / 2
+        while not stop.wait(check_every):
+            beats = self._beats
+            if self._captured is not None and self._captured[0] == beats:
+                # Already got this stall
+                continue
+            overdue = time.monotonic() - self._last_beat - self.interval
+            if overdue < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            # If the loop moved on while we were looking, this stack is
+            # probably innocent
+            if self._beats == beats:
+                self._captured = (beats, stack)
@@ -0,0 +1,206 @@
+"""Per-delivery tracing, so we can see where a slow webhook spent its time.
+
+Each webhook delivery gets a trace, whose id is the delivery id. Code that
+does something worth timing wraps it in a span:
+
+  with span("github.request", endpoint=endpoint) as s:
+      response = await send()
+      s.set(status=response[0])
+
+Spans nest: the current span lives in a contextvar, so it follows the code
+into awaits and into tasks started from inside it (trio copies the context
+when it starts a task). Outside of a trace, span() does nothing, so it's
+cheap to sprinkle around code that only sometimes runs for a webhook.
+
+Traces are started with start_trace(delivery_id, name). When its outermost
+span finishes, the spans are stored in RECORDER, which keeps the most recent
+traces in memory and can also export them as JSON lines. A
+delivery can have several traces with the same id -- e.g. one for receiving
+it, and another later for processing it on a background worker -- and the
+recorder keeps them together.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+import contextvars
+import itertools
+import json
+import time
+
+__all__ = [
+    "span",
+    "start_trace",
+    "current_trace_id",
+    "span_tree",
+    "TraceRecorder",
+    "RECORDER",
+]
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "attributes",
+        "error",
+        "_finished",
+        "_start",
+        "_started_at",
+        "_duration",
+    )
+
+    def __init__(self, name, trace_id, parent_id, finished, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = next(_span_ids)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+        # Where finished spans go; shared by the whole trace
+        self._finished = finished
+        self._start = time.monotonic()
+        self._started_at = time.time()
+        self._duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def _finish(self):
+        self._duration = time.monotonic() - self._start
+        self._finished.append(self.as_dict())
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "started_at": self._started_at,
+            "duration": self._duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoSpan:
+    # What span() gives you when there's no trace to add to
+    def set(self, **attributes):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+_NOTHING = nullcontext(_NO_SPAN)
+
+
+@contextmanager
+def _enter(new_span):
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as exc:
+        new_span.error = repr(exc)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span._finish()
+
+
+def span(name, **attributes):
+    """Time the body of a 'with' block, as part of the current trace."""
+    parent = _current_span.get()
+    if parent is None:
+        return _NOTHING
+    new_span = Span(
+        name, parent.trace_id, parent.span_id, parent._finished, attributes
+    )
+    return _enter(new_span)
+
+
+@contextmanager
+def start_trace(trace_id, name, **attributes):
+    """Start a new trace, whose outermost span is 'name'.
+
+    If we're already inside a trace with the same id, this is just a span.
+    """
+    parent = _current_span.get()
+    if trace_id is None or (
+        parent is not None and parent.trace_id == trace_id
+    ):
+        with span(name, **attributes) as new_span:
+            yield new_span
+        return
+    finished = []
+    root = Span(name, trace_id, None, finished, attributes)
+    try:
+        with _enter(root):
+            yield root
+    finally:
+        RECORDER.record(trace_id, finished)
+
+
+def current_trace_id():
+    """The id of the trace we're in (i.e., the delivery id), or None."""
+    current = _current_span.get()
+    return None if current is None else current.trace_id
+
+
+def span_tree(spans):
+    """Nest a trace's spans under their parents, in start order."""
+    nodes = {
+        s["span_id"]: dict(s, children=[])
+        for s in sorted(spans, key=lambda s: s["started_at"])
+    }
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node["parent_id"])
+        if parent is None:
+            roots.append(node)
+        else:
+            parent["children"].append(node)
+    return roots
+
+
+class TraceRecorder:
+    """Keeps the spans from the last 'max_traces' traces."""
+
+    def __init__(self, max_traces=1000):
+        self.max_traces = max_traces
+        # trace id -> [span dict, ...]
+        self._traces = OrderedDict()
+        self._export = None
+
+    def export_to(self, write_line):
+        """Also pass every finished trace to 'write_line', as a line of JSON.
+
+        This is called from inside the event loop, so it shouldn't block;
+        e.g. use a Logger's 'write_line', and run its writer."""
+        self._export = write_line
+
+    def close(self):
+        self._export = None
+
+    def record(self, trace_id, spans):
+        # Most recently finished goes last
+        self._traces[trace_id] = self._traces.pop(trace_id, []) + spans
+        while len(self._traces) > self.max_traces:
+            self._traces.popitem(last=False)
+        if self._export is not None:
+            line = json.dumps(
+                {"trace_id": trace_id, "spans": spans}, default=str
+            )
+            self._export(line)
+
+    def get(self, trace_id):
+        return self._traces.get(trace_id)
+
+    def recent(self, count=100):
+        """[(trace_id, spans), ...] for the most recently finished traces."""
+        items = list(self._traces.items())[-count:]
+        items.reverse()
+        return items
+
+
+RECORDER = TraceRecorder()
@@ -2,6 +2,7 @@ import pytest
 import psycopg2
 import os
 import random
+import snekomatic.db
 
 # Enable pytest-trio's "trio mode"
 from pytest_trio.enable_trio_mode import *
@@ -28,6 +29,7 @@ def heroku_style_pg():
             cur.execute(f"CREATE DATABASE {test_db_name};")
     os.environ["DATABASE_URL"] = f"{BASE_DATABASE_URL}/{test_db_name}"
     yield
+    snekomatic.db.dispose_engine()
     del os.environ["DATABASE_URL"]
     with psycopg2.connect(BASE_DATABASE_URL) as conn:
         conn.autocommit = True
@@ -0,0 +1,341 @@
+"""A fake Github API, so handlers can run without a network or credentials.
+
+It's a transport (see snekomatic.gh.AsksTransport), so pass it as
+GithubApp(session=FakeGithub()) and the real client code runs unchanged.
+It implements just the endpoints snekomatic uses, and records what happened
+so tests and benchmarks can check.
+
+It tries to misbehave like the real thing, too:
+
+- Every endpoint can have its own latency distribution: set
+  'latency[endpoint name]' (or 'latency["*"]' for everything else) to a
+  function returning seconds, like
+  functools.partial(rng.lognormvariate, -3, 0.5).
+
+- Each set of credentials (the app's JWT, or an installation's token) has a
+  rate limit budget, reported in x-ratelimit-* headers and at /rate_limit.
+  Once it's used up, requests get 403s until the budget resets.
+
+- GET responses have ETags, and conditional requests that match get a 304,
+  which (like on Github) doesn't count against the rate limit.
+
+- Errors can be injected: fail_next() and secondary_rate_limit_next() for
+  specific requests, or 'error_rate' and 'secondary_rate_limit_rate' (endpoint
+  name or "*" -> probability) for background noise.
+"""
+from collections import Counter, defaultdict
+import datetime
+import hashlib
+import json
+import random
+import re
+import secrets
+import time
+import urllib.parse
+
+import anyio
+
+SECONDARY_RATE_LIMIT_MESSAGE = (
+    "You have exceeded a secondary rate limit. Please wait a few minutes "
+    "before you try again."
+)
+
+
+def _lookup(settings, endpoint, default):
+    # Per-endpoint settings, with "*" for all the other endpoints
+    return settings.get(endpoint, settings.get("*", default))
+
+
+class FakeGithub:
+    def __init__(self, *, rate_limit=5000, rate_limit_window=3600, rng=None):
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.rng = random.Random(0) if rng is None else rng
+        # endpoint name or "*" -> function returning seconds
+        self.latency = {}
+        # endpoint name or "*" -> probability of a 502 / a secondary rate
+        # limit
+        self.error_rate = {}
+        self.secondary_rate_limit_rate = {}
+
+        # endpoint name -> number of requests
+        self.calls = Counter()
+        # endpoint name -> number of requests answered with a 304
+        self.not_modified = Counter()
+        # endpoint name -> number of injected errors
+        self.errors = Counter()
+
+        # installation id -> org login
+        self.installations = {}
+        # org -> {login: "active" or "pending"}
+        self.orgs = defaultdict(dict)
+        # [(url path, body), ...]
+        self.comments = []
+        self.reactions = []
+
+        # token -> installation id
+        self._tokens = {}
+        # "app" or installation id -> [remaining, reset_at]
+        self._budgets = {}
+        # [(endpoint name or None, status, headers, data), ...]
+        self._faults = []
+
+        org = r"/orgs/(?P<org>[^/]+)"
+        membership = org + r"/memberships/(?P<username>[^/]+)"
+        self._endpoints = [
+            (
+                "access_tokens",
+                "POST",
+                r"/app/installations/(?P<installation_id>[^/]+)"
+                r"/access_tokens",
+                self._access_token,
+            ),
+            ("installations", "GET", r"/app/installations", self._list),
+            ("app", "GET", r"/app", self._app),
+            ("rate_limit", "GET", r"/rate_limit", self._rate_limit),
+            ("memberships", "GET", membership, self._get_membership),
+            ("memberships", "PUT", membership, self._put_membership),
+            ("members", "GET", org + r"/members", self._list),
+            ("invitations", "GET", org + r"/invitations", self._list),
+            (
+                "comments",
+                "POST",
+                r"/repos/[^/]+/[^/]+/(issues|pulls)/.*/(comments|replies)",
+                self._comment,
+            ),
+            (
+                "reactions",
+                "POST",
+                r"/repos/[^/]+/[^/]+/.*/reactions",
+                self._reaction,
+            ),
+        ]
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def fail_next(self, endpoint=None, *, status=502, count=1):
+        """Make the next 'count' requests to 'endpoint' (or to anything, if
+        None) fail with a server error."""
+        for _ in range(count):
+            self._faults.append(
+                (endpoint, status, {}, {"message": "Server Error"})
+            )
+
+    def secondary_rate_limit_next(
+        self, endpoint=None, *, retry_after=60, count=1
+    ):
+        """Make the next 'count' requests to 'endpoint' (or to anything, if
+        None) hit a secondary rate limit."""
+        for _ in range(count):
+            self._faults.append(
+                (
+                    endpoint,
+                    403,
+                    {"retry-after": str(retry_after)},
+                    {"message": SECONDARY_RATE_LIMIT_MESSAGE},
+                )
+            )
+
+    async def request(self, method, url, headers, body):
+        path = urllib.parse.urlsplit(url).path
+        for name, endpoint_method, pattern, handler in self._endpoints:
+            if method != endpoint_method:
+                continue
+            match = re.fullmatch(pattern, path)
+            if match is not None:
+                break
+        else:
+            self.calls["not_found"] += 1
+            return self._respond(404, {"message": "Not Found"})
+
+        self.calls[name] += 1
+        latency = _lookup(self.latency, name, None)
+        if latency is not None:
+            await anyio.sleep(latency())
+
+        identity = self._identify(headers.get("authorization"))
+        if identity is None:
+            return self._respond(401, {"message": "Bad credentials"})
+        # Like Github, /app endpoints need the app's JWT, and everything else
+        # (except /rate_limit) needs an installation token
+        wants_app = path.startswith("/app")
+        if name != "rate_limit" and (identity == "app") != wants_app:
+            return self._respond(401, {"message": "Wrong credentials"})
+
+        fault = self._fault_for(name)
+        if fault is not None:
+            self.errors[name] += 1
+            status, extra_headers, data = fault
+            return self._respond(status, data, extra_headers)
+
+        # Checking the rate limit doesn't count against it, and neither do
+        # 304s
+        budget = self._budget(identity)
+        counted = name != "rate_limit"
+        if counted and budget[0] <= 0:
+            return self._respond(
+                403,
+                {"message": f"API rate limit exceeded for {identity}."},
+                self._rate_limit_headers(budget),
+            )
+
+        data = json.loads(body) if body else None
+        response = handler(url, data, identity, **match.groupdict())
+        if len(response) == 2:
+            status, data = response
+            extra_headers = {}
+        else:
+            status, data, extra_headers = response
+        not_modified = False
+        if method == "GET" and status == 200:
+            raw = json.dumps(data, sort_keys=True).encode("utf-8")
+            extra_headers["etag"] = f'"{hashlib.sha1(raw).hexdigest()}"'
+            if headers.get("if-none-match") == extra_headers["etag"]:
+                self.not_modified[name] += 1
+                not_modified = True
+                counted = False
+        if counted:
+            budget[0] -= 1
+        extra_headers.update(self._rate_limit_headers(budget))
+        if not_modified:
+            return 304, extra_headers, b""
+        return self._respond(status, data, extra_headers)
+
+    def _identify(self, authorization):
+        # Returns "app", an installation id, or None if the credentials are
+        # no good
+        if authorization is None:
+            return None
+        scheme, _, credentials = authorization.partition(" ")
+        if scheme.lower() == "bearer":
+            # We don't check the JWT's signature
+            return "app"
+        return self._tokens.get(credentials)
+
+    def _fault_for(self, name):
+        for i, (endpoint, status, headers, data) in enumerate(self._faults):
+            if endpoint is None or endpoint == name:
+                del self._faults[i]
+                return status, headers, data
+        if self.rng.random() < _lookup(self.error_rate, name, 0):
+            return 502, {}, {"message": "Server Error"}
+        if self.rng.random() < _lookup(
+            self.secondary_rate_limit_rate, name, 0
+        ):
+            return (
+                403,
+                {"retry-after": "60"},
+                {"message": SECONDARY_RATE_LIMIT_MESSAGE},
+            )
+        return None
+
+    def _budget(self, identity):
+        now = time.time()
+        budget = self._budgets.get(identity)
+        if budget is None or budget[1] <= now:
+            budget = [self.rate_limit, int(now) + self.rate_limit_window]
+            self._budgets[identity] = budget
+        return budget
+
+    def _rate_limit_headers(self, budget):
+        remaining, reset_at = budget
+        return {
+            "x-ratelimit-limit": str(self.rate_limit),
+            "x-ratelimit-remaining": str(remaining),
+            "x-ratelimit-used": str(self.rate_limit - remaining),
+            "x-ratelimit-reset": str(reset_at),
+        }
+
+    def _respond(self, status, data, extra_headers=None):
+        headers = {"content-type": "application/json; charset=utf-8"}
+        if extra_headers is not None:
+            headers.update(extra_headers)
+        body = b"" if data is None else json.dumps(data).encode("utf-8")
+        return status, headers, body
+
+    def _page(self, url, items):
+        # Github-style pagination, with a Link header pointing to the next
+        # page if there is one
+        parts = urllib.parse.urlsplit(url)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        per_page = int(query.get("per_page", 30))
+        page = int(query.get("page", 1))
+        start = (page - 1) * per_page
+        headers = {}
+        if start + per_page < len(items):
+            query["page"] = str(page + 1)
+            next_url = parts._replace(
+                query=urllib.parse.urlencode(query)
+            ).geturl()
+            headers["link"] = f'<{next_url}>; rel="next"'
+        return 200, items[start : start + per_page], headers
+
+    def _list(self, url, data, caller, org=None):
+        path = urllib.parse.urlsplit(url).path
+        if path == "/app/installations":
+            items = [
+                {
+                    "id": installation_id,
+                    "account": {"login": login, "type": "Organization"},
+                }
+                for installation_id, login in self.installations.items()
+            ]
+        elif path.endswith("/members"):
+            items = [
+                {"login": login}
+                for login, state in sorted(self.orgs[org].items())
+                if state == "active"
+            ]
+        else:
+            items = [
+                {"login": login}
+                for login, state in sorted(self.orgs[org].items())
+                if state == "pending"
+            ]
+        return self._page(url, items)
+
+    def _access_token(self, url, data, caller, installation_id):
+        token = f"fake-token-{secrets.token_hex(8)}"
+        self._tokens[token] = installation_id
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        return (
+            201,
+            {
+                "token": token,
+                "expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            },
+        )
+
+    def _app(self, url, data, caller):
+        return 200, {"id": 1, "slug": "fake-snekomatic"}
+
+    def _rate_limit(self, url, data, caller):
+        remaining, reset_at = self._budget(caller)
+        rate = {
+            "limit": self.rate_limit,
+            "remaining": remaining,
+            "reset": reset_at,
+        }
+        return 200, {"resources": {"core": rate}, "rate": rate}
+
+    def _get_membership(self, url, data, caller, org, username):
+        state = self.orgs[org].get(username)
+        if state is None:
+            return 404, {"message": "Not Found"}
+        return 200, {"state": state, "role": "member"}
+
+    def _put_membership(self, url, data, caller, org, username):
+        state = self.orgs[org].setdefault(username, "pending")
+        return 200, {"state": state, "role": data["role"]}
+
+    def _comment(self, url, data, caller):
+        path = urllib.parse.urlsplit(url).path
+        self.comments.append((path, data["body"]))
+        return 201, {"id": len(self.comments), "body": data["body"]}
+
+    def _reaction(self, url, data, caller):
+        path = urllib.parse.urlsplit(url).path
+        self.reactions.append((path, data["content"]))
+        return 201, {"id": len(self.reactions), "content": data["content"]}
@@ -1,13 +1,18 @@
 import pytest
 import os
+import trio
 import asks
 import pendulum
 import attr
 import urllib.parse
+import datetime
+import http
 import json
+import gidgethub
 
+import snekomatic.app
 from snekomatic.app import main
-from snekomatic.db import SentInvitation
+from snekomatic.db import SentInvitation, OrgMembers
 from snekomatic.gh import GithubApp, BaseGithubClient
 from .util import fake_webhook, save_environ
 from .credentials import *
@@ -31,6 +36,46 @@ async def test_main_smoke(our_app_url):
     assert "Hi!" in response.text
 
 
+async def test_ready(our_app_url):
+    ready_url = urllib.parse.urljoin(our_app_url, "ready")
+    while True:
+        response = await asks.get(ready_url)
+        if response.status_code == 200:
+            break
+        assert response.status_code == 503
+        await trio.sleep(0.1)
+    assert response.text == "ready"
+
+
+async def test_status_and_metrics(our_app_url):
+    headers, body = fake_webhook("ping", {}, TEST_WEBHOOK_SECRET)
+    response = await asks.post(
+        urllib.parse.urljoin(our_app_url, "webhook/github"),
+        headers=headers,
+        data=body,
+    )
+    assert response.status_code == 200
+
+    response = await asks.get(urllib.parse.urljoin(our_app_url, "status"))
+    status = response.json()
+    assert status["webhook_workers_running"] is False
+    assert "rate_limits" in status
+    assert "loop_stalls" in status
+
+    response = await asks.get(urllib.parse.urljoin(our_app_url, "metrics"))
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "snekomatic_webhook_ack_seconds_count" in response.text
+    assert "snekomatic_webhook_done_seconds_count" in response.text
+    assert "snekomatic_db_query_seconds" in response.text
+    assert "snekomatic_loop_lag_seconds" in response.text
+
+    # Not enabled without DEBUG_TRACES
+    response = await asks.get(
+        urllib.parse.urljoin(our_app_url, "debug/traces")
+    )
+    assert response.status_code == 404
+
+
 @attr.s(frozen=True)
 class InviteScenario:
     pr_merged = attr.ib()
@@ -121,7 +166,7 @@ async def test_invite_scenarios(s, our_app_url, monkeypatch):
 
     # Set up database
     if s.in_db:
-        SentInvitation.add(PR_CREATOR)
+        await SentInvitation.add(PR_CREATOR)
 
     # Faking the Github API
     async def fake_token_for(self, installation_id):
@@ -166,4 +211,70 @@ async def test_invite_scenarios(s, our_app_url, monkeypatch):
     # Checks
     assert did_invite == did_comment
     assert did_invite == s.expect_invite
-    assert (SentInvitation.contains(PR_CREATOR)) == s.expect_in_db_after
+    in_db_after = await SentInvitation.contains(PR_CREATOR)
+    assert in_db_after == s.expect_in_db_after
+
+
+class FakeOrgClient:
+    def __init__(self, members, invitations):
+        self.members = members
+        self.invitations = invitations
+        self.lookups = []
+
+    async def getiter(self, url, url_vars):
+        assert url_vars == {"org": "acme"}
+        if url.startswith("/orgs/{org}/members"):
+            for login in self.members:
+                yield {"login": login}
+        else:
+            assert url.startswith("/orgs/{org}/invitations")
+            for login in self.invitations:
+                yield {"login": login}
+
+    async def getitem(self, url, url_vars):
+        self.lookups.append(url_vars["username"])
+        if url_vars["username"] in self.members:
+            return {"state": "active"}
+        raise gidgethub.BadRequest(http.HTTPStatus(404))
+
+
+async def test_org_member_mirror(heroku_style_pg, monkeypatch):
+    gh_client = FakeOrgClient(["julia"], ["bob", None])
+    cached_member_state = snekomatic.app._cached_member_state
+
+    # Without a mirror, we always ask Github
+    assert await cached_member_state(gh_client, "acme", "julia") == "active"
+    assert gh_client.lookups == ["julia"]
+
+    monkeypatch.setattr(snekomatic.app, "org_member_sync_interval", 3600)
+    await snekomatic.app._sync_org_members(gh_client, "acme")
+    gh_client.lookups.clear()
+    assert await cached_member_state(gh_client, "acme", "julia") == "active"
+    assert await cached_member_state(gh_client, "acme", "bob") == "pending"
+    assert not gh_client.lookups
+    # People who aren't in a fresh mirror aren't members
+    assert await cached_member_state(gh_client, "acme", "eve") is None
+    assert not gh_client.lookups
+
+    # Webhooks keep the mirror up to date
+    await snekomatic.app.organization_membership_changed(
+        "organization",
+        {
+            "action": "member_removed",
+            "organization": {"login": "acme"},
+            "membership": {"user": {"login": "julia"}},
+        },
+        gh_client,
+    )
+    hour = datetime.timedelta(hours=1)
+    assert await OrgMembers.state("acme", "julia", max_age=hour) == (
+        True,
+        None,
+    )
+    assert await cached_member_state(gh_client, "acme", "julia") is None
+    assert not gh_client.lookups
+
+    # A stale mirror isn't trusted
+    monkeypatch.setattr(snekomatic.app, "org_member_sync_interval", 0)
+    assert await cached_member_state(gh_client, "acme", "julia") == "active"
+    assert gh_client.lookups == ["julia"]
@@ -1,18 +1,77 @@
 import os
+import datetime
 import psycopg2
 import pytest
-from snekomatic.db import SentInvitation
+import pendulum
+from cryptography.fernet import Fernet
+import snekomatic.db
+from snekomatic.db import (
+    SentInvitation,
+    WebhookJob,
+    DB_STATS,
+    InstallationTokenStore,
+    WebhookDeliveryStore,
+    OrgMembers,
+    prepare_database,
+)
 
 
-def test_SentInvitation(heroku_style_pg):
-    assert not SentInvitation.contains("foo")
-    assert not SentInvitation.contains("bar")
-    SentInvitation.add("foo")
-    assert SentInvitation.contains("foo")
-    assert not SentInvitation.contains("bar")
+async def test_SentInvitation(heroku_style_pg):
+    calls_before = DB_STATS.calls
+    assert not await SentInvitation.contains("foo")
+    assert not await SentInvitation.contains("bar")
+    await SentInvitation.add("foo")
+    assert await SentInvitation.contains("foo")
+    assert not await SentInvitation.contains("bar")
+    # Only the initial load and the insert actually hit the database; the
+    # rest were answered from the in-memory copy
+    assert DB_STATS.calls == calls_before + 2
 
 
-def test_consistency_check(heroku_style_pg):
+async def test_SentInvitation_other_process(heroku_style_pg):
+    assert not await SentInvitation.contains("foo")
+
+    # Some other process adds an entry behind our backs
+    with psycopg2.connect(os.environ["DATABASE_URL"]) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO persistent_set_sent_invitation VALUES ('foo');"
+            )
+
+    # Adding it again is harmless
+    await SentInvitation.add("foo")
+    assert await SentInvitation.contains("foo")
+
+    with psycopg2.connect(os.environ["DATABASE_URL"]) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO persistent_set_sent_invitation VALUES ('bar');"
+            )
+
+    # We don't notice right away...
+    assert not await SentInvitation.contains("bar")
+    # ...but we do once our copy gets old enough
+    snekomatic.db._sent_invitation_cache.loaded_at -= (
+        snekomatic.db.SENT_INVITATION_MAX_AGE
+    )
+    assert await SentInvitation.contains("bar")
+
+
+async def test_prepare_database(heroku_style_pg, capsys):
+    await prepare_database()
+    assert "Migrating database" in capsys.readouterr().out
+    # Calling it again is a no-op
+    await prepare_database()
+    assert capsys.readouterr().out == ""
+
+    # A fresh process can tell that the database is already up to date, and
+    # skips the checks
+    snekomatic.db.dispose_engine()
+    await prepare_database()
+    assert "skipping checks" in capsys.readouterr().out
+
+
+async def test_consistency_check(heroku_style_pg):
     with psycopg2.connect(os.environ["DATABASE_URL"]) as conn:
         conn.autocommit = True
         with conn.cursor() as cur:
@@ -20,6 +79,181 @@ def test_consistency_check(heroku_style_pg):
 
     # Now any attempt to access the database should raise an exception
     with pytest.raises(RuntimeError):
-        SentInvitation.contains("foo")
+        await SentInvitation.contains("foo")
     with pytest.raises(RuntimeError):
-        SentInvitation.add("foo")
+        await SentInvitation.add("foo")
+
+
+async def test_WebhookJob(heroku_style_pg):
+    assert await WebhookJob.claim(10) == []
+
+    first = await WebhookJob.push(
+        "delivery-1", "pull_request", {"action": "opened"}
+    )
+    second = await WebhookJob.push(
+        "delivery-2", "issues", {"action": "closed"}
+    )
+    assert await WebhookJob.counts() == {"pending": 2, "dead": 0}
+
+    # Concurrent claimers get disjoint jobs, in FIFO order
+    [job1] = await WebhookJob.claim(1)
+    [job2] = await WebhookJob.claim(1)
+    assert await WebhookJob.claim(10) == []
+    assert (job1.id, job2.id) == (first, second)
+    assert job1.delivery_id == "delivery-1"
+    assert job1.event_type == "pull_request"
+    assert job1.payload == {"action": "opened"}
+    assert job1.attempts == 1
+
+    await WebhookJob.complete(job1)
+    assert await WebhookJob.counts() == {"pending": 1, "dead": 0}
+
+    # Failed jobs back off before they can be retried
+    assert not await WebhookJob.fail(job2, "oops")
+    assert await WebhookJob.claim(10) == []
+    assert await WebhookJob.counts() == {"pending": 1, "dead": 0}
+
+
+async def test_WebhookJob_lease_expiry(heroku_style_pg):
+    await WebhookJob.push("delivery-1", "ping", {})
+    # A worker claims the job and then dies without finishing it
+    [job] = await WebhookJob.claim(10, lease=datetime.timedelta(0))
+    # Once the lease runs out, someone else picks it up
+    [retried] = await WebhookJob.claim(10)
+    assert retried.id == job.id
+    assert retried.attempts == 2
+    # The first worker finds out it lost the job
+    assert not await WebhookJob.renew(job)
+    assert await WebhookJob.renew(retried)
+    assert await WebhookJob.claim(10) == []
+
+
+async def test_WebhookJob_dead_letter(heroku_style_pg):
+    await WebhookJob.push("delivery-1", "ping", {})
+    [job] = await WebhookJob.claim(10)
+    assert await WebhookJob.fail(job, "oops", max_attempts=1)
+    assert await WebhookJob.counts() == {"pending": 0, "dead": 1}
+
+
+async def test_InstallationTokenStore(heroku_style_pg):
+    store = InstallationTokenStore(Fernet.generate_key())
+    assert await store.get(1234) is None
+
+    expires_at = pendulum.now().add(hours=1)
+    await store.put(1234, "super-secret", expires_at)
+    token, got_expires_at = await store.get(1234)
+    assert token == "super-secret"
+    assert abs((got_expires_at - expires_at).total_seconds()) < 1
+
+    # Overwriting works
+    await store.put(1234, "even-more-secret", expires_at)
+    assert (await store.get(1234))[0] == "even-more-secret"
+
+    # It's not stored in plaintext
+    with psycopg2.connect(os.environ["DATABASE_URL"]) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT encrypted_token FROM installation_token;")
+            [(stored,)] = cur.fetchall()
+    assert "secret" not in stored
+
+    # And with the wrong key, we can't get it back
+    other_store = InstallationTokenStore(Fernet.generate_key())
+    assert await other_store.get(1234) is None
+
+
+async def test_InstallationTokenStore_lock(heroku_style_pg):
+    store = InstallationTokenStore(Fernet.generate_key(), lock_timeout=0.5)
+
+    async with store.renewal_lock(1234) as locked:
+        assert locked
+        # Someone else can't get the same lock...
+        async with store.renewal_lock(1234) as locked2:
+            assert not locked2
+        # ...but they can get the lock for a different installation
+        async with store.renewal_lock(5678) as locked3:
+            assert locked3
+
+    # After it's released, we can get it again
+    async with store.renewal_lock(1234) as locked:
+        assert locked
+
+
+async def test_WebhookDeliveryStore(heroku_style_pg):
+    store = WebhookDeliveryStore()
+    assert await store.claim("delivery-1")
+    # Someone else is working on it
+    assert not await WebhookDeliveryStore().claim("delivery-1")
+    # They failed, so it can be tried again
+    await store.release("delivery-1")
+    assert await store.claim("delivery-1")
+    await store.complete("delivery-1")
+    assert not await store.claim("delivery-1")
+    # Releasing a finished delivery doesn't do anything
+    await store.release("delivery-1")
+    assert not await store.claim("delivery-1")
+
+
+async def test_WebhookDeliveryStore_lease_and_ttl(heroku_style_pg):
+    # A process claims a delivery and then dies without finishing it
+    dying = WebhookDeliveryStore(lease=datetime.timedelta(0))
+    assert await dying.claim("delivery-1")
+    # Once the lease runs out, someone else can take over
+    assert await WebhookDeliveryStore(lease=datetime.timedelta(0)).claim(
+        "delivery-1"
+    )
+    await dying.complete("delivery-1")
+    # Finished deliveries are forgotten eventually
+    forgetful = WebhookDeliveryStore(ttl=datetime.timedelta(0))
+    assert await forgetful.claim("delivery-2")
+    assert await forgetful.claim("delivery-1")
+
+
+async def test_OrgMembers(heroku_style_pg):
+    hour = datetime.timedelta(hours=1)
+    # We don't know anything until we've synced
+    await OrgMembers.set_state("acme", "julia", "active")
+    assert await OrgMembers.state("acme", "julia", max_age=hour) == (
+        False,
+        "active",
+    )
+
+    await OrgMembers.replace("acme", {"Julia": "active", "bob": "pending"})
+    assert await OrgMembers.state("acme", "JULIA", max_age=hour) == (
+        True,
+        "active",
+    )
+    assert await OrgMembers.state("acme", "bob", max_age=hour) == (
+        True,
+        "pending",
+    )
+    assert await OrgMembers.state("acme", "eve", max_age=hour) == (True, None)
+    # Other orgs are separate
+    assert await OrgMembers.state("other", "bob", max_age=hour) == (
+        False,
+        None,
+    )
+
+    # Updates from webhooks
+    await OrgMembers.set_state("acme", "bob", "active")
+    await OrgMembers.set_state("acme", "Julia", None)
+    await OrgMembers.set_state("acme", "eve", "pending")
+    assert await OrgMembers.state("acme", "bob", max_age=hour) == (
+        True,
+        "active",
+    )
+    assert (await OrgMembers.state("acme", "julia", max_age=hour))[1] is None
+    assert await OrgMembers.state("acme", "eve", max_age=hour) == (
+        True,
+        "pending",
+    )
+
+    # Syncing replaces everything
+    await OrgMembers.replace("acme", {"carol": "active"})
+    assert (await OrgMembers.state("acme", "bob", max_age=hour))[1] is None
+
+    # Old copies aren't fresh
+    zero = datetime.timedelta(0)
+    assert await OrgMembers.state("acme", "carol", max_age=zero) == (
+        False,
+        "active",
+    )
@@ -3,22 +3,43 @@ import pytest
 import asks
 import attr
 from snekomatic.gh import (
+    AsksTransport,
     BaseGithubClient,
+    CacheStats,
     GithubApp,
+    GraphQLError,
+    GraphQLLookup,
+    LazyEvent,
+    RateLimitScheduler,
+    WebhookHandlerError,
+    WebhookQueueFull,
     reply_url,
     reaction_url,
     get_comment_body,
+    parse_commands,
+    _endpoint_name,
 )
 import gidgethub
 from gidgethub.sansio import accept_format
 from glom import glom
+from marko.ext.gfm import gfm
 import trio
+import trio.testing
 import pendulum
+import jwt
 import os
 import json
+import re
+import threading
+import time
+import urllib.parse
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 
-from .util import fake_webhook, save_environ
+from snekomatic.tracing import RECORDER, span_tree
+from .fake_github import FakeGithub
+from .util import fake_webhook, save_environ, sign_webhook
 from .credentials import *
 
 SAMPLE_DATA_DIR = Path(__file__).absolute().parent / "sample-data"
@@ -38,7 +59,242 @@ async def test_basic_gh_client():
         assert "rate" in data
 
 
+def test_asks_transport_pools_per_host():
+    transport = AsksTransport(connections_per_host=3)
+    a1 = transport._session_for("https://api.github.com/rate_limit")
+    a2 = transport._session_for("https://api.github.com/app")
+    b = transport._session_for("https://uploads.github.com/foo")
+    assert a1 is a2
+    assert a1 is not b
+
+    session = asks.Session()
+    transport = AsksTransport(session)
+    assert transport._session_for("https://api.github.com/app") is session
+    assert transport._session_for("https://example.com/") is session
+
+
+async def test_basic_gh_client_custom_transport():
+    class FakeTransport:
+        async def request(self, method, url, headers, body):
+            assert method == "GET"
+            assert url == "https://api.github.com/rate_limit"
+            return (
+                200,
+                {"content-type": "application/json"},
+                b'{"rate": {}}',
+            )
+
+    gh = BaseGithubClient(FakeTransport(), requester=TEST_USER_AGENT)
+    assert await gh.getitem("/rate_limit") == {"rate": {}}
+
+
+async def test_rate_limit_scheduler(autojump_clock):
+    responses = []
+    sent_at = []
+
+    class FakeTransport:
+        async def request(self, method, url, headers, body):
+            sent_at.append(trio.current_time())
+            status_code, extra_headers = responses.pop(0)
+            headers = {"content-type": "application/json", **extra_headers}
+            return status_code, headers, b"{}"
+
+    def budget_headers(remaining):
+        return {
+            "x-ratelimit-limit": "100",
+            "x-ratelimit-remaining": str(remaining),
+            "x-ratelimit-reset": str(int(time.time()) + 600),
+        }
+
+    scheduler = RateLimitScheduler()
+
+    def client(priority):
+        return BaseGithubClient(
+            FakeTransport(),
+            requester=TEST_USER_AGENT,
+            scheduler=scheduler,
+            rate_limit_key="install",
+            priority=priority,
+        )
+
+    # Plenty of budget, so nothing waits
+    responses.append((200, budget_headers(50)))
+    await client("low").getitem("/")
+    assert scheduler.budgets["install"].remaining == 50
+    assert scheduler.budgets["install"].limit == 100
+
+    # Running low: normal requests still go straight through...
+    responses.append((200, budget_headers(10)))
+    await client("normal").getitem("/")
+    start = trio.current_time()
+    responses.append((200, budget_headers(9)))
+    await client("normal").getitem("/")
+    assert sent_at[-1] == start
+
+    # ...but low priority requests wait for the budget to reset
+    responses.append((200, budget_headers(100)))
+    await client("low").getitem("/")
+    assert sent_at[-1] - start > 500
+
+    # Secondary rate limits are honored, and the request retried
+    start = trio.current_time()
+    responses.append((403, {"retry-after": "30"}))
+    responses.append((200, budget_headers(99)))
+    assert await client("normal").getitem("/") == {}
+    assert sent_at[-2] == start
+    assert sent_at[-1] - start > 29
+    assert not responses
+
+
 # Some end-to-end tests for the full app's client functionality
+class FakeGraphQLTransport:
+    def __init__(self):
+        self.queries = []
+
+    async def request(self, method, url, headers, body):
+        assert method == "POST"
+        assert url == "https://api.github.com/graphql"
+        request = json.loads(body)
+        self.queries.append(request["query"])
+        data = {}
+        errors = []
+        # Answer each alias with its own variables. (The lookbehind skips
+        # declarations like "$login__q0: String!".)
+        for alias in re.findall(r"(?<![\w$])(q\d+): ", request["query"]):
+            suffix = f"__{alias}"
+            data[alias] = {
+                name[: -len(suffix)]: value
+                for name, value in request["variables"].items()
+                if name.endswith(suffix)
+            }
+            if data[alias].get("login") == "ghost":
+                data[alias] = None
+                errors.append({"message": "no ghosts", "path": [alias]})
+        response = {"data": data}
+        if errors:
+            response["errors"] = errors
+        headers = {
+            "content-type": "application/json",
+            "x-ratelimit-limit": "5000",
+            "x-ratelimit-remaining": "4999",
+            "x-ratelimit-reset": str(int(time.time()) + 600),
+        }
+        return 200, headers, json.dumps(response).encode("utf-8")
+
+
+USER_LOOKUP = GraphQLLookup(
+    "user(login: $login) { login name }", login="String!"
+)
+PR_LOOKUP = GraphQLLookup(
+    "repository(owner: $owner, name: $name) {"
+    " pullRequest(number: $number) { merged } }",
+    owner="String!",
+    name="String!",
+    number="Int!",
+)
+
+
+def test_graphql_lookup_needs_types():
+    with pytest.raises(ValueError):
+        GraphQLLookup("user(login: $login) { name }")
+
+
+async def test_graphql_batching(autojump_clock):
+    transport = FakeGraphQLTransport()
+    app = GithubApp(
+        session=transport,
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+    )
+
+    async def fake_token_for(installation_id):
+        return "xyzzy"
+
+    app.token_for = fake_token_for
+
+    results = {}
+    errors = {}
+
+    async def lookup(name, lookup, variables):
+        # Different clients for the same installation share a batcher
+        client = app.client_for("a")
+        try:
+            results[name] = await client.graphql_lookup(lookup, variables)
+        except GraphQLError as exc:
+            errors[name] = exc
+
+    async with trio.open_nursery() as nursery:
+        for login in ["julia", "ghost"]:
+            nursery.start_soon(lookup, login, USER_LOOKUP, {"login": login})
+        nursery.start_soon(
+            lookup,
+            "pr",
+            PR_LOOKUP,
+            {"owner": "python-trio", "name": "trio", "number": 1},
+        )
+
+    # All in one query, with the answers fanned back out
+    assert len(transport.queries) == 1
+    assert results == {
+        "julia": {"login": "julia"},
+        "pr": {"owner": "python-trio", "name": "trio", "number": 1},
+    }
+    # Errors only go to the lookup they're about
+    assert str(errors["ghost"]) == "no ghosts"
+    assert app._graphql_batchers["a"].stats.lookups == 3
+    assert app._graphql_batchers["a"].stats.queries == 1
+    # GraphQL has its own rate limit budget
+    assert app.rate_limits.budgets["a", "graphql"].remaining == 4999
+    assert "a" not in app.rate_limits.budgets
+
+    # Lookups that happen later go in a new batch
+    await lookup("bob", USER_LOOKUP, {"login": "bob"})
+    assert results["bob"] == {"login": "bob"}
+    assert len(transport.queries) == 2
+
+
+async def test_graphql_batching_leader_cancelled():
+    transport = FakeGraphQLTransport()
+    client = BaseGithubClient(transport, requester=TEST_USER_AGENT)
+    leader_scope = trio.CancelScope()
+    results = []
+
+    async def leader():
+        with leader_scope:
+            await client.graphql_lookup(USER_LOOKUP, {"login": "julia"})
+
+    async def follower():
+        results.append(
+            await client.graphql_lookup(USER_LOOKUP, {"login": "bob"})
+        )
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(leader)
+        await trio.testing.wait_all_tasks_blocked()
+        nursery.start_soon(follower)
+        await trio.testing.wait_all_tasks_blocked()
+        # The leader gets cancelled while it's waiting for others to join
+        leader_scope.cancel()
+
+    # So the follower sent its own query instead
+    assert results == [{"login": "bob"}]
+    assert len(transport.queries) == 1
+    assert "julia" not in json.dumps(transport.queries)
+
+
+async def test_graphql_query():
+    transport = FakeGraphQLTransport()
+    client = BaseGithubClient(transport, requester=TEST_USER_AGENT)
+    query = "query($login__q0: String!) { q0: user(login: $login__q0) { x } }"
+    assert await client.graphql(query, {"login__q0": "njsmith"}) == {
+        "q0": {"login": "njsmith"}
+    }
+    with pytest.raises(GraphQLError) as excinfo:
+        await client.graphql(query, {"login__q0": "ghost"})
+    assert len(excinfo.value.errors) == 1
+
+
 async def test_client_part_of_app():
     app = GithubApp(
         user_agent=TEST_USER_AGENT,
@@ -117,6 +373,130 @@ def test_app_envvar_fallback():
         assert app.webhook_secret == TEST_WEBHOOK_SECRET
 
 
+def test_app_jwt_is_cached():
+    app = GithubApp(app_id=TEST_APP_ID, private_key=TEST_PRIVATE_KEY)
+    token = app._app_jwt()
+    assert app._app_jwt() is token
+
+    claims = jwt.decode(token, verify=False)
+    assert claims["iss"] == TEST_APP_ID
+    # Github rejects tokens that last longer than this
+    assert claims["exp"] - claims["iat"] <= 10 * 60
+
+    # When the token is about to expire, we make a new one
+    soon = pendulum.now().add(seconds=10)
+    app._app_token.expires_at = soon
+    app._app_jwt()
+    assert app._app_token.expires_at > soon.add(minutes=5)
+
+
+class FakeTokenTransport:
+    def __init__(self):
+        self.issued = 0
+
+    async def request(self, method, url, headers, body):
+        assert method == "POST"
+        assert url.endswith("/access_tokens")
+        self.issued += 1
+        response = {
+            "token": f"token-{self.issued}",
+            "expires_at": pendulum.now().add(hours=1).to_iso8601_string(),
+        }
+        return (
+            201,
+            {"content-type": "application/json"},
+            json.dumps(response).encode("ascii"),
+        )
+
+
+async def test_token_refresher(nursery, autojump_clock):
+    transport = FakeTokenTransport()
+    app = GithubApp(
+        session=transport,
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+    )
+    assert await app.token_for("active") == "token-1"
+    assert await app.token_for("idle") == "token-2"
+    # "idle" hasn't been used in a while
+    app._installation_tokens["idle"].last_used -= 2 * 3600
+
+    nursery.start_soon(partial(app.run_token_refresher, interval=10))
+
+    # Nothing's close to expiring, so nothing happens
+    await trio.sleep(60)
+    assert transport.issued == 2
+
+    # Both tokens will expire soon, but only the active one gets renewed
+    soon = pendulum.now().add(minutes=3)
+    app._installation_tokens["active"].expires_at = soon
+    app._installation_tokens["idle"].expires_at = soon
+    await trio.sleep(60)
+    assert transport.issued == 3
+    assert app._installation_tokens["active"].token == "token-3"
+    assert app._installation_tokens["idle"].token == "token-2"
+    # ...and it happened before the token was needed
+    assert await app.token_for("active") == "token-3"
+    assert transport.issued == 3
+
+
+class FakeTokenStore:
+    def __init__(self):
+        self.tokens = {}
+        self.broken = False
+
+    async def get(self, installation_id):
+        if self.broken:
+            raise RuntimeError("database is down")
+        return self.tokens.get(installation_id)
+
+    async def put(self, installation_id, token, expires_at):
+        if self.broken:
+            raise RuntimeError("database is down")
+        self.tokens[installation_id] = (token, expires_at)
+
+    @asynccontextmanager
+    async def renewal_lock(self, installation_id):
+        yield True
+
+
+async def test_shared_token_store():
+    transport = FakeTokenTransport()
+    store = FakeTokenStore()
+
+    def make_app():
+        return GithubApp(
+            session=transport,
+            user_agent=TEST_USER_AGENT,
+            app_id=TEST_APP_ID,
+            private_key=TEST_PRIVATE_KEY,
+            token_store=store,
+        )
+
+    app1 = make_app()
+    app2 = make_app()
+
+    # The first process has to ask Github, and shares the result...
+    assert await app1.token_for("a") == "token-1"
+    assert store.tokens["a"][0] == "token-1"
+    # ...so the second process doesn't have to
+    assert await app2.token_for("a") == "token-1"
+    assert transport.issued == 1
+
+    # Stale tokens in the store are ignored
+    store.tokens["a"] = ("stale", pendulum.now().add(seconds=10))
+    assert await make_app().token_for("a") == "token-2"
+    assert store.tokens["a"][0] == "token-2"
+
+    # If the store breaks, we carry on without it
+    store.broken = True
+    assert await make_app().token_for("a") == "token-3"
+    # And tokens are still cached in memory
+    assert await app1.token_for("a") == "token-1"
+    assert transport.issued == 3
+
+
 async def test_github_app_webhook_routing(autojump_clock):
     app = GithubApp(
         user_agent=TEST_USER_AGENT,
@@ -142,7 +522,7 @@ async def test_github_app_webhook_routing(autojump_clock):
 
     with pytest.raises(TypeError):
 
-        @app.route("pull_request", action="created", user="njsmith")
+        @app.route("pull_request", action="created", where={"action": "x"})
         async def unnused(event_type, payload, client):  # pragma: no cover
             pass
 
@@ -250,6 +630,438 @@ async def test_github_app_webhook_routing(autojump_clock):
     record.clear()
 
 
+async def test_github_app_webhook_routing_restrictions(autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+
+    record = []
+    handlers = {}
+
+    def recorder(name):
+        async def handler(event_type, payload, client):
+            record.append(name)
+
+        handlers[handler] = name
+        return handler
+
+    app.add(recorder("any"), "pull_request")
+    app.add(
+        recorder("opened-in-trio"),
+        "pull_request",
+        action="opened",
+        where={"repository.full_name": "python-trio/trio"},
+    )
+    app.add(recorder("bot"), "pull_request", where={"sender.type": "Bot"})
+    app.add(
+        recorder("opened-by-njsmith"),
+        "pull_request",
+        action="opened",
+        where={"pull_request.user.login": "njsmith"},
+    )
+    app.add(
+        recorder("big"),
+        "pull_request",
+        where={"pull_request.additions": lambda n: n > 1000},
+    )
+    app.add(
+        recorder("labeled"),
+        "pull_request",
+        action=lambda action: action.endswith("labeled"),
+    )
+
+    async def deliver(payload):
+        record.clear()
+        payload["installation"] = {"id": TEST_INSTALLATION_ID}
+        await app.dispatch_webhook(
+            *fake_webhook("pull_request", payload, secret=TEST_WEBHOOK_SECRET)
+        )
+        return set(record)
+
+    assert await deliver(
+        {
+            "action": "opened",
+            "repository": {"full_name": "python-trio/trio"},
+            "sender": {"type": "Bot"},
+            "pull_request": {
+                "user": {"login": "njsmith"},
+                "additions": 5000,
+                # The built-in command route looks at this
+                "body": None,
+            },
+        }
+    ) == {"any", "opened-in-trio", "bot", "opened-by-njsmith", "big"}
+
+    assert await deliver(
+        {
+            "action": "opened",
+            "repository": {"full_name": "python-trio/snekomatic"},
+            "sender": {"type": "User"},
+            "pull_request": {
+                "user": {"login": "pquentin"},
+                "additions": 5,
+                "body": "/not-a-registered-command",
+            },
+        }
+    ) == {"any"}
+
+    assert await deliver({"action": "unlabeled", "pull_request": None}) == {
+        "any",
+        "labeled",
+    }
+
+    # Restrictions on missing fields never match
+    assert await deliver({}) == {"any"}
+
+    # Routes are found in registration order
+    routes = app._routes["pull_request"].match(
+        {"action": "labeled", "sender": {"type": "Bot"}}
+    )
+    assert [handlers[route.async_fn] for route in routes] == [
+        "any",
+        "bot",
+        "labeled",
+    ]
+    # Ours, plus the built-in one for commands in newly opened PRs
+    assert len(app._routes["pull_request"]) == 7
+
+
+def test_github_app_webhook_signatures():
+    app = GithubApp(webhook_secret=TEST_WEBHOOK_SECRET)
+    payload = {"action": "created", "installation": {"id": "xyzzy"}}
+    headers, body = fake_webhook("issue", payload, TEST_WEBHOOK_SECRET)
+    assert app.parse_webhook(headers, body).data == payload
+
+    # Either signature is enough on its own...
+    sha1_only = dict(headers)
+    del sha1_only["x-hub-signature-256"]
+    assert app.parse_webhook(sha1_only, body).data == payload
+    sha256_only = dict(headers)
+    del sha256_only["x-hub-signature"]
+    assert app.parse_webhook(sha256_only, body).data == payload
+
+    # ...but if there's a sha256 signature, it has to be right
+    bad_sha256 = dict(headers)
+    bad_sha256["x-hub-signature-256"] = sign_webhook(body, "nope", "sha256")
+    with pytest.raises(gidgethub.ValidationFailure):
+        app.parse_webhook(bad_sha256, body)
+
+    form_body = urllib.parse.urlencode({"payload": json.dumps(payload)})
+    form_body = form_body.encode("ascii")
+    form_headers = dict(headers)
+    form_headers["content-type"] = "application/x-www-form-urlencoded"
+    form_headers["x-hub-signature-256"] = sign_webhook(
+        form_body, TEST_WEBHOOK_SECRET, "sha256"
+    )
+    assert app.parse_webhook(form_headers, form_body).data == payload
+
+    text_headers = dict(headers)
+    text_headers["content-type"] = "text/plain"
+    with pytest.raises(gidgethub.BadRequest):
+        app.parse_webhook(text_headers, body)
+
+
+async def test_github_app_webhook_lazy_decoding(autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+
+    record = []
+
+    @app.route("pull_request", action="closed")
+    async def pull_request_closed(event_type, payload, client):
+        record.append(payload["number"])
+
+    def parse(event_type, payload):
+        return app.parse_webhook(
+            *fake_webhook(event_type, payload, TEST_WEBHOOK_SECRET)
+        )
+
+    installation = {"id": TEST_INSTALLATION_ID}
+    closed = {"action": "closed", "installation": installation}
+
+    # Nothing routes this event type, or this action, or anything without an
+    # installation, and we can tell without decoding the payload
+    for event in [
+        parse("check_run", closed),
+        parse("pull_request", {"action": "labeled", "installation": {}}),
+        parse("pull_request", {"action": "closed"}),
+    ]:
+        await app.process_event(event)
+        assert not event.decoded
+
+    # Payloads with the action somewhere else still work
+    event = parse(
+        "pull_request",
+        {"number": 1, "installation": installation, "action": "closed"},
+    )
+    assert app.might_route(event)
+    await app.process_event(event)
+    assert event.decoded
+    assert record == [1]
+
+
+async def test_github_app_webhook_queue(nursery, autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+
+    record = []
+    errors = []
+    app.error_handler = errors.append
+    unblock = trio.Event()
+
+    @app.route("pull_request")
+    async def handler(event_type, payload, client):
+        if payload["action"] == "block":
+            await unblock.wait()
+        if payload["action"] == "explode":
+            raise ValueError("kaboom")
+        record.append(payload["action"])
+
+    def webhook(action):
+        return fake_webhook(
+            "pull_request",
+            {"action": action, "installation": {"id": "xyzzy"}},
+            secret=TEST_WEBHOOK_SECRET,
+        )
+
+    # Can't enqueue before the workers are running
+    assert not app.webhook_workers_running
+    with pytest.raises(RuntimeError):
+        await app.enqueue_webhook(*webhook("created"))
+
+    nursery.start_soon(partial(app.run_webhook_workers, 1, queue_size=1))
+    await trio.testing.wait_all_tasks_blocked()
+    assert app.webhook_workers_running
+
+    # Bad signatures are still rejected synchronously
+    with pytest.raises(gidgethub.ValidationFailure):
+        await app.enqueue_webhook(
+            *fake_webhook("pull_request", {}, secret="trust me")
+        )
+
+    # Occupy the only worker
+    await app.enqueue_webhook(*webhook("block"))
+    await trio.sleep(5)
+    assert app.webhook_queue_stats.depth == 0
+
+    # This one has to wait in the queue...
+    await app.enqueue_webhook(*webhook("explode"))
+    assert app.webhook_queue_stats.depth == 1
+    # ...and now the queue is full
+    with pytest.raises(WebhookQueueFull):
+        await app.enqueue_webhook(*webhook("dropped"))
+    assert not record
+
+    unblock.set()
+    await trio.sleep(5)
+    assert record == ["block"]
+    assert len(errors) == 1
+    assert isinstance(errors[0], ValueError)
+
+    # The worker survives the failure and keeps going
+    await app.enqueue_webhook(*webhook("synchronize"))
+    await trio.sleep(5)
+    assert record == ["block", "synchronize"]
+
+    stats = app.webhook_queue_stats
+    assert stats.enqueued == 3
+    assert stats.processed == 2
+    assert stats.failed == 1
+    assert stats.depth == 0
+    assert stats.max_wait > 0
+
+
+async def test_github_app_route_isolation(autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        route_timeout=100,
+    )
+    errors = []
+    app.error_handler = errors.append
+    finished = []
+
+    @app.route("pull_request")
+    async def slow(event_type, payload, client):
+        await trio.sleep(10)
+        finished.append("slow")
+
+    @app.route("pull_request")
+    async def also_slow(event_type, payload, client):
+        await trio.sleep(10)
+        finished.append("also_slow")
+
+    @app.route("pull_request")
+    async def broken(event_type, payload, client):
+        raise ValueError("oops")
+
+    @app.route("pull_request", timeout=5)
+    async def stuck(event_type, payload, client):
+        await trio.sleep_forever()
+
+    start = trio.current_time()
+    with pytest.raises(WebhookHandlerError) as exc_info:
+        await app.dispatch_webhook(
+            *fake_webhook(
+                "pull_request",
+                {"installation": {"id": "xyzzy"}},
+                secret=TEST_WEBHOOK_SECRET,
+            )
+        )
+    # Handlers ran concurrently (1 second is the eventual-consistency delay)
+    assert trio.current_time() - start == pytest.approx(11)
+    # The failures didn't stop the other handlers
+    assert sorted(finished) == ["also_slow", "slow"]
+    # Each failure was reported separately
+    assert len(errors) == 2
+    assert exc_info.value.errors == errors
+    assert {type(error) for error in errors} == {ValueError, TimeoutError}
+
+    stats = app.route_stats
+    assert stats[slow.__qualname__].calls == 1
+    assert stats[slow.__qualname__].failures == 0
+    assert stats[slow.__qualname__].max_time > 0
+    assert stats[broken.__qualname__].failures == 1
+    assert stats[stuck.__qualname__].failures == 1
+
+
+class FakeDeliveryStore:
+    def __init__(self):
+        # delivery id -> "claimed" or "done"
+        self.deliveries = {}
+        self.broken = False
+
+    async def claim(self, delivery_id):
+        if self.broken:
+            raise RuntimeError("database is on fire")
+        if delivery_id in self.deliveries:
+            return False
+        self.deliveries[delivery_id] = "claimed"
+        return True
+
+    async def complete(self, delivery_id):
+        self.deliveries[delivery_id] = "done"
+
+    async def release(self, delivery_id):
+        del self.deliveries[delivery_id]
+
+
+async def test_github_app_webhook_deduplication(autojump_clock):
+    store = FakeDeliveryStore()
+
+    def make_app():
+        app = GithubApp(
+            user_agent=TEST_USER_AGENT,
+            app_id=TEST_APP_ID,
+            private_key=TEST_PRIVATE_KEY,
+            webhook_secret=TEST_WEBHOOK_SECRET,
+            delivery_store=store,
+        )
+        app.add(handler, "pull_request")
+        return app
+
+    calls = []
+    fail = False
+
+    async def handler(event_type, payload, client):
+        calls.append(payload["number"])
+        await trio.sleep(1)
+        if fail:
+            raise ValueError("oops")
+
+    app1 = make_app()
+    app2 = make_app()
+    webhook = fake_webhook(
+        "pull_request",
+        {"number": 1, "installation": {"id": "xyzzy"}},
+        secret=TEST_WEBHOOK_SECRET,
+    )
+
+    # Duplicates arriving at the same time, in the same process or another
+    # one, only run the handlers once
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(app1.dispatch_webhook, *webhook)
+        nursery.start_soon(app1.dispatch_webhook, *webhook)
+        nursery.start_soon(app2.dispatch_webhook, *webhook)
+    assert calls == [1]
+    delivery_id = webhook[0]["x-github-delivery"]
+    assert store.deliveries[delivery_id] == "done"
+
+    # Later redeliveries are ignored too
+    await app2.dispatch_webhook(*webhook)
+    assert calls == [1]
+
+    # Failed deliveries can be redelivered
+    calls.clear()
+    fail = True
+    webhook = fake_webhook(
+        "pull_request",
+        {"number": 2, "installation": {"id": "xyzzy"}},
+        secret=TEST_WEBHOOK_SECRET,
+    )
+    with pytest.raises(WebhookHandlerError):
+        await app1.dispatch_webhook(*webhook)
+    assert not store.deliveries.get(webhook[0]["x-github-delivery"])
+    fail = False
+    await app2.dispatch_webhook(*webhook)
+    assert calls == [2, 2]
+
+    # If the store breaks, we process deliveries anyway
+    store.broken = True
+    await make_app().dispatch_webhook(*webhook)
+    assert calls == [2, 2, 2]
+
+    # Unless we know they're duplicates
+    await app2.dispatch_webhook(*webhook)
+    assert calls == [2, 2, 2]
+
+
+async def test_github_app_route_max_concurrency(autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+    running = 0
+    max_running = 0
+
+    @app.route("pull_request", max_concurrency=2)
+    async def handler(event_type, payload, client):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await trio.sleep(10)
+        running -= 1
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(5):
+            nursery.start_soon(
+                app.dispatch_webhook,
+                *fake_webhook(
+                    "pull_request",
+                    {"installation": {"id": "xyzzy"}},
+                    secret=TEST_WEBHOOK_SECRET,
+                ),
+            )
+
+    assert max_running == 2
+    assert app.route_stats[handler.__qualname__].calls == 5
+
+
 async def test_github_app_webhook_client_works():
     app = GithubApp(
         user_agent=TEST_USER_AGENT,
@@ -280,6 +1092,205 @@ async def test_github_app_webhook_client_works():
     assert handler_ran
 
 
+async def test_github_app_conditional_request_cache(monkeypatch):
+    requests = []
+
+    class FakeTransport:
+        async def request(self, method, url, headers, body):
+            requests.append(headers)
+            token = headers["authorization"].split()[-1]
+            etag = f'"etag-for-{token}"'
+            if headers.get("if-none-match") == etag:
+                return 304, {"etag": etag}, b""
+            return (
+                200,
+                {"content-type": "application/json", "etag": etag},
+                json.dumps({"token": token}).encode("ascii"),
+            )
+
+    app = GithubApp(
+        session=FakeTransport(),
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+
+    async def fake_token_for(self, installation_id):
+        return f"token-{installation_id}"
+
+    monkeypatch.setattr(GithubApp, "token_for", fake_token_for)
+
+    client_a = app.client_for("a")
+    assert await client_a.getitem("/thing") == {"token": "token-a"}
+    assert "if-none-match" not in requests[-1]
+    assert app.cache_stats == CacheStats(hits=0, misses=1, not_modified=0)
+
+    # Second time around, we revalidate and get a 304
+    assert await client_a.getitem("/thing") == {"token": "token-a"}
+    assert requests[-1]["if-none-match"] == '"etag-for-token-a"'
+    assert app.cache_stats == CacheStats(hits=1, misses=1, not_modified=1)
+
+    # A different installation doesn't see installation a's cached data
+    client_b = app.client_for("b")
+    assert await client_b.getitem("/thing") == {"token": "token-b"}
+    assert "if-none-match" not in requests[-1]
+    assert app.cache_stats == CacheStats(hits=1, misses=2, not_modified=1)
+
+
+async def test_fake_github(autojump_clock):
+    fake = FakeGithub(rate_limit=10)
+    app = GithubApp(
+        session=fake,
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+    client = app.client_for(TEST_INSTALLATION_ID)
+    alice = "/orgs/some-org/memberships/alice"
+    bob = "/orgs/some-org/memberships/bob"
+
+    # Memberships are stateful
+    fake.orgs["some-org"]["alice"] = "active"
+    assert glom(await client.getitem(alice), "state") == "active"
+    with pytest.raises(gidgethub.BadRequest) as excinfo:
+        await client.getitem(bob)
+    assert excinfo.value.status_code == 404
+    await client.put(bob, data={"role": "member"})
+    assert glom(await client.getitem(bob), "state") == "pending"
+    assert fake.orgs["some-org"]["bob"] == "pending"
+    assert fake.calls["access_tokens"] == 1
+
+    # Revalidating gets a 304, which doesn't use up any of the rate limit
+    assert glom(await client.getitem(alice), "state") == "active"
+    assert fake.not_modified["memberships"] == 1
+    assert app.cache_stats.not_modified == 1
+    budget = app.rate_limits.budgets[TEST_INSTALLATION_ID]
+    assert budget.limit == 10
+    assert budget.remaining == 6
+
+    # Secondary rate limits get waited out and retried, and latency is
+    # simulated
+    fake.latency["memberships"] = lambda: 2
+    fake.secondary_rate_limit_next("memberships", retry_after=30)
+    start = trio.current_time()
+    assert glom(await client.getitem(alice), "state") == "active"
+    assert trio.current_time() - start > 33
+    assert fake.errors["memberships"] == 1
+
+    fake.fail_next(status=503)
+    with pytest.raises(gidgethub.GitHubBroken):
+        await client.getitem(alice)
+
+    # Every attempt shows up in the metrics
+    memberships = "/orgs/{name}/memberships/{username}"
+    request_seconds = app.github_request_seconds
+    assert request_seconds.count(endpoint=memberships, status="200") == 3
+    assert request_seconds.count(endpoint=memberships, status="404") == 1
+    # The revalidation, and the retry after the secondary rate limit
+    assert request_seconds.count(endpoint=memberships, status="304") == 2
+    assert request_seconds.count(endpoint=memberships, status="403") == 1
+    assert request_seconds.count(endpoint=memberships, status="503") == 1
+    access_tokens = "/app/installations/{id}/access_tokens"
+    assert request_seconds.count(endpoint=access_tokens, status="201") == 1
+    assert app.token_refreshes.value(result="fetched") == 1
+    rendered = app.metrics.render()
+    assert "snekomatic_github_rate_limit_remaining" in rendered
+
+
+async def test_webhook_tracing(autojump_clock):
+    fake = FakeGithub()
+    fake.orgs["acme"]["alice"] = "active"
+    app = GithubApp(
+        session=fake,
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+
+    @app.route("pull_request", action="closed")
+    async def check_membership(event_type, payload, client):
+        await client.getitem("/orgs/acme/memberships/alice")
+
+    headers, body = fake_webhook(
+        "pull_request",
+        {"action": "closed", "installation": {"id": TEST_INSTALLATION_ID}},
+        secret=TEST_WEBHOOK_SECRET,
+    )
+    await app.dispatch_webhook(headers, body)
+
+    (root,) = span_tree(RECORDER.get(headers["x-github-delivery"]))
+
+    def names(node):
+        return [child["name"] for child in node["children"]]
+
+    def child(node, name):
+        (found,) = [c for c in node["children"] if c["name"] == name]
+        return found
+
+    assert root["name"] == "dispatch_webhook"
+    assert names(root) == ["verify_signature", "process_event"]
+    process = child(root, "process_event")
+    assert process["attributes"] == {"event_type": "pull_request"}
+    assert names(process) == ["consistency_delay", "route"]
+    route = child(process, "route")
+    assert route["attributes"]["handler"].endswith("check_membership")
+    # The token gets fetched on demand, inside the handler
+    assert names(route) == ["token_refresh", "github_request"]
+    token_request = child(child(route, "token_refresh"), "github_request")
+    assert token_request["attributes"] == {
+        "method": "POST",
+        "endpoint": "/app/installations/{id}/access_tokens",
+        "status": "201",
+    }
+    assert child(route, "github_request")["attributes"]["status"] == "200"
+
+    # Outside a delivery, nothing gets traced
+    before = RECORDER.recent()
+    await app.client_for(TEST_INSTALLATION_ID).getitem(
+        "/orgs/acme/memberships/alice"
+    )
+    assert RECORDER.recent() == before
+
+
+def test_endpoint_name():
+    assert (
+        _endpoint_name(
+            "https://api.github.com/repos/python-trio/trio/issues/5/comments"
+        )
+        == "/repos/{owner}/{repo}/issues/{id}/comments"
+    )
+    assert (
+        _endpoint_name("https://api.github.com/orgs/acme/members?page=2")
+        == "/orgs/{name}/members"
+    )
+    assert _endpoint_name("https://api.github.com/graphql") == "/graphql"
+
+
+def test_github_app_cache_is_bounded():
+    app = GithubApp(user_agent=TEST_USER_AGENT, cache_size=1000)
+    client = app.client_for("a")
+    small = ("etag", None, {"data": "x" * 100}, None)
+    # Sized by the response body they came from
+    client._cache.next_entry_size = 110
+    client._cache["/small"] = small
+    # Too big to fit at all
+    client._cache.next_entry_size = 2010
+    client._cache["/huge"] = ("etag", None, {"data": "x" * 2000}, None)
+    assert client._cache["/small"] == small
+    with pytest.raises(KeyError):
+        client._cache["/huge"]
+    # Old entries get evicted to make room
+    for i in range(10):
+        client._cache.next_entry_size = 110
+        client._cache[f"/{i}"] = small
+    with pytest.raises(KeyError):
+        client._cache["/small"]
+    assert app._cache.currsize <= 1000
+
+
 @attr.s
 class WebhookScenario(object):
     test_data = attr.ib()
@@ -431,6 +1442,24 @@ command_scenarios = [
         """,
         expected_commands=[["/test-command", str(i)] for i in [1, 2, 3, 4]],
     ),
+    # The rest of the last command's paragraph still affects how it's parsed
+    CommandScenario(body="/test-command heading\n---", expected_commands=[]),
+    CommandScenario(
+        body="/test-command heading\nsome text\n---", expected_commands=[]
+    ),
+    CommandScenario(
+        body="/test-command heading\nline two\nline three\n===",
+        expected_commands=[],
+    ),
+    # Long pasted logs, before and after commands
+    CommandScenario(
+        body="/test-command top\n\n" + "DEBUG: spam\n" * 5000,
+        expected_commands=[["/test-command", "top"]],
+    ),
+    CommandScenario(
+        body="DEBUG: spam\n" * 5000 + "\n/test-command bottom",
+        expected_commands=[["/test-command", "bottom"]],
+    ),
 ]
 
 
@@ -460,3 +1489,101 @@ async def test_github_app_command_routing(autojump_clock, scenario):
     )
 
     assert got_commands == scenario.expected_commands
+
+
+def test_parse_commands_is_memoized(monkeypatch):
+    calls = []
+    real_parse = gfm.parse
+
+    def counting_parse(text):
+        calls.append(text)
+        return real_parse(text)
+
+    monkeypatch.setattr(gfm, "parse", counting_parse)
+
+    # No line starts with /, so we don't parse at all
+    assert parse_commands("see /usr/bin/python\n" * 100) == []
+    assert not calls
+
+    body = "/test-memo a b"
+    commands = parse_commands(body)
+    assert commands == [["/test-memo", "a", "b"]]
+    assert len(calls) == 1
+    # Handlers can't mess up the cached copy
+    commands[0].append("c")
+    assert parse_commands(body) == [["/test-memo", "a", "b"]]
+    assert len(calls) == 1
+
+
+async def test_cpu_offload(monkeypatch):
+    parsed_in = []
+    real_parse = gfm.parse
+
+    def recording_parse(text):
+        parsed_in.append(threading.get_ident())
+        return real_parse(text)
+
+    monkeypatch.setattr(gfm, "parse", recording_parse)
+
+    app = GithubApp(app_id=TEST_APP_ID, private_key=TEST_PRIVATE_KEY)
+    app.cpu_offload.thresholds["parse_commands"] = 100
+    cpu_seconds = app.cpu_offload.cpu_seconds
+
+    small = "/test-offload small"
+    assert await app.parse_commands(small) == [["/test-offload", "small"]]
+    big = "lorem ipsum\n\n" * 20 + "/test-offload big"
+    assert await app.parse_commands(big) == [["/test-offload", "big"]]
+    # The cache works the same either way
+    assert await app.parse_commands(big) == [["/test-offload", "big"]]
+    loop_thread = threading.get_ident()
+    assert parsed_in[0] == loop_thread
+    assert len(parsed_in) == 2 and parsed_in[1] != loop_thread
+    assert cpu_seconds.count(kind="parse_commands", where="loop") == 1
+    assert cpu_seconds.count(kind="parse_commands", where="thread") == 1
+
+    app.cpu_offload.thresholds["json_decode"] = 0
+    event = LazyEvent(b'{"action": "x"}', event="ping", delivery_id="1")
+    await app.decode_event(event)
+    assert event.decoded
+    assert event.data == {"action": "x"}
+    assert cpu_seconds.count(kind="json_decode", where="thread") == 1
+
+    # App tokens are always signed in a thread, but only when they need
+    # renewing
+    token = await app._app_jwt_offloaded()
+    assert await app._app_jwt_offloaded() is token
+    assert cpu_seconds.count(kind="jwt_sign", where="thread") == 1
+
+
+async def test_concurrent_offloaded_parses():
+    # marko isn't thread-safe, so this would mix up results without
+    # _marko_lock
+    app = GithubApp(cpu_threads=4)
+    app.cpu_offload.thresholds["parse_commands"] = 0
+    filler = "> quoted\n\n<div>\nhtml\n</div>\n\n- item\n\n" * 200
+    bodies = {
+        n: filler
+        + f"/test-concurrent {n}\n\n"
+        + filler
+        + f"/test-concurrent again {n}"
+        for n in range(8)
+    }
+    results = {}
+
+    async def parse(n):
+        results[n] = await app.parse_commands(bodies[n])
+
+    async with trio.open_nursery() as nursery:
+        for n in bodies:
+            nursery.start_soon(parse, n)
+    for n in bodies:
+        expected = [
+            ["/test-concurrent", str(n)],
+            ["/test-concurrent", "again", str(n)],
+        ]
+        assert results[n] == expected
+        # What got cached is right too
+        assert parse_commands(bodies[n]) == expected
+    assert app.cpu_offload.cpu_seconds.count(
+        kind="parse_commands", where="thread"
+    ) == len(bodies)
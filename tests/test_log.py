@@ -0,0 +1,74 @@
+import io
+
+import trio
+
+from snekomatic.log import Logger, bind
+from snekomatic.tracing import start_trace
+
+
+def test_log_format_and_fields():
+    stream = io.StringIO()
+    logger = Logger(stream=stream)
+    logger.log("Plain")
+    with start_trace("test-log-fields", "test"):
+        with bind(installation_id=5):
+            logger.log("Tagged", note="two words", empty="", skipped=None)
+        logger.log("Unbound", installation_id=6)
+    assert stream.getvalue().splitlines() == [
+        "Plain",
+        "Tagged delivery_id=test-log-fields installation_id=5 "
+        'note="two words" empty=""',
+        "Unbound delivery_id=test-log-fields installation_id=6",
+    ]
+
+
+def test_log_exc_info():
+    stream = io.StringIO()
+    logger = Logger(stream=stream)
+    try:
+        raise ValueError("oops")
+    except ValueError:
+        logger.log("Failed", exc_info=True)
+    lines = stream.getvalue().splitlines()
+    assert lines[0] == "Failed"
+    assert lines[1].startswith("Traceback")
+    assert lines[-1] == "ValueError: oops"
+
+
+def test_log_sampling():
+    stream = io.StringIO()
+    logger = Logger(stream=stream)
+    logger.sample_rates["chatty"] = 0
+    logger.log("Dropped", category="chatty")
+    logger.log("Kept", category="other")
+    assert stream.getvalue() == "Kept\n"
+    assert logger.sampled_out == 1
+
+
+async def test_log_writer(autojump_clock):
+    stream = io.StringIO()
+    logger = Logger(max_pending=2, stream=stream)
+    async with trio.open_nursery() as nursery:
+        await nursery.start(logger.run_writer)
+        for i in range(3):
+            logger.log(f"Line {i}")
+        # Buffered, not written yet
+        assert stream.getvalue() == ""
+        assert logger.dropped == 1
+        await trio.sleep(1)
+        assert stream.getvalue().splitlines() == [
+            "Line 0",
+            "Line 1",
+            "Log buffer full; dropped 1 records",
+        ]
+        logger.log("Leftover")
+        # The writer might already have taken this, but not written it yet
+        nursery.cancel_scope.cancel()
+    # Written on the way out, either way
+    assert stream.getvalue().endswith("Leftover\n")
+    logger.log("After")
+    assert stream.getvalue().endswith("After\n")
+
+    metrics = {metric.name: metric for metric in logger.collect()}
+    assert metrics["snekomatic_log_dropped_total"].value() == 1
+    assert metrics["snekomatic_log_pending"].value() == 0
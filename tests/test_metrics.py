@@ -0,0 +1,80 @@
+import pytest
+
+from snekomatic.metrics import (
+    CallbackCollector,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+)
+
+
+def test_counter_and_gauge():
+    counter = Counter("things_total", "Things", ["kind"])
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    counter.inc(kind='b"\n')
+    assert counter.value(kind="a") == 3
+    assert counter.value(kind="c") == 0
+    assert counter.render() == [
+        "# HELP things_total Things",
+        "# TYPE things_total counter",
+        'things_total{kind="a"} 3',
+        'things_total{kind="b\\"\\n"} 1',
+    ]
+
+    gauge = Gauge("level", "Level")
+    assert gauge.value() is None
+    gauge.set(0.5)
+    gauge.set(1.5)
+    assert gauge.value() == 1.5
+    assert gauge.render()[-1] == "level 1.5"
+
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        gauge.set(1, kind="a")
+
+
+def test_histogram():
+    histogram = Histogram(
+        "latency_seconds", "Latency", ["route"], buckets=[1, 0.1]
+    )
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value, route="/")
+    assert histogram.count(route="/") == 4
+    assert histogram.count(route="/other") == 0
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{route="/",le="0.1"} 2',
+        'latency_seconds_bucket{route="/",le="1"} 3',
+        'latency_seconds_bucket{route="/",le="+Inf"} 4',
+        'latency_seconds_sum{route="/"} 3.65',
+        'latency_seconds_count{route="/"} 4',
+    ]
+
+
+def test_registry():
+    inner = Registry()
+    counter = inner.register(Counter("a_total", "A"))
+    counter.inc()
+
+    def collect():
+        gauge = Gauge("b", "B")
+        gauge.set(len(calls))
+        calls.append(None)
+        return [gauge]
+
+    calls = []
+    outer = Registry()
+    outer.register(inner)
+    outer.register(CallbackCollector(collect))
+    assert outer.render() == (
+        "# HELP a_total A\n"
+        "# TYPE a_total counter\n"
+        "a_total 1\n"
+        "# HELP b B\n"
+        "# TYPE b gauge\n"
+        "b 0\n"
+    )
+    # Callbacks run at every scrape
+    assert outer.render().endswith("b 1\n")
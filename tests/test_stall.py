@@ -0,0 +1,48 @@
+import os
+import time
+import traceback
+
+import trio
+
+import snekomatic
+from snekomatic.stall import StallDetector, _offender
+
+
+def _block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+async def test_stall_detector(capsys):
+    detector = StallDetector(threshold=0.05, interval=0.01)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(detector.run)
+        await trio.sleep(0.05)
+        _block_the_loop(0.3)
+        await trio.sleep(0.05)
+        nursery.cancel_scope.cancel()
+
+    offender = "test_stall.py:_block_the_loop"
+    assert list(detector.offenders) == [offender]
+    stats = detector.offenders[offender]
+    assert stats.count == 1
+    assert 0.2 < stats.max == stats.total
+    assert detector.stalls.value(offender=offender) == 1
+    assert detector.lag_seconds.count() > 1
+
+    out = capsys.readouterr().out
+    assert f"Event loop stalled offender={offender}" in out
+    assert "time.sleep(seconds)" in out
+
+
+def test_offender():
+    ours = os.path.join(os.path.dirname(snekomatic.__file__), "gh.py")
+    stack = traceback.StackSummary.from_list(
+        [
+            ("/site-packages/trio/_core/_run.py", 1, "run", None),
+            (ours, 2, "parse_commands", None),
+            ("/site-packages/marko/parser.py", 3, "parse", None),
+        ]
+    )
+    assert _offender(stack) == "gh.py:parse_commands"
+    assert _offender(stack[:1]) == "_run.py:run"
+    assert _offender([]) == "unknown"
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+import trio
+
+from snekomatic.tracing import (
+    RECORDER,
+    TraceRecorder,
+    current_trace_id,
+    span,
+    span_tree,
+    start_trace,
+)
+
+
+async def test_spans(autojump_clock):
+    # Outside a trace, spans are no-ops
+    with span("nothing") as s:
+        s.set(ignored=True)
+    assert current_trace_id() is None
+
+    async def child(n):
+        with span("child", n=n):
+            await trio.sleep(n)
+
+    with start_trace("delivery-1", "root") as root:
+        assert current_trace_id() == "delivery-1"
+        root.set(extra="x")
+        # Starting the same trace again just makes a span
+        with start_trace("delivery-1", "inner"):
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(child, 1)
+                nursery.start_soon(child, 2)
+    assert current_trace_id() is None
+
+    with pytest.raises(ValueError):
+        with start_trace("delivery-1", "retry"):
+            with span("fails"):
+                raise ValueError("oops")
+
+    roots = span_tree(RECORDER.get("delivery-1"))
+    assert [root["name"] for root in roots] == ["root", "retry"]
+    first, retry = roots
+    assert first["attributes"] == {"extra": "x"}
+    assert first["duration"] >= 0
+    (inner,) = first["children"]
+    assert inner["name"] == "inner"
+    assert sorted(c["attributes"]["n"] for c in inner["children"]) == [1, 2]
+    assert retry["children"][0]["error"] == "ValueError('oops')"
+    assert retry["error"] == "ValueError('oops')"
+
+
+def test_trace_recorder():
+    recorder = TraceRecorder(max_traces=2)
+    exported = []
+    recorder.export_to(exported.append)
+    recorder.record("a", [{"name": "receive"}])
+    recorder.record("b", [{"name": "receive"}])
+    recorder.record("a", [{"name": "process"}])
+    assert recorder.get("a") == [{"name": "receive"}, {"name": "process"}]
+    assert [trace_id for trace_id, _ in recorder.recent()] == ["a", "b"]
+    recorder.record("c", [])
+    assert recorder.get("b") is None
+    recorder.close()
+    recorder.record("d", [])
+
+    lines = [json.loads(line) for line in exported]
+    assert lines == [
+        {"trace_id": "a", "spans": [{"name": "receive"}]},
+        {"trace_id": "b", "spans": [{"name": "receive"}]},
+        {"trace_id": "a", "spans": [{"name": "process"}]},
+        {"trace_id": "c", "spans": []},
+    ]
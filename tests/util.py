@@ -5,10 +5,10 @@ import secrets
 import asks
 from contextlib import contextmanager
 
-# Partial duplicate of gidgethub.sansio.validate_event
-def sign_webhook(body: bytes, secret: str):
-    hmaccer = hmac.new(secret.encode("ascii"), msg=body, digestmod="sha1")
-    sig = "sha1=" + hmaccer.hexdigest()
+# Partial duplicate of snekomatic.gh._verify_webhook_signature
+def sign_webhook(body: bytes, secret: str, digestmod="sha1"):
+    hmaccer = hmac.new(secret.encode("ascii"), msg=body, digestmod=digestmod)
+    sig = f"{digestmod}=" + hmaccer.hexdigest()
     return sig
 
 
@@ -21,6 +21,7 @@ def fake_webhook(event_type, payload, secret):
     }
     if secret is not None:
         headers["x-hub-signature"] = sign_webhook(body, secret)
+        headers["x-hub-signature-256"] = sign_webhook(body, secret, "sha256")
     return headers, body
 
 